@@ -0,0 +1,67 @@
+import argparse
+import numpy as np
+
+from configs.utils import get_config
+from data_utils.utils import preprocess_sentence
+from evaluation import Cider, CiderReward
+from utils.logging_utils import setup_logger
+import json
+import time
+
+logger = setup_logger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config-file", type=str, required=True)
+parser.add_argument("--beam-size", type=int, default=5)
+parser.add_argument("--batch-size", type=int, default=32)
+parser.add_argument("--batches", type=int, default=50)
+parser.add_argument("--seed", type=int, default=0)
+
+args = parser.parse_args()
+
+config = get_config(args.config_file)
+
+# the references of the self-critical reward, as built by OpenEndedTask
+json_data = json.load(open(config.DATASET.JSON_PATH.TRAIN, encoding="utf-8"))
+references = {}
+for ann in json_data["annotations"]:
+    answer = " ".join(preprocess_sentence(ann["answers"], config.DATASET.VOCAB.TOKENIZER))
+    references.setdefault(str(ann["id"]), []).append(answer)
+keys = list(references.keys())
+answers = [ref for refs in references.values() for ref in refs]
+
+start_time = time.perf_counter()
+cider = Cider(references)
+logger.info("Cider built in %.2fs", time.perf_counter() - start_time)
+start_time = time.perf_counter()
+cider_reward = CiderReward(references)
+logger.info("CiderReward built in %.2fs", time.perf_counter() - start_time)
+
+# the sampled answers of a beam are drawn from the answers of the training set,
+# and one of them is the reference so that every score range is covered
+rng = np.random.RandomState(args.seed)
+cider_time = .0
+cider_reward_time = .0
+max_diff = .0
+n_rewards = 0
+for _ in range(args.batches):
+    batch_keys = [keys[idx] for idx in rng.randint(len(keys), size=args.batch_size)]
+    beam_keys = [key for key in batch_keys for _ in range(args.beam_size)]
+    beam_answers = [answers[idx] for idx in rng.randint(len(answers), size=len(beam_keys))]
+    beam_answers[::args.beam_size] = [references[key][0] for key in batch_keys]
+
+    start_time = time.perf_counter()
+    gens = {f"{idx}": [answer, ] for idx, answer in enumerate(beam_answers)}
+    gts = {f"{idx}": references[key] for idx, key in enumerate(beam_keys)}
+    scores = cider.compute_score(gts, gens)[1]
+    cider_time += time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    rewards = cider_reward.compute_score(beam_keys, beam_answers)[1]
+    cider_reward_time += time.perf_counter() - start_time
+
+    max_diff = max(max_diff, float(np.abs(scores - rewards).max()))
+    n_rewards += len(beam_keys)
+
+logger.info("Max difference to Cider: %.2e", max_diff)
+logger.info("Rewards/s: %.0f (Cider) - %.0f (CiderReward)", n_rewards / cider_time, n_rewards / cider_reward_time)
@@ -0,0 +1,48 @@
+import argparse
+import torch
+from torch import nn
+
+# imported first so that the registries resolve the imports between models, tasks and data_utils
+import builders.task_builder
+from models.modules.attentions import ScaledDotProductAttention
+from utils.logging_utils import setup_logger
+from types import SimpleNamespace
+import copy
+import time
+
+logger = setup_logger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--d-model", type=int, default=512)
+parser.add_argument("--head", type=int, default=8)
+parser.add_argument("--batch-size", type=int, default=8)
+parser.add_argument("--memory-len", type=int, default=50)
+parser.add_argument("--steps", type=int, default=100)
+
+args = parser.parse_args()
+
+torch.manual_seed(0)
+d_k = args.d_model // args.head
+attention = ScaledDotProductAttention(SimpleNamespace(HEAD=args.head, D_MODEL=args.d_model, D_KEY=d_k, D_VALUE=d_k, 
+                                                        DROPOUT=0., USE_AOA=False, CAN_BE_STATEFUL=False)).eval()
+quantized = copy.deepcopy(attention)
+quantized.split_projections()
+quantized = torch.ao.quantization.quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+
+# one decoding step attends from a single position to the encoder features
+x = torch.randn(args.batch_size, 1, args.d_model)
+memory = torch.randn(args.batch_size, args.memory_len, args.d_model)
+
+timings = {}
+max_diff = .0
+with torch.no_grad():
+    expected = attention(x, memory, memory)[0]
+    max_diff = float((quantized(x, memory, memory)[0] - expected).abs().max())
+    for name, module in (("float32", attention), ("dynamic-int8", quantized)):
+        start_time = time.perf_counter()
+        for _ in range(args.steps):
+            module(x, memory, memory)
+        timings[name] = time.perf_counter() - start_time
+
+logger.info("Max difference to float32: %.2e", max_diff)
+logger.info("%d decoding steps: %.4fs (float32) - %.4fs (dynamic-int8)", args.steps, timings["float32"], timings["dynamic-int8"])
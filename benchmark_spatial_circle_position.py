@@ -0,0 +1,39 @@
+import argparse
+import torch
+
+# imported first so that the registries resolve the imports between models, tasks and data_utils
+import builders.task_builder
+from models.modules.SCP import SpatialCirclePosition
+from utils.spatial_circle_position import loop_cells, loop_distances, random_boxes
+from utils.logging_utils import setup_logger
+from types import SimpleNamespace
+import time
+
+logger = setup_logger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--batch-size", type=int, default=8)
+parser.add_argument("--n-ocr", type=int, nargs="+", default=[50, 100])
+parser.add_argument("--image-size", type=int, nargs=2, default=[640, 480])
+parser.add_argument("--num-distance", type=int, default=8)
+
+args = parser.parse_args()
+
+# the loops are the grid assignment and distance bucketing SpatialCirclePosition had before it was vectorized
+torch.manual_seed(0)
+scp = SpatialCirclePosition(SimpleNamespace(HEAD=2, D_MODEL=16, D_KEY=8, D_VALUE=8, DROPOUT=0., USE_AOA=False, CAN_BE_STATEFUL=False,
+                                            NUM_DISTANCE=args.num_distance, CELL_DISTANCES=True)).eval()
+image_sizes = [tuple(args.image_size)] * args.batch_size
+for n_ocr in args.n_ocr:
+    boxes = random_boxes(args.batch_size, n_ocr, image_sizes)
+
+    start_time = time.perf_counter()
+    expected = loop_distances(loop_cells(boxes, image_sizes), args.num_distance)
+    loop_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    dist = scp.distance_buckets(scp.patch(boxes, torch.tensor(image_sizes)))
+    vectorized_time = time.perf_counter() - start_time
+
+    logger.info("%d tokens: %.4fs (loops) - %.4fs (vectorized), identical buckets: %s", 
+                n_ocr, loop_time, vectorized_time, torch.equal(dist, expected))
@@ -49,6 +49,8 @@ class FeatureClassificationDataset(BaseDataset):
         features = self.load_features(self.annotations[idx]["image_id"])
 
         return Instance(
+            # one row per answer, the rows of a question share its id but not their index
+            sample_idx=idx,
             question_id=item["id"],
             image_id=item["image_id"],
             filename=item["filename"],
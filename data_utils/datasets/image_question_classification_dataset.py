@@ -25,6 +25,7 @@ class ImageQuestionClassificationDataset(FeatureClassificationDataset):
         answer_tokens = self.vocab.encode_answer(answer)
 
         return Instance(
+            sample_idx=idx,
             question_id=idx,
             filename=image_file,
             image=image,
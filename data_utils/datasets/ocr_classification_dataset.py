@@ -144,6 +144,7 @@ class OcrClassificationDataset(FeatureClassificationDataset):
 
         return Instance(
             **features,
+            sample_idx=idx,
             image_id=item["image_id"],
             filename=item["filename"],
             question_tokens=question,
@@ -119,8 +119,43 @@ def unk_init(token, dim):
 def default_value():
     return None
 
-def collate_fn(samples: List[Instance]):
-    return InstanceList(samples)
+def collate_fn(samples: List[Instance], padding_idx: int=0, answer_is_sequence: bool=True, 
+               trim_padding: bool=False, pad_to_multiple_of: int=1):
+    '''
+        Besides padding the samples into a batch, records the true lengths of the padded fields
+        so that models can build their padding masks without reducing over the features.
+
+        answer_is_sequence: answer_tokens hold token sequences (open-ended tasks) rather than class labels.
+        trim_padding: cut question and answer tokens to the longest sequence of the batch, rounded up
+            to a multiple of pad_to_multiple_of, instead of keeping the padding to the vocab max lengths.
+    '''
+    batch = InstanceList(samples)
+
+    if batch.has("region_features"):
+        batch.region_lengths = torch.tensor([sample.region_features.shape[0] for sample in samples])
+
+    token_fields = [("question_tokens", "question_lengths", [])]
+    if answer_is_sequence:
+        token_fields.append(("answer_tokens", "answer_lengths", ["shifted_right_answer_tokens"]))
+    for field, length_field, aligned_fields in token_fields:
+        if not (batch.has(field) and isinstance(batch.get(field), torch.Tensor)):
+            continue
+
+        # the position after the last token which is not padding: a token inside the sequence may share
+        # its id with the padding (e.g. an <unk> mapped to it), it must not shorten the sequence
+        not_padding = batch.get(field) != padding_idx
+        positions = torch.arange(1, not_padding.shape[-1] + 1, device=not_padding.device)
+        lengths = (not_padding * positions).amax(dim=-1)
+        batch.set(length_field, lengths)
+
+        if trim_padding:
+            max_len = int(lengths.max())
+            max_len = -(-max_len // pad_to_multiple_of) * pad_to_multiple_of
+            for name in [field] + aligned_fields:
+                if batch.has(name) and batch.get(name).shape[-1] > max_len:
+                    batch.set(name, batch.get(name)[:, :max_len].contiguous())
+
+    return batch
 
 def is_japanese_sentence(text: str):
     # REFERENCE UNICODE TABLES: 
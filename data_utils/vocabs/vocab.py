@@ -65,13 +65,17 @@ class Vocab(object):
         self.freqs = Counter()
         self.max_question_length = 0
         self.max_answer_length = 0
-        for json_dir in json_dirs:
+        # tokens of the training answers (the first json), used for the output shortlist of the decoder
+        self.train_answer_tokens = set()
+        for ith, json_dir in enumerate(json_dirs):
             json_data = json.load(open(json_dir, encoding="utf-8"))
             for ann in json_data["annotations"]:
                 question = preprocess_sentence(ann["question"], self.tokenizer)
                 answer = preprocess_sentence(ann["answers"], self.tokenizer)
                 self.freqs.update(question)
                 self.freqs.update(answer)
+                if ith == 0:
+                    self.train_answer_tokens.update(answer)
                 if len(question) + 2 > self.max_question_length:
                         self.max_question_length = len(question) + 2
                 if len(answer) + 2 > self.max_answer_length:
@@ -79,6 +83,19 @@ class Vocab(object):
         print(f"Max question length: {self.max_question_length}")
         print(f"Max answer length: {self.max_answer_length}")
 
+    def answer_token_ids(self) -> List[int]:
+        '''
+            Sorted ids of the special tokens and of the tokens appearing in the training answers.
+            The special tokens hold the first ids, so they keep the same position inside the shortlist.
+        '''
+        if not hasattr(self, "train_answer_tokens"):
+            raise ValueError(f"{type(self).__name__} does not record the tokens of the training answers, "
+                                "rebuild the vocab to use the output shortlist")
+        ids = {self.stoi[token] for token in self.specials}
+        ids.update(self.stoi[token] for token in self.train_answer_tokens if token in self.stoi)
+
+        return sorted(ids)
+
     def encode_question(self, question: List[str]) -> torch.Tensor:
         """ Turn a question into a vector of indices and a question length """
         vec = torch.ones(self.max_question_length).long() * self.padding_idx
@@ -1,7 +1,7 @@
 from .bleu import Bleu
 from .meteor import Meteor
 from .rouge import Rouge
-from .cider import Cider
+from .cider import Cider, CiderReward
 from .accuracy import Accuracy
 from .f1 import F1
 from .precision import Precision
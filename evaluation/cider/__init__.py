@@ -1 +1,2 @@
-from .cider import Cider
\ No newline at end of file
+from .cider import Cider
+from .cider_reward import CiderReward
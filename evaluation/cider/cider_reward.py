@@ -0,0 +1,111 @@
+import numpy as np
+from collections import defaultdict
+
+from .cider_scorer import precook
+
+class CiderReward(object):
+    '''
+        CIDEr-D of sampled answers against a fixed corpus of references, used as the reward of
+        self-critical training. The tf-idf vectors of the references are computed once, so scoring
+        a batch only cooks the sampled answers. The clipped cosine similarities and the length
+        penalties of all the (answer, reference) pairs of the batch are then computed at once.
+        Scores are the ones of Cider(references).compute_score on the same references.
+    '''
+    def __init__(self, references: dict, n=4, sigma=6.0):
+        '''
+            references: dictionary with key <question> and value <list of reference sentences>
+        '''
+        self.n = n
+        self.sigma = sigma
+
+        cooked_references = {key: [precook(ref, n) for ref in refs] for key, refs in references.items()}
+        doc_frequency = defaultdict(float)
+        for refs in cooked_references.values():
+            for ngram in set([ngram for ref in refs for ngram in ref]):
+                doc_frequency[ngram] += 1
+        self.ref_len = np.log(float(len(cooked_references)))
+
+        # every n-gram of the references gets a column, the others can not match any reference
+        self.ngram_ids = {ngram: ith for ith, ngram in enumerate(doc_frequency)}
+        self.idf = self.ref_len - np.log(np.maximum(1.0, np.array(list(doc_frequency.values()), dtype=np.float64)))
+
+        self.references = {key: [self.vectorize(ref) for ref in refs] for key, refs in cooked_references.items()}
+
+    def vectorize(self, counts):
+        '''
+            Maps the counts of n-grams of a sentence to its tf-idf weights.
+            :return: ngram ids (-1 outside of the references), ngram orders, weights, norm per order, length
+        '''
+        ids = np.array([self.ngram_ids.get(ngram, -1) for ngram in counts], dtype=np.int64)
+        orders = np.array([len(ngram) - 1 for ngram in counts], dtype=np.int64)
+        term_freqs = np.array(list(counts.values()), dtype=np.float64)
+        # n-grams which do not appear in the references have a document frequency of 1
+        weights = term_freqs * np.where(ids >= 0, self.idf[ids], self.ref_len)
+        norms = np.sqrt(np.bincount(orders, weights=weights**2, minlength=self.n))
+        # as in CiderScorer, the length of a sentence is its count of bigrams
+        length = term_freqs[orders == 1].sum()
+
+        return ids, orders, weights, norms, length
+
+    def compute_score(self, keys, hypotheses):
+        '''
+            keys: the key of the references of each hypothesis
+            hypotheses: sentences, e.g. the answers sampled by beam search
+            :return: mean score, scores (np.ndarray)
+        '''
+        hypotheses = [self.vectorize(precook(hypothesis, self.n)) for hypothesis in hypotheses]
+        hyp_ids, hyp_orders, hyp_weights, hyp_norms, hyp_lengths = zip(*hypotheses)
+        hyp_sizes = np.array([len(ids) for ids in hyp_ids], dtype=np.int64)
+        hyp_offsets = np.cumsum(hyp_sizes) - hyp_sizes
+        hyp_ids = np.concatenate(hyp_ids)
+        hyp_orders = np.concatenate(hyp_orders)
+        hyp_weights = np.concatenate(hyp_weights)
+        hyp_norms = np.stack(hyp_norms)
+        hyp_lengths = np.array(hyp_lengths)
+
+        # one row per (hypothesis, reference) pair
+        pair_refs = [self.references[key] for key in keys]
+        n_refs = np.array([len(refs) for refs in pair_refs], dtype=np.float64)
+        pair_hyp = np.repeat(np.arange(len(keys)), n_refs.astype(np.int64))
+        pair_refs = [ref for refs in pair_refs for ref in refs]
+        n_pairs = len(pair_refs)
+        ref_ids, _, ref_weights, ref_norms, ref_lengths = zip(*pair_refs)
+        ref_sizes = np.array([len(ids) for ids in ref_ids], dtype=np.int64)
+        ref_pair = np.repeat(np.arange(n_pairs), ref_sizes)
+        ref_keys = ref_pair * len(self.ngram_ids) + np.concatenate(ref_ids)
+        ref_weights = np.concatenate(ref_weights)
+        ref_norms = np.stack(ref_norms)
+        ref_lengths = np.array(ref_lengths)
+
+        # the n-grams of the hypothesis of each pair
+        entry_sizes = hyp_sizes[pair_hyp]
+        entry_pair = np.repeat(np.arange(n_pairs), entry_sizes)
+        entries = np.repeat(hyp_offsets[pair_hyp] - (np.cumsum(entry_sizes) - entry_sizes), entry_sizes) + np.arange(entry_sizes.sum())
+        entry_ids = hyp_ids[entries]
+        entry_keys = entry_pair * len(self.ngram_ids) + entry_ids
+
+        # clipped dot products between the hypothesis and the reference of each pair, per n-gram order
+        # the keys of the references are sorted and closed by a key greater than all the others,
+        # so every n-gram of the hypotheses is searched in them. n-grams outside of the references never match
+        sort_idx = np.argsort(ref_keys, kind="stable")
+        ref_keys = np.append(ref_keys[sort_idx], n_pairs * len(self.ngram_ids))
+        ref_weights = np.append(ref_weights[sort_idx], 0.)
+        matches = np.searchsorted(ref_keys, entry_keys)
+        matched = (entry_ids >= 0) & (ref_keys[matches] == entry_keys)
+        values = np.where(matched, np.minimum(hyp_weights[entries], ref_weights[matches]) * ref_weights[matches], 0.)
+        values = np.bincount(entry_pair * self.n + hyp_orders[entries], weights=values,
+                                minlength=n_pairs * self.n).reshape(n_pairs, self.n)
+
+        # cosine similarity with a gaussian penalty on the length difference
+        norms = hyp_norms[pair_hyp] * ref_norms
+        values = np.divide(values, norms, out=values, where=norms != 0)
+        delta = hyp_lengths[pair_hyp] - ref_lengths
+        values *= np.exp(-(delta**2) / (2 * self.sigma**2))[:, None]
+
+        # mean over the n-gram orders and the references, times 10
+        scores = np.bincount(pair_hyp, weights=values.mean(axis=-1), minlength=len(keys)) / n_refs * 10.0
+
+        return np.mean(scores), scores
+
+    def __str__(self):
+        return 'CIDEr-D'
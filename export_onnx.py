@@ -0,0 +1,71 @@
+import argparse
+import torch
+import numpy as np
+
+from configs.utils import get_config
+from builders.task_builder import build_task
+from models.onnx_export import export_onnx
+from utils.onnx_predictor import OnnxPredictor
+from utils.logging_utils import setup_logger
+import os
+import time
+
+logger = setup_logger()
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--config-file", type=str, required=True)
+parser.add_argument("--output-dir", type=str, default=None)
+parser.add_argument("--check-batches", type=int, default=0,
+                    help="number of test batches used to compare the onnxruntime predictor against model.beam_search")
+
+args = parser.parse_args()
+
+config = get_config(args.config_file)
+
+task = build_task(config)
+task.load_checkpoint("best_model", weights_only=True)
+
+# the exported graphs target CPU inference
+device = torch.device("cpu")
+model = task.model.to(device)
+model.device = device
+model.eval()
+
+output_dir = args.output_dir if args.output_dir is not None else os.path.join(task.checkpoint_path, "onnx")
+items = next(iter(task.test_dict_dataloader)).to(device)
+export_onnx(model, items, output_dir)
+logger.info("ONNX graphs exported to %s", output_dir)
+
+if args.check_batches > 0:
+    predictor = OnnxPredictor(output_dir)
+    beam_size = task.evaluating_beam_size
+
+    torch_time = .0
+    onnx_time = .0
+    matched = 0
+    total = 0
+    max_diff = .0
+    for it, items in enumerate(task.test_dict_dataloader):
+        if it == args.check_batches:
+            break
+        items = items.to(device)
+
+        start_time = time.perf_counter()
+        with torch.no_grad():
+            outs, log_probs = model.beam_search(items, batch_size=items.batch_size, beam_size=beam_size, out_size=1)
+        torch_time += time.perf_counter() - start_time
+
+        input_features = {name: items.get(name).numpy() for name in predictor.encoder_inputs}
+        start_time = time.perf_counter()
+        onnx_outs, onnx_log_probs = predictor.beam_search(input_features, beam_size=beam_size)
+        onnx_time += time.perf_counter() - start_time
+
+        matched += (outs.numpy() == onnx_outs).all(axis=-1).sum()
+        total += outs.shape[0]
+        max_diff = max(max_diff, float(np.abs(log_probs.numpy() - onnx_log_probs).max()))
+
+    n_batches = min(args.check_batches, len(task.test_dict_dataloader))
+    logger.info("Identical answers: %d/%d, max log-probability difference: %.2e", matched, total, max_diff)
+    logger.info("Latency per batch: %.4fs (torch) - %.4fs (onnxruntime)", torch_time / n_batches, onnx_time / n_batches)
+
+logger.info("Task done.")
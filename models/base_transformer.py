@@ -3,6 +3,9 @@ from torch import nn
 
 from models.modules.containers import Module
 from models.modules.beam_search import BeamSearch
+from models.modules.greedy_search import GreedySearch
+from models.modules.answer_trie import AnswerTrie
+from models.modules.decoders import DecoderStepGraph
 from utils.instance import Instance
 
 class BaseTransformer(Module):
@@ -14,8 +17,21 @@ class BaseTransformer(Module):
         self.eos_idx = vocab.eos_idx
         self.d_model = config.D_MODEL
 
-        self.register_state('encoder_features', None)
-        self.register_state('encoder_padding_mask', None)
+        self.register_state('encoder_features', None, beam_invariant=True)
+        self.register_state('encoder_padding_mask', None, beam_invariant=True)
+        # nodes of the AnswerTrie reached by the decoded prefixes, when decoding is constrained to a closed answer set
+        self.register_state('answer_nodes', None)
+
+        # compiled inference graphs, built lazily at the first decoding call in eval mode.
+        # They are kept in a plain dict so they do not show up as submodules in the state_dict
+        self.compile_inference = config.COMPILE_INFERENCE if hasattr(config, "COMPILE_INFERENCE") else False
+        self._compiled = {}
+        # the explicit caches of the compiled decoder step, batch first so that beam search re-gathers them
+        self.register_state('step_enc_keys', None, beam_invariant=True)
+        self.register_state('step_enc_values', None, beam_invariant=True)
+        self.register_state('step_keys', None)
+        self.register_state('step_values', None)
+        self.register_state('step_mask', None)
 
     def init_weights(self):
         for p in self.parameters():
@@ -25,21 +41,106 @@ class BaseTransformer(Module):
     def encoder_forward(self, input_features: Instance):
         raise NotImplementedError
 
+    def compiled(self, name: str):
+        '''
+            The torch.compile graphs of encoder_forward and of the decoder step, built at the first call.
+            encoder_forward is specialized per input shape, so its graphs are reused across the buckets
+            produced by the collate padding (DATASET.PAD_TO_MULTIPLE_OF). The decoder step is the pure
+            DecoderStepGraph, its caches are inputs and outputs instead of module states mutated in place,
+            and it is compiled with dynamic shapes so that the growing caches do not trigger recompilations
+            (sizes 0 and 1 and the first step of beam search are still specialized, a few graphs in total).
+            The compilation is paid by the first decoding call and can take minutes on CPU for the full-size
+            models, so COMPILE_INFERENCE only pays off for long evaluations or prediction runs.
+        '''
+        if not self._compiled:
+            self._compiled["encoder_forward"] = torch.compile(self.encoder_forward, dynamic=False)
+            self._compiled["decoder_step"] = torch.compile(DecoderStepGraph(self.decoder), dynamic=True)
+
+        return self._compiled[name]
+
+    def use_compiled(self) -> bool:
+        return self.compile_inference and not self.training
+
+    def inference_fn(self, name: str):
+        '''
+            Returns the compiled encoder_forward when COMPILE_INFERENCE is set and the model is in eval mode,
+            otherwise the eager one.
+        '''
+        if not self.use_compiled():
+            return getattr(self, name)
+
+        return self.compiled(name)
+
+    def compiled_decoder_step(self, t: int, tokens: torch.Tensor) -> torch.Tensor:
+        '''
+            One decoding step through the compiled DecoderStepGraph, equivalent to a call of the stateful decoder.
+            tokens: (b_s, 1) vocab ids
+        '''
+        if t == 0:
+            # the encoder keys and values of every layer are projected once per decode
+            enc_keys, enc_values = zip(*[layer.enc_attn.attention.project_keys_values(self.encoder_features, self.encoder_features)
+                                            for layer in self.decoder.layers])
+            self.step_enc_keys = torch.stack(enc_keys, dim=1) # (b_s, n_layers, h, n_enc, d_k)
+            self.step_enc_values = torch.stack(enc_values, dim=1) # (b_s, n_layers, h, n_enc, d_v)
+            b_s, n_layers, h, _, d_k = self.step_enc_keys.shape
+            self.step_keys = self.step_enc_keys.new_zeros((b_s, n_layers, h, 0, d_k))
+            self.step_values = self.step_enc_values.new_zeros((b_s, n_layers, h, 0, self.step_enc_values.shape[-1]))
+            self.step_mask = torch.zeros((b_s, 1, 1, 0), dtype=torch.bool, device=tokens.device)
+
+        step = torch.full((1, ), t, dtype=torch.long, device=tokens.device)
+        output, keys, values, self.step_mask = self.compiled("decoder_step")(
+            self.to_output_ids(tokens), step,
+            self.step_enc_keys.transpose(0, 1), self.step_enc_values.transpose(0, 1), self.encoder_padding_mask,
+            self.step_keys.transpose(0, 1), self.step_values.transpose(0, 1), self.step_mask
+        )
+        self.step_keys = keys.transpose(0, 1)
+        self.step_values = values.transpose(0, 1)
+
+        return output.unsqueeze(1)
+
     def forward(self, input_features: Instance):
         raise NotImplementedError
 
-    def step(self, t, prev_output):
+    def to_output_ids(self, tokens: torch.Tensor) -> torch.Tensor:
+        '''
+            Maps vocab ids to the indices of the distribution returned by the decoder,
+            which differ from the vocab ids when the decoder uses an output shortlist.
+        '''
+        if hasattr(self.decoder, "to_output_ids"):
+            return self.decoder.to_output_ids(tokens)
+
+        return tokens
+
+    def from_output_ids(self, ids: torch.Tensor) -> torch.Tensor:
+        if hasattr(self.decoder, "from_output_ids"):
+            return self.decoder.from_output_ids(ids)
+
+        return ids
+
+    def step(self, t, prev_output, answer_trie: AnswerTrie=None):
         bs = self.encoder_features.shape[0]
         if t == 0:
             it = torch.zeros((bs, 1)).long().fill_(self.vocab.bos_idx).to(self.encoder_features.device)
         else:
-            it = prev_output
+            it = self.from_output_ids(prev_output)
 
-        output = self.decoder(
-            answer_tokens=it,
-            encoder_features=self.encoder_features,
-            encoder_attention_mask=self.encoder_padding_mask
-        )
+        if self.use_compiled():
+            output = self.compiled_decoder_step(t, it)
+        else:
+            output = self.decoder(
+                answer_tokens=it,
+                encoder_features=self.encoder_features,
+                encoder_attention_mask=self.encoder_padding_mask
+            )
+
+        if answer_trie is not None:
+            # the trie holds output ids, the nodes are re-gathered with the other states when beams are selected
+            if t == 0:
+                self.answer_nodes = answer_trie.root(bs, output.device)
+            else:
+                self.answer_nodes = answer_trie.advance(self.answer_nodes, prev_output)
+            disallowed = answer_trie.disallowed_mask(self.answer_nodes, output.shape[-1])
+            output = output.masked_fill(disallowed.unsqueeze(1), -10e4)
 
         return output
 
@@ -48,7 +149,17 @@ class BaseTransformer(Module):
                             b_s=batch_size, device=self.device)
 
         with self.statefulness(batch_size):
-            self.encoder_features, self.encoder_padding_mask = self.encoder_forward(input_features)
+            self.encoder_features, self.encoder_padding_mask = self.inference_fn("encoder_forward")(input_features)
             output =  beam_search.apply(out_size, return_probs, **kwargs)
 
-        return output
+        return (self.from_output_ids(output[0]), ) + tuple(output[1:])
+
+    def greedy_decode(self, input_features: Instance, batch_size: int, **kwargs):
+        greedy_search = GreedySearch(model=self, max_len=self.max_len, eos_idx=self.eos_idx, padding_idx=self.vocab.padding_idx,
+                                        b_s=batch_size, device=self.device)
+
+        with self.statefulness(batch_size):
+            self.encoder_features, self.encoder_padding_mask = self.inference_fn("encoder_forward")(input_features)
+            output = greedy_search.apply(**kwargs)
+
+        return (self.from_output_ids(output[0]), ) + tuple(output[1:])
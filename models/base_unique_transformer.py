@@ -3,6 +3,7 @@ from torch import nn
 
 from models.modules.containers import Module
 from models.modules.beam_search import BeamSearch
+from models.modules.greedy_search import GreedySearch
 from utils.instance import Instance
 
 class BaseUniqueTransformer(Module):
@@ -67,4 +68,15 @@ class BaseUniqueTransformer(Module):
             self.join_feature_len = self.encoder_features.shape[1]
             output =  beam_search.apply(out_size, return_probs, **kwargs)
 
-        return output
\ No newline at end of file
+        return output
+
+    def greedy_decode(self, input_features: Instance, batch_size: int, **kwargs):
+        greedy_search = GreedySearch(model=self, max_len=self.max_len, eos_idx=self.eos_idx, padding_idx=self.vocab.padding_idx,
+                                        b_s=batch_size, device=self.device)
+
+        with self.statefulness(batch_size):
+            self.encoder_features, (self.encoder_padding_mask, self.encoder_attention_mask) = self.embed_features(input_features)
+            self.join_feature_len = self.encoder_features.shape[1]
+            output = greedy_search.apply(**kwargs)
+
+        return output
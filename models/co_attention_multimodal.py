@@ -44,12 +44,14 @@ class CoAttentionMultimodal(BaseClassificationModel):
     def forward(self, input_features: Instance):
         # 1. Embeddings
         vision_features = input_features.region_features
-        vision_features, vision_padding_mask = self.vision_embedding(vision_features)
+        region_lengths = input_features.region_lengths if input_features.has("region_lengths") else None
+        vision_features, vision_padding_mask = self.vision_embedding(vision_features, region_lengths)
         # vision_features: (batch, num_obj, d_model)
         # vision_padding_mask: (batch, 1, 1, num_obj)
 
         question_tokens = input_features.question_tokens
-        text_features, (text_padding_mask, _) = self.text_embedding(question_tokens)
+        question_lengths = input_features.question_lengths if input_features.has("question_lengths") else None
+        text_features, (text_padding_mask, _) = self.text_embedding(question_tokens, question_lengths)
         # text_features: (batch, seq_len, d_model)
         # text_padding_mask: (batch, 1, 1, seq_len)
 
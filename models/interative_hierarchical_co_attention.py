@@ -2,7 +2,7 @@ import torch
 from torch import nn
 from torch.nn import init, functional as F
 
-from .utils import generate_padding_mask
+from .utils import generate_padding_mask, accumulate_ngram_features
 from models.base_transformer import BaseTransformer
 from utils.instance import InstanceList
 from builders.model_builder import META_ARCHITECTURE
@@ -45,15 +45,8 @@ class HierarchicalFeaturesExtractor(nn.Module):
         for conv in self.convs:
             ngrams_features.append(conv(features.permute((0, -1, 1))).permute((0, -1, 1)))
         
-        features_len = features.shape[-1]
-        unigram_features = ngrams_features[0]
-        # for each token in the unigram
-        for ith in range(features_len):
-            # for each n-gram, we ignore the unigram
-            for ngram in range(1, max(self.ngrams)):
-                # summing all possible n-gram tokens into the unigram
-                for prev_ith in range(max(0, ith-ngram+1), min(ith+1, ngrams_features[ngram].shape[1])):
-                    unigram_features[:, ith] += ngrams_features[ngram][:, prev_ith]
+        # summing all n-gram features covering each token into the unigram
+        unigram_features = accumulate_ngram_features(ngrams_features, self.ngrams)
 
         return unigram_features
 
@@ -112,8 +105,10 @@ class IterativeHierarchicalCoAttention(BaseTransformer):
         v = input_features.region_features
         q = input_features.question_tokens
 
-        v, v_padding_mask = self.vision_embedding(v)
-        q, (q_padding_mask, _) = self.question_embedding(q)
+        region_lengths = input_features.region_lengths if input_features.has("region_lengths") else None
+        question_lengths = input_features.question_lengths if input_features.has("question_lengths") else None
+        v, v_padding_mask = self.vision_embedding(v, region_lengths)
+        q, (q_padding_mask, _) = self.question_embedding(q, question_lengths)
         # q_padding_mask is already generated by the embedding, no need to generate again
 
         # performing hierarchical feature extraction
@@ -137,7 +132,7 @@ class IterativeHierarchicalCoAttention(BaseTransformer):
         
         # Create a mask for single combined token - all zeros (no masking)
         bs = combined.shape[0]
-        combined_mask = torch.zeros((bs, 1, 1), device=combined.device)
+        combined_mask = torch.zeros((bs, 1, 1), dtype=torch.bool, device=combined.device)
 
         return combined, combined_mask
         
@@ -148,9 +143,10 @@ class IterativeHierarchicalCoAttention(BaseTransformer):
         out = self.decoder(
             answer_tokens=answer_tokens,
             encoder_features=combined,
-            encoder_attention_mask=None  # No masking needed for single combined token
+            encoder_attention_mask=None,  # No masking needed for single combined token
+            answer_lengths=input_features.answer_lengths if input_features.has("answer_lengths") else None
         )
 
-        return F.log_softmax(out, dim=-1)
+        return F.log_softmax(out.float(), dim=-1)
 
     
\ No newline at end of file
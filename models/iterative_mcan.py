@@ -35,17 +35,20 @@ class IterativeMCAN(BaseTransformer):
         output = self.decoder(
             answer_tokens=answer_tokens,
             encoder_features=encoder_features,
-            encoder_attention_mask=encoder_padding_mask
+            encoder_attention_mask=encoder_padding_mask,
+            answer_lengths=input_features.answer_lengths if input_features.has("answer_lengths") else None
         )
 
         return output
 
     def encoder_forward(self, input_features: Instance):
         vision_features = input_features.region_features
-        vision_features, vision_padding_mask = self.vision_embedding(vision_features)
+        region_lengths = input_features.region_lengths if input_features.has("region_lengths") else None
+        vision_features, vision_padding_mask = self.vision_embedding(vision_features, region_lengths)
 
         question_tokens = input_features.question_tokens
-        text_features, (text_padding_mask, _) = self.text_embedding(question_tokens)
+        question_lengths = input_features.question_lengths if input_features.has("question_lengths") else None
+        text_features, (text_padding_mask, _) = self.text_embedding(question_tokens, question_lengths)
 
         # SA
         text_features = self.self_encoder(
@@ -102,7 +102,8 @@ class IterativeSAAA(BaseTransformer):
         v = input_features.region_features
         q = input_features.question_tokens
 
-        v, v_padding_mask = self.vision(v)
+        region_lengths = input_features.region_lengths if input_features.has("region_lengths") else None
+        v, v_padding_mask = self.vision(v, region_lengths)
         q = self.text(q)
         q_padding_mask = generate_padding_mask(q.unsqueeze(dim=1), padding_idx=self.padding_idx)
 
@@ -126,8 +127,9 @@ class IterativeSAAA(BaseTransformer):
         out = self.decoder(
             answer_tokens=answer_tokens,
             encoder_features=combined,
-            encoder_attention_mask=combined_mask
+            encoder_attention_mask=combined_mask,
+            answer_lengths=input_features.answer_lengths if input_features.has("answer_lengths") else None
         )
 
-        return F.log_softmax(out, dim=-1)
+        return F.log_softmax(out.float(), dim=-1)
     
@@ -14,66 +14,50 @@ class SpatialCirclePosition(ScaledDotProductAttention):
             num_embeddings=config.NUM_DISTANCE,
             embedding_dim=config.HEAD
         )
+        # the distances between the tokens are measured in cells from the centres of their boxes, otherwise in pixels
+        # with the former geometry, where the centroid of a box is half its width and height
+        self.cell_distances = config.CELL_DISTANCES if hasattr(config, "CELL_DISTANCES") else False
 
         self.init_weights()
 
     def init_weights(self):
         super().init_weights()
-        nn.init.xavier_uniform_(self.dist_embedding.weight)
+        # also called by ScaledDotProductAttention.__init__, before the distance embedding exists
+        if hasattr(self, "dist_embedding"):
+            nn.init.xavier_uniform_(self.dist_embedding.weight)
 
-    def patch(ocr_box: tuple,
-              image_size: tuple
-            ) -> tuple:
+    def patch(self, ocr_boxes: torch.Tensor, image_sizes: torch.Tensor) -> torch.Tensor:
         """
-            ocr_box: (x1, y1, x2, y2)
-            image_size: (w, h)
-            return: (x_centroid, y_centroid)
+            Assigns every OCR token to a cell of the 11x11 grid over its image.
+            ocr_boxes: (bs, n_ocr, 4) as (x1, y1, x2, y2)
+            image_sizes: (bs, 2) as (w, h)
+            return: the (column, row) indices of the cells, or their pixel centres with the former geometry (bs, n_ocr, 2)
         """
-        ocr_x1, ocr_y1, ocr_x2, ocr_y2 = ocr_box
-        ocr_centroid_x = (ocr_x2 - ocr_x1) // 2
-        ocr_centroid_y = (ocr_y2 - ocr_y1) // 2
+        if self.cell_distances:
+            ocr_centroids = (ocr_boxes[..., :2] + ocr_boxes[..., 2:]) // 2 # (bs, n_ocr, 2)
+        else:
+            ocr_centroids = (ocr_boxes[..., 2:] - ocr_boxes[..., :2]) // 2 # (bs, n_ocr, 2)
+        area_sizes = (image_sizes // 11).clamp(min=1).unsqueeze(1) # (bs, 1, 2)
+        # a centroid lying on a boundary goes to the higher cell, the remainder of the integer division to the last one
+        cells = torch.div(ocr_centroids, area_sizes, rounding_mode="floor").clamp(0, 10)
+        if not self.cell_distances:
+            return cells * area_sizes + area_sizes // 2
 
-        img_w, img_h = image_size
-        
-        w_per_area = img_w // 11
-        h_per_area = img_h // 11
-        x_unit_centroid = w_per_area // 2
-        y_unit_centroid = h_per_area // 2
-        
-        # list of indices
-        iths = [i for i in range(11)]
-        # list of x boundaries
-        x_lower_bounds = np.array([ith*w_per_area for ith in iths])
-        x_centroids = np.array([ith*w_per_area+x_unit_centroid for ith in iths])
-        x_higher_bounds = np.array([(ith+1)*w_per_area for ith in iths])
-        # list of y boundaries
-        y_lower_bounds = np.array([ith*h_per_area for ith in iths])
-        y_centroids = np.array([ith*h_per_area+y_unit_centroid for ith in iths])
-        y_higher_bounds = np.array([(ith+1)*h_per_area for ith in iths])
+        return cells
 
-        selected_x_centroid = None
-        selected_y_centroid = None
-        for ith in iths:
-            x_lower_bound = x_lower_bounds[ith]
-            x_higher_bound = x_higher_bounds[ith]
-            if x_lower_bound <= ocr_centroid_x <= x_higher_bound:
-                selected_x_centroid = x_centroids[ith]
-
-            y_lower_bound = y_lower_bounds[ith]
-            y_higher_bound = y_higher_bounds[ith]
-            if y_lower_bound <= ocr_centroid_y <= y_higher_bound:
-                selected_y_centroid = y_centroids[ith]
-
-        return (selected_x_centroid, selected_y_centroid)
-    
-    def pytha(self, p_i: torch.Tensor, p_j: torch.Tensor) -> torch.Tensor:
+    def distance_buckets(self, cells: torch.Tensor) -> torch.Tensor:
         """
-            p_i: (bs, 2)
-            p_j: (bs, 2)
-            return: (bs, )
+            cells: (bs, n_ocr, 2)
+            return: the truncated Euclidean distances between the cells, in cells capped at NUM_DISTANCE - 1, or in pixels
+                with the former geometry (bs, n_ocr, n_ocr)
         """
-        delta = p_i - p_j
-        return torch.sqrt(torch.square(delta[0]) + torch.square(delta[1])).long()
+        dist = torch.cdist(cells.float(), cells.float(), compute_mode="donot_use_mm_for_euclid_dist") # (bs, n_ocr, n_ocr)
+        if not self.cell_distances:
+            # not capped, NUM_DISTANCE has to exceed the diagonal of the images
+            return dist.long()
+        boundaries = torch.arange(1, self.dist_embedding.num_embeddings, device=dist.device, dtype=dist.dtype)
+
+        return torch.bucketize(dist, boundaries, right=True)
 
     def forward(self,
                 ocr_features: torch.Tensor,
@@ -84,27 +68,17 @@ class SpatialCirclePosition(ScaledDotProductAttention):
         """
             ocr_boxes: (bs, n_ocr, 4)
             ocr_padding_masks: (bs, 1, 1, n_ocr)
+            image_sizes: (w, h) of each image
         """
         bs, nq, _ = ocr_boxes.shape
-        patch_boxes = torch.zeros((bs, nq, 2), device=ocr_boxes.device)
-        for batch in bs:
-            image_size = image_sizes[batch]
-            for ith in range(nq):
-                patch_boxes[batch][ith] = torch.Tensor(self.patch(image_size)).to(ocr_boxes.device)
-
-        dist = torch.zeros((bs, nq, nq)).long().to(ocr_boxes.device)
-        for i in range(nq):
-            for j in range(i, nq):
-                dist[:, i, j] = self.pytha(patch_boxes[:, i], patch_boxes[:, j]).to(ocr_boxes.device)
-                dist[:, j, i] = self.pytha(patch_boxes[:, j], patch_boxes[:, i]).to(ocr_boxes.device)
-        dist = dist.unsqueeze(-1)# (bs, nq, nq, 1)
-        dist = self.dist_embedding(dist) # (bs, nq, nq, d_k)
+        image_sizes = torch.as_tensor(image_sizes, device=ocr_boxes.device).view(bs, 2)
+        cells = self.patch(ocr_boxes, image_sizes)
+        dist = self.distance_buckets(cells) # (bs, nq, nq)
+        dist = self.dist_embedding(dist).permute(0, 3, 1, 2) # (bs, h, nq, nq)
 
-        q = self.fc_q(ocr_features).view(bs, nq, self.h, self.d_k).permute(0, 2, 1, 3)  # (bs, h, nq, d_k)
-        k = self.fc_k(ocr_features).view(bs, nq, self.h, self.d_k).permute(0, 2, 3, 1)  # (bs, h, d_k, nk)
-        v = self.fc_v(ocr_features).view(bs, nq, self.h, self.d_v).permute(0, 2, 1, 3)  # (bs, h, nk, d_v)
-        att = torch.matmul(q, k) / np.sqrt(self.d_k)  # (bs, h, nq, nq)
-        att += ocr_padding_masks
+        q, k, v = self.project_qkv(ocr_features) # (bs, h, nq, d_k), (bs, h, nk, d_k), (bs, h, nk, d_v)
+        att = torch.matmul(q, k.transpose(-2, -1)) / np.sqrt(self.d_k)  # (bs, h, nq, nq)
+        att = att.masked_fill(ocr_padding_masks, -10e4)
         att = torch.softmax(att + dist, dim=-1)
         out = torch.matmul(att, v).permute(0, 2, 1, 3).contiguous().view(bs, nq, self.h * self.d_v)  # (bs, nq, h*d_v)
         out = self.fc_o(out)  # (bs, nq, d_model)
@@ -0,0 +1,81 @@
+import torch
+from typing import List
+
+class AnswerTrie(object):
+    '''
+        Prefix tree over the token ids of a closed set of answers, each one closed by <eos>.
+        Decoding through the trie only produces answers of the set: at every step the tokens
+        which do not extend a known prefix are masked out of the log-probabilities.
+        Node 0 is the root. A node without children ends an answer, it leaves the next tokens
+        free since the decoding search already ignores what follows <eos>.
+        The edges are kept as tensors sorted by parent then token, so the children of a node are
+        contiguous. Both decoding steps index them on the device of the nodes, without reading back
+        the nodes.
+    '''
+    def __init__(self, answers: List[List[int]], eos_idx: int):
+        children = [{}]
+        answers = {tuple(answer) for answer in answers}
+        for answer in answers:
+            node = 0
+            for token in answer + (eos_idx, ):
+                if token not in children[node]:
+                    children[node][token] = len(children)
+                    children.append({})
+                node = children[node][token]
+        self.n_answers = len(answers)
+
+        edges = [(node, token, child) for node, node_children in enumerate(children)
+                    for token, child in sorted(node_children.items())]
+        parents, tokens, targets = torch.tensor(edges, dtype=torch.long).view(-1, 3).unbind(dim=-1)
+        # the key of an edge is unique and increasing with (parent, token)
+        self.key_base = max(tokens.tolist(), default=eos_idx) + 1
+        self.edge_keys = parents * self.key_base + tokens
+        self.edge_tokens = tokens
+        self.edge_targets = targets
+        self.counts = torch.bincount(parents, minlength=len(children))
+        self.offsets = torch.cumsum(self.counts, dim=0) - self.counts
+        self.max_children = int(self.counts.max())
+
+    def __len__(self):
+        return self.n_answers
+
+    def to(self, device):
+        for name in ("edge_keys", "edge_tokens", "edge_targets", "counts", "offsets"):
+            setattr(self, name, getattr(self, name).to(device))
+
+        return self
+
+    def root(self, batch_size: int, device) -> torch.Tensor:
+        return torch.zeros((batch_size, ), dtype=torch.long, device=device)
+
+    def advance(self, nodes: torch.Tensor, tokens: torch.Tensor) -> torch.Tensor:
+        '''
+            nodes: (N, ), tokens: (N, 1)
+            return: the nodes reached by appending tokens to the prefixes of nodes (N, )
+        '''
+        if self.edge_keys.device != nodes.device:
+            self.to(nodes.device)
+        tokens = tokens.view(-1)
+        keys = nodes * self.key_base + tokens
+        edges = torch.searchsorted(self.edge_keys, keys).clamp(max=self.edge_keys.shape[0] - 1)
+        found = (self.edge_keys[edges] == keys) & (tokens < self.key_base)
+
+        # a token which does not extend the prefix keeps its node, e.g. after <eos>
+        return torch.where(found, self.edge_targets[edges], nodes)
+
+    def disallowed_mask(self, nodes: torch.Tensor, vocab_len: int) -> torch.Tensor:
+        '''
+            nodes: (N, )
+            return: True for the tokens which do not extend the prefixes of nodes (N, vocab_len)
+        '''
+        if self.edge_keys.device != nodes.device:
+            self.to(nodes.device)
+        counts = self.counts[nodes].unsqueeze(-1) # (N, 1)
+        ranks = torch.arange(self.max_children, device=nodes.device) # (max_children, )
+        edges = (self.offsets[nodes].unsqueeze(-1) + ranks).clamp(max=self.edge_tokens.shape[0] - 1) # (N, max_children)
+        # the ranks past the children of a node are sent to an extra column, dropped after the scatter
+        tokens = torch.where(ranks < counts, self.edge_tokens[edges], vocab_len)
+        allowed = torch.zeros((nodes.shape[0], vocab_len + 1), dtype=torch.bool, device=nodes.device)
+        allowed = allowed.scatter_(1, tokens, True)[:, :vocab_len] | (counts == 0)
+
+        return ~allowed
@@ -5,7 +5,39 @@ import numpy as np
 from builders.attention_builder import build_attention, META_ATTENTION
 
 from models.modules.containers import Module
-from models.utils import clones, box_relational_embedding
+from models.utils import box_relational_embedding
+
+ATTENTION_BACKENDS = ("math", "fused")
+
+def scaled_dot_product_attention(q, k, v, attention_mask=None, backend="math", need_weights=False):
+    '''
+        q: (..., nq, d_k), k: (..., nk, d_k), v: (..., nk, d_v)
+        attention_mask: boolean mask broadcastable to (..., nq, nk). True indicates masking.
+        return: the attended values (..., nq, d_v) and the attention map (..., nq, nk), which the fused
+            backend does not materialize unless need_weights is set.
+    '''
+    if backend == "fused" and not need_weights:
+        if k.shape[:-2] != q.shape[:-2]:
+            k = k.expand(*q.shape[:-2], *k.shape[-2:])
+            v = v.expand(*q.shape[:-2], *v.shape[-2:])
+        if attention_mask is not None:
+            # torch yields NaN for the queries whose keys are all masked, where the math backend attends
+            # uniformly. Their keys are left unmasked and their output is replaced by the mean of the values
+            fully_masked = attention_mask.all(dim=-1, keepdim=True)
+            attention_mask = ~(attention_mask & ~fully_masked) # torch takes True as the positions that take part in attention
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=attention_mask)
+        if attention_mask is not None:
+            out = torch.where(fully_masked, v.mean(dim=-2, keepdim=True), out)
+
+        return out, None
+
+    att = torch.matmul(q, k.transpose(-2, -1)) / np.sqrt(q.shape[-1])  # (..., nq, nk)
+    if attention_mask is not None:
+        att = att.masked_fill(attention_mask, -10e4)
+    att = torch.softmax(att, dim=-1)
+    out = torch.matmul(att, v)  # (..., nq, d_v)
+
+    return out, att
 
 @META_ATTENTION.register()
 class ScaledDotProductAttention(nn.Module):
@@ -21,9 +53,8 @@ class ScaledDotProductAttention(nn.Module):
         d_k = config.D_KEY
         d_v = config.D_VALUE
 
-        self.fc_q = nn.Linear(d_model, h * d_k)
-        self.fc_k = nn.Linear(d_model, h * d_k)
-        self.fc_v = nn.Linear(d_model, h * d_v)
+        # the projections of queries, keys and values are stored fused so that self-attention runs a single GEMM
+        self.fc_qkv = nn.Linear(d_model, h * d_k * 2 + h * d_v)
         self.fc_o = nn.Linear(h * d_v, d_model)
 
         self.d_model = d_model
@@ -31,43 +62,133 @@ class ScaledDotProductAttention(nn.Module):
         self.d_v = d_v
         self.h = h
 
+        self.backend = config.BACKEND if hasattr(config, "BACKEND") else "math"
+        if self.backend not in ATTENTION_BACKENDS:
+            raise ValueError(f"Attention backend must be one of {ATTENTION_BACKENDS}, got {self.backend}")
+
         self.init_weights()
 
     def init_weights(self):
-        nn.init.xavier_uniform_(self.fc_q.weight)
-        nn.init.xavier_uniform_(self.fc_k.weight)
-        nn.init.xavier_uniform_(self.fc_v.weight)
+        # each of the q, k and v blocks is initialized as a separate layer
+        q_end = self.h * self.d_k
+        k_end = 2 * self.h * self.d_k
+        nn.init.xavier_uniform_(self.fc_qkv.weight[:q_end])
+        nn.init.xavier_uniform_(self.fc_qkv.weight[q_end:k_end])
+        nn.init.xavier_uniform_(self.fc_qkv.weight[k_end:])
         nn.init.xavier_uniform_(self.fc_o.weight)
-        nn.init.constant_(self.fc_q.bias, 0)
-        nn.init.constant_(self.fc_k.bias, 0)
-        nn.init.constant_(self.fc_v.bias, 0)
+        nn.init.constant_(self.fc_qkv.bias, 0)
         nn.init.constant_(self.fc_o.bias, 0)
 
-    def forward(self, queries, keys, values, attention_mask=None, **kwargs):
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with separate fc_q, fc_k and fc_v layers
+        if prefix + "fc_k.weight" in state_dict:
+            for param in ("weight", "bias"):
+                state_dict[prefix + f"fc_qkv.{param}"] = torch.cat([state_dict.pop(prefix + f"{fc}.{param}") 
+                                                                        for fc in ("fc_q", "fc_k", "fc_v")], dim=0)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def split_projections(self):
+        '''
+            Replaces fc_qkv by the layers fc_q and fc_kv. Dynamic quantization turns every nn.Linear into
+            a quantized layer whose rows can not be sliced, each projection then runs a whole int8 layer.
+        '''
+        q_end = self.h * self.d_k
+        weight, bias = self.fc_qkv.weight.detach(), self.fc_qkv.bias.detach()
+        self.fc_q = nn.Linear(self.d_model, q_end).to(weight.device)
+        self.fc_kv = nn.Linear(self.d_model, self.fc_qkv.out_features - q_end).to(weight.device)
+        with torch.no_grad():
+            self.fc_q.weight.copy_(weight[:q_end])
+            self.fc_q.bias.copy_(bias[:q_end])
+            self.fc_kv.weight.copy_(weight[q_end:])
+            self.fc_kv.bias.copy_(bias[q_end:])
+        del self.fc_qkv
+
+    def _project(self, x, start: int, end: int):
+        if hasattr(self, "fc_qkv"):
+            return F.linear(x, self.fc_qkv.weight[start:end], self.fc_qkv.bias[start:end])
+
+        # split by split_projections, the ranges asked for are the queries or lie within the keys and values
+        q_end = self.h * self.d_k
+        if end <= q_end:
+            return self.fc_q(x)[..., start:end]
+
+        return self.fc_kv(x)[..., start - q_end:end - q_end]
+
+    def project_queries(self, queries):
         b_s, nq = queries.shape[:2]
-        nk = keys.shape[1]
 
-        q = self.fc_q(queries).view(b_s, nq, self.h, self.d_k).permute(0, 2, 1, 3)  # (b_s, h, nq, d_k)
-        k = self.fc_k(keys).view(b_s, nk, self.h, self.d_k).permute(0, 2, 3, 1)  # (b_s, h, d_k, nk)
-        v = self.fc_v(values).view(b_s, nk, self.h, self.d_v).permute(0, 2, 1, 3)  # (b_s, h, nk, d_v)
+        return self._project(queries, 0, self.h * self.d_k).view(b_s, nq, self.h, self.d_k).permute(0, 2, 1, 3)  # (b_s, h, nq, d_k)
 
-        att = torch.matmul(q, k) / np.sqrt(self.d_k)  # (b_s, h, nq, nk)
-        if attention_mask is not None:
-            # 1. Đảm bảo mask luôn là 4D (b_s, 1, nq, nk)
-            if attention_mask.dim() == 3:
+    def project_keys_values(self, keys, values):
+        b_s, nk = keys.shape[:2]
+        kv_end = 2 * self.h * self.d_k + self.h * self.d_v
+
+        if keys is values:
+            k, v = self._project(keys, self.h * self.d_k, kv_end).split([self.h * self.d_k, self.h * self.d_v], dim=-1)
+        else:
+            k = self._project(keys, self.h * self.d_k, 2 * self.h * self.d_k)
+            v = self._project(values, 2 * self.h * self.d_k, kv_end)
+        k = k.view(b_s, nk, self.h, self.d_k).permute(0, 2, 1, 3)  # (b_s, h, nk, d_k)
+        v = v.view(b_s, nk, self.h, self.d_v).permute(0, 2, 1, 3)  # (b_s, h, nk, d_v)
+
+        return k, v
+
+    def project_qkv(self, features):
+        b_s, n = features.shape[:2]
+
+        if hasattr(self, "fc_qkv"):
+            q, k, v = self.fc_qkv(features).split([self.h * self.d_k, self.h * self.d_k, self.h * self.d_v], dim=-1)
+        else:
+            q = self.fc_q(features)
+            k, v = self.fc_kv(features).split([self.h * self.d_k, self.h * self.d_v], dim=-1)
+        q = q.view(b_s, n, self.h, self.d_k).permute(0, 2, 1, 3)  # (b_s, h, n, d_k)
+        k = k.view(b_s, n, self.h, self.d_k).permute(0, 2, 1, 3)  # (b_s, h, n, d_k)
+        v = v.view(b_s, n, self.h, self.d_v).permute(0, 2, 1, 3)  # (b_s, h, n, d_v)
+
+        return q, k, v
+
+    def forward(self, queries, keys, values, attention_mask=None, projected_keys_values=None, need_weights=False, **kwargs):
+        '''
+            attention_mask: boolean mask broadcastable to (b_s, h, nq, nk). True indicates masking.
+            projected_keys_values: optional (k, v) already computed by project_keys_values, in which case
+                keys and values are not projected again (used by the decoding caches of MultiHeadAttention).
+            need_weights: the fused backend only returns the attention map when it is asked for.
+        '''
+        b_s, nq = queries.shape[:2]
+
+        if projected_keys_values is None and queries is keys and keys is values:
+            q, k, v = self.project_qkv(queries)
+        else:
+            q = self.project_queries(queries)
+            if projected_keys_values is None:
+                k, v = self.project_keys_values(keys, values)
+            else:
+                k, v = projected_keys_values
+
+        if attention_mask is not None and attention_mask.dim() == 3:
+            # Đảm bảo mask luôn là 4D (b_s, 1, nq, nk)
+            attention_mask = attention_mask.unsqueeze(1)
+
+        # Beam Search: keys, values or masks kept once per sample (beam-invariant states) are broadcast over the beams
+        n_samples = k.shape[0]
+        if attention_mask is not None and attention_mask.shape[0] not in (1, b_s):
+            n_samples = attention_mask.shape[0]
+        if n_samples != b_s:
+            q = q.view(n_samples, b_s // n_samples, *q.shape[1:])  # (bs, beam_size, h, nq, d_k)
+            k = k.view(n_samples, -1, *k.shape[1:])
+            v = v.view(n_samples, -1, *v.shape[1:])
+            if attention_mask is not None:
                 attention_mask = attention_mask.unsqueeze(1)
-            
-            # 2. Xử lý trường hợp Beam Search (khi b_s của att đã bị nhân lên)
-            if att.shape[0] != attention_mask.shape[0]:
-                beam_size = att.shape[0] // attention_mask.shape[0]
-                attention_mask = attention_mask.unsqueeze(1).repeat(1, beam_size, 1, 1, 1)
-                attention_mask = attention_mask.view(att.shape[0], *attention_mask.shape[2:])
-            
-            att += attention_mask   
-        att = torch.softmax(att, dim=-1)
-        out = torch.matmul(att, v).permute(0, 2, 1, 3).contiguous().view(b_s, nq, self.h * self.d_v)  # (b_s, nq, h*d_v)
+
+        out, att = scaled_dot_product_attention(q, k, v, attention_mask, backend=self.backend, need_weights=need_weights)
+        out = out.reshape(b_s, self.h, nq, self.d_v)
+        out = out.permute(0, 2, 1, 3).contiguous().view(b_s, nq, self.h * self.d_v)  # (b_s, nq, h*d_v)
         out = self.fc_o(out)  # (b_s, nq, d_model)
 
+        if att is not None:
+            att = att.reshape(b_s, *att.shape[-3:]) # (b_s, h, nq, nk)
+
         return out, att
 
 @META_ATTENTION.register()
@@ -95,13 +216,17 @@ class AugmentedGeometryScaledDotProductAttention(nn.Module):
         self.fc_k = nn.Linear(d_model, h * d_k)
         self.fc_v = nn.Linear(d_model, h * d_v)
         self.fc_o = nn.Linear(h * d_v, d_model)
-        self.fc_gs = clones(nn.Linear(self.d_g, 1), h)
+        self.fc_g = nn.Linear(self.d_g, h) # geometry weights of all the heads at once
 
         self.d_model = d_model
         self.d_k = d_k
         self.d_v = d_v
         self.h = h
 
+        # when set, the geometry weights are computed for this many boxes at a time instead of materializing
+        # the whole (bs, n, n, d_g) embedding
+        self.chunk_size = config.GEOMETRY_CHUNK_SIZE if hasattr(config, "GEOMETRY_CHUNK_SIZE") else None
+
         self.init_weights()
 
     def init_weights(self):
@@ -109,26 +234,46 @@ class AugmentedGeometryScaledDotProductAttention(nn.Module):
         nn.init.xavier_uniform_(self.fc_k.weight)
         nn.init.xavier_uniform_(self.fc_v.weight)
         nn.init.xavier_uniform_(self.fc_o.weight)
-        for fc_g in self.fc_gs:
-            nn.init.xavier_uniform_(fc_g.weight)
+        nn.init.xavier_uniform_(self.fc_g.weight)
 
         nn.init.constant_(self.fc_q.bias, 0)
         nn.init.constant_(self.fc_k.bias, 0)
         nn.init.constant_(self.fc_v.bias, 0)
         nn.init.constant_(self.fc_o.bias, 0)
-        for fc_g in self.fc_gs:
-            nn.init.constant_(fc_g.bias, 0)
+        nn.init.constant_(self.fc_g.bias, 0)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved with one nn.Linear(d_g, 1) per head in fc_gs
+        if prefix + "fc_gs.0.weight" in state_dict:
+            state_dict[prefix + "fc_g.weight"] = torch.cat([state_dict.pop(prefix + f"fc_gs.{ith}.weight") for ith in range(self.h)], dim=0)
+            state_dict[prefix + "fc_g.bias"] = torch.cat([state_dict.pop(prefix + f"fc_gs.{ith}.bias") for ith in range(self.h)], dim=0)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def geometry_weights(self, boxes, relative_geometry_embeddings=None):
+        '''
+            relative_geometry_embeddings: the (bs, n, n, d_g) embedding of boxes, when it is shared across layers.
+            return: the per-head geometry weights (bs, h, n, n)
+        '''
+        if relative_geometry_embeddings is not None:
+            return F.relu(self.fc_g(relative_geometry_embeddings)).permute(0, 3, 1, 2)
+
+        if self.chunk_size is None:
+            relative_geometry_embeddings = box_relational_embedding(boxes, dim_g=self.d_g, trignometric_embedding=self.trignometric_embedding)
+            return F.relu(self.fc_g(relative_geometry_embeddings)).permute(0, 3, 1, 2)
+
+        relative_geometry_weights = []
+        for start in range(0, boxes.shape[1], self.chunk_size):
+            relative_geometry_embeddings = box_relational_embedding(boxes, dim_g=self.d_g, trignometric_embedding=self.trignometric_embedding, 
+                                                                    query_boxes=boxes[:, start:start+self.chunk_size])
+            relative_geometry_weights.append(F.relu(self.fc_g(relative_geometry_embeddings)))
 
-    def forward(self, queries, keys, values, boxes, attention_mask=None, **kwargs):
+        return torch.cat(relative_geometry_weights, dim=1).permute(0, 3, 1, 2)
+
+    def forward(self, queries, keys, values, attention_mask=None, boxes=None, relative_geometry_embeddings=None, **kwargs):
         # embedding geometric information from boxes coordinates
-        relative_geometry_embeddings = box_relational_embedding(boxes, dim_g=self.d_g, trignometric_embedding=self.trignometric_embedding)
-        flatten_relative_geometry_embeddings = relative_geometry_embeddings.view(-1, self.d_g)
-        bs, nk, _, _ = relative_geometry_embeddings.shape
-        box_size_per_head = [bs, 1, nk, nk]
-        relative_geometry_weights_per_head = [fc_g(flatten_relative_geometry_embeddings).view(box_size_per_head) for fc_g in self.fc_gs]
-        relative_geometry_weights = torch.cat(relative_geometry_weights_per_head, dim=1) # (bs, h, nk, nk)
-        relative_geometry_weights = F.relu(relative_geometry_weights)
-        
+        relative_geometry_weights = self.geometry_weights(boxes, relative_geometry_embeddings) # (bs, h, nk, nk)
+
         b_s, nq = queries.shape[:2]
         nk = keys.shape[1]
         q = self.fc_q(queries).view(b_s, nq, self.h, self.d_k).permute(0, 2, 1, 3)  # (b_s, h, nq, d_k)
@@ -137,7 +282,7 @@ class AugmentedGeometryScaledDotProductAttention(nn.Module):
 
         a = torch.matmul(q, k) / np.sqrt(self.d_k)  # (b_s, h, nq, nk)
         if attention_mask is not None:
-            att += attention_mask
+            a = a.masked_fill(attention_mask, -10e4)
 
         g = relative_geometry_weights
         mn = torch.log(torch.clamp(g, min = 1e-6)) + a
@@ -211,7 +356,7 @@ class AugmentedMemoryScaledDotProductAttention(nn.Module):
 
         att = torch.matmul(q, k) / np.sqrt(self.d_k)  # (b_s, h, nq, nk)
         if attention_mask is not None:
-            att[:, :, :, :nk] = att[:, :, :, :nk] + attention_mask
+            att[:, :, :, :nk] = att[:, :, :, :nk].masked_fill(attention_mask, -10e4)
         att = torch.softmax(att, -1)
         out = torch.matmul(att, v).permute(0, 2, 1, 3).contiguous().view(b_s, nq, self.h * self.d_v)  # (b_s, nq, h*d_v)
         out = self.fc_o(out)  # (b_s, nq, d_model)
@@ -260,14 +405,14 @@ class AdaptiveScaledDotProductAttention(nn.Module):
         nn.init.constant_(self.fc_o.bias, 0)
         nn.init.constant_(self.fc_s.bias, 0)
 
-    def forward(self, queries, keys, values, language_signals, attention_mask=None):
+    def forward(self, queries, keys, values, attention_mask=None, language_signals=None, **kwargs):
         '''
         Computes
         :param queries: Queries (b_s, nq, d_model)
         :param keys: Keys (b_s, nk, d_model)
         :param values: Values (b_s, nk, d_model)
-        :param language_signals: Language signals (b_s, ns, d_model)
         :param attention_mask: Mask over attention values (b_s, h, nq, nk). True indicates masking.
+        :param language_signals: Language signals (b_s, ns, d_model)
         :param attention_weights: Multiplicative weights for attention values (b_s, h, nq, nk).
         :return:
         '''
@@ -283,18 +428,16 @@ class AdaptiveScaledDotProductAttention(nn.Module):
 
         attn = torch.matmul(q, k) / np.sqrt(self.d_k)  # (b_s, h, nq, nk)
         if attention_mask is not None:
-            attn = attn + attention_mask
+            attn = attn.masked_fill(attention_mask, -10e4)
 
-        language_attn = torch.matmul(q, s.permute(0, 1, 3, 2)) / np.sqrt(self.d_k)  # (b_s, h, nq, nq)
-        language_attn = torch.cat([language_attn[:, :, i, i].unsqueeze(-1) for i in range(nq)], -1) # (b_s, h, nq)
+        # each query only attends to its own language signal, so only the diagonal of q.s^T is needed
+        language_attn = torch.einsum("bhqd,bhqd->bhq", q, s) / np.sqrt(self.d_k)  # (b_s, h, nq)
 
         combined_attn = torch.cat([attn, language_attn.unsqueeze(-1)], dim=-1)     # (b_s, h, nq, nk + 1)
-        combined_attn = [torch.softmax(combined_attn[:, :, i, :].unsqueeze(2), dim=-1) for i in range(nq)] # [ (b_s, h, 1, nk + 1) ]
-
-        combined_v = [torch.cat([v, s[:, :, i, :].unsqueeze(2)], 2) for i in range(nq)] # [ (b_s, h, nk + 1, d_v) ]
+        combined_attn = torch.softmax(combined_attn, dim=-1)
 
-        assert len(combined_attn) == len(combined_v) == nq
-        out = torch.cat([torch.matmul(combined_attn[i], combined_v[i]) for i in range(nq)], dim=2)
+        # the weight of the extra slot is applied to the query's own signal instead of concatenating it to v per query
+        out = torch.matmul(combined_attn[..., :nk], v) + combined_attn[..., nk:] * s # (b_s, h, nq, d_v)
 
         out = out.permute(0, 2, 1, 3).contiguous().view(b_s, nq, self.h * self.d_v)  # (b_s, nq, h*d_v)
         out = self.fc_o(out)  # (b_s, nq, d_model)
@@ -306,7 +449,7 @@ class MultiHeadAttention(Module):
         Multi-head attention layer with Dropout and Layer Normalization.
     '''
 
-    def __init__(self, config):
+    def __init__(self, config, max_len: int=None):
         super(MultiHeadAttention, self).__init__()
         
         d_model = config.D_MODEL
@@ -323,17 +466,98 @@ class MultiHeadAttention(Module):
         self.layer_norm = nn.LayerNorm(d_model)
 
         self.can_be_stateful = config.CAN_BE_STATEFUL
+        # attention modules that expose project_keys_values get a cache of projected, head-split keys and values
+        self.use_kv_cache = hasattr(self.attention, "project_keys_values")
+        self.max_len = max_len
+        self.running_len = 0
         if self.can_be_stateful:
-            self.register_state('running_keys', torch.zeros((0, d_model)))
-            self.register_state('running_values', torch.zeros((0, d_model)))
+            if self.use_kv_cache:
+                # (b_s, h, max_len, d_k) and (b_s, h, max_len, d_v), allocated at the first decoding step
+                self.register_state('running_keys', None)
+                self.register_state('running_values', None)
+            else:
+                self.register_state('running_keys', torch.zeros((0, d_model)))
+                self.register_state('running_values', torch.zeros((0, d_model)))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the cache of projected keys and values hold the empty
+        # (0, d_model) running_keys and running_values buffers, which are only states
+        if self.can_be_stateful and self.use_kv_cache:
+            state_dict.pop(prefix + "running_keys", None)
+            state_dict.pop(prefix + "running_values", None)
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _init_states(self, batch_size: int):
+        super()._init_states(batch_size)
+        self.running_len = 0
+
+    def _reset_states(self):
+        super()._reset_states()
+        self.running_len = 0
+
+    def apply_to_states(self, fn, include_beam_invariant: bool=True):
+        if not (self.can_be_stateful and self.use_kv_cache and self.running_keys is not None):
+            super().apply_to_states(fn, include_beam_invariant)
+            return
+
+        # only the filled part of the caches is reordered, and it is written back into the preallocated buffers
+        for name in self._state_names:
+            cache = self._buffers[name]
+            filled = fn(cache[:, :, :self.running_len])
+            if torch.is_grad_enabled():
+                # the caches of the earlier steps are saved for backward, they must not be overwritten
+                self._buffers[name] = filled
+                continue
+            if filled.shape[0] != cache.shape[0]:
+                cache = cache.new_empty((filled.shape[0], ) + cache.shape[1:])
+                self._buffers[name] = cache
+            cache[:, :, :self.running_len] = filled
+
+    def update_kv_cache(self, keys, values):
+        k, v = self.attention.project_keys_values(keys, values)
+        start = self.running_len
+        end = start + k.shape[2]
+
+        if torch.is_grad_enabled():
+            # decoding with gradients (e.g. self-critical training): the keys and values of the earlier steps
+            # are saved for backward, so the caches are extended out of place instead of written into a buffer
+            if self.running_keys is not None:
+                k = torch.cat([self.running_keys[:, :, :start], k], dim=2)
+                v = torch.cat([self.running_values[:, :, :start], v], dim=2)
+            self.running_keys = k
+            self.running_values = v
+            self.running_len = end
+
+            return k, v
+
+        if self.running_keys is None or end > self.running_keys.shape[2]:
+            capacity = max(self.max_len or 0, 2*end)
+            running_keys = k.new_empty((k.shape[0], k.shape[1], capacity, k.shape[-1]))
+            running_values = v.new_empty((v.shape[0], v.shape[1], capacity, v.shape[-1]))
+            if self.running_keys is not None:
+                running_keys[:, :, :start] = self.running_keys[:, :, :start]
+                running_values[:, :, :start] = self.running_values[:, :, :start]
+            self.running_keys = running_keys
+            self.running_values = running_values
+
+        self.running_keys[:, :, start:end] = k
+        self.running_values[:, :, start:end] = v
+        self.running_len = end
+
+        return self.running_keys[:, :, :end], self.running_values[:, :, :end]
 
     def forward(self, queries, keys, values, attention_mask, **kwargs):
-        if self.can_be_stateful and self._is_stateful:
-            self.running_keys = torch.cat([self.running_keys, keys], 1)
-            keys = self.running_keys
-
-            self.running_values = torch.cat([self.running_values, values], 1)
-            values = self.running_values
+        # keys and values projected by the caller come with their own cache (see DecoderStepGraph)
+        if self.can_be_stateful and self._is_stateful and kwargs.get("projected_keys_values") is None:
+            if self.use_kv_cache:
+                kwargs["projected_keys_values"] = self.update_kv_cache(keys, values)
+            else:
+                self.running_keys = torch.cat([self.running_keys, keys], 1)
+                keys = self.running_keys
+
+                self.running_values = torch.cat([self.running_values, values], 1)
+                values = self.running_values
 
         out, _ = self.attention(queries, keys, values, attention_mask, **kwargs)
         
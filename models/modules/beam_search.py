@@ -28,7 +28,8 @@ class BeamSearch(object):
                                 dim=1,
                                 index=beam.expand(*( [self.b_s, self.beam_size] + shape[1:] ))
                             )
-            s = s.view(*( [-1, ] + shape[1:] ))
+            # explicit batch size, states left empty (e.g. those of the stateful decoder when the compiled step runs) have no -1 to infer
+            s = s.view(*( [self.b_s * self.beam_size, ] + shape[1:] ))
             return s
 
         return fn
@@ -58,7 +59,7 @@ class BeamSearch(object):
         selected_beam = torch.div(selected_idx, candidate_logprob.shape[-1], rounding_mode="trunc")
         selected_words = selected_idx - selected_beam * candidate_logprob.shape[-1]
 
-        self.model.apply_to_states(self._expand_state(selected_beam, cur_beam_size))
+        self.model.apply_to_states(self._expand_state(selected_beam, cur_beam_size), include_beam_invariant=False)
 
         self.seq_logprob = selected_logprob.unsqueeze(-1)
         self.seq_mask = torch.gather(self.seq_mask, 1, selected_beam.unsqueeze(-1))
@@ -7,9 +7,16 @@ class Module(nn.Module):
         self._is_stateful = False
         self._state_names = []
         self._state_defaults = dict()
+        self._beam_invariant_states = set()
 
-    def register_state(self, name: str, default: TensorOrNone):
+    def register_state(self, name: str, default: TensorOrNone, beam_invariant: bool=False):
+        '''
+            beam_invariant: the state is identical across the beams of a sample, so it is kept once per sample
+                during beam search and broadcast by its consumers instead of being gathered at every step.
+        '''
         self._state_names.append(name)
+        if beam_invariant:
+            self._beam_invariant_states.add(name)
         if default is None:
             self._state_defaults[name] = None
         else:
@@ -23,12 +30,17 @@ class Module(nn.Module):
             if isinstance(m, Module):
                 yield from m.states()
 
-    def apply_to_states(self, fn):
+    def apply_to_states(self, fn, include_beam_invariant: bool=True):
         for name in self._state_names:
+            if not include_beam_invariant and name in self._beam_invariant_states:
+                continue
+            # states with a None default which have not been set during this decoding
+            if self._buffers[name] is None:
+                continue
             self._buffers[name] = fn(self._buffers[name])
         for m in self.children():
             if isinstance(m, Module):
-                m.apply_to_states(fn)
+                m.apply_to_states(fn, include_beam_invariant)
 
     def _init_states(self, batch_size: int):
         for name in self._state_names:
@@ -3,7 +3,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from models.modules.attentions import MultiHeadAttention
-from models.utils import generate_padding_mask, generate_sequential_mask, generate_self_attention_masks, sinusoid_encoding_table
+from models.utils import run_layer, generate_padding_mask, generate_padding_mask_from_lengths, generate_sequential_mask, generate_self_attention_masks, sinusoid_encoding_table
 from models.modules.positionwise_feed_forward import PositionWiseFeedForward
 from models.modules.containers import Module, ModuleList
 from builders.decoder_builder import META_DECODER
@@ -11,16 +11,33 @@ from builders.text_embedding_builder import build_text_embedding
 from builders.pretrained_language_model_builder import build_pretrained_language_model
 
 class DecoderLayer(Module):
-    def __init__(self, config):
+    def __init__(self, config, max_len: int=None):
         super(DecoderLayer, self).__init__()
 
-        self.self_attn = MultiHeadAttention(config.SELF_ATTENTION)
+        self.self_attn = MultiHeadAttention(config.SELF_ATTENTION, max_len=max_len)
         self.enc_attn = MultiHeadAttention(config.ENC_ATTENTION)
         self.pwff = PositionWiseFeedForward(config.ENC_ATTENTION)
 
+        # projected encoder keys and values, computed once at the first decoding step
+        self.register_state('enc_keys', None, beam_invariant=True)
+        self.register_state('enc_values', None, beam_invariant=True)
+
     def forward(self, queries, keys, values, self_attention_mask, enc_attention_mask, **kwargs):
         self_att = self.self_attn(queries, queries, queries, attention_mask=self_attention_mask, **kwargs)
-        enc_att = self.enc_attn(self_att, keys, values, attention_mask=enc_attention_mask, **kwargs)
+        if self._is_stateful and self.enc_attn.use_kv_cache:
+            if self.enc_keys is None:
+                self.enc_keys, self.enc_values = self.enc_attn.attention.project_keys_values(keys, values)
+            enc_att = self.enc_attn(self_att, keys, values, attention_mask=enc_attention_mask, 
+                                    projected_keys_values=(self.enc_keys, self.enc_values), **kwargs)
+        else:
+            if keys.shape[0] != self_att.shape[0]:
+                # encoder states are kept once per sample during beam search
+                beam_size = self_att.shape[0] // keys.shape[0]
+                keys = keys.repeat_interleave(beam_size, dim=0)
+                values = values.repeat_interleave(beam_size, dim=0)
+                if enc_attention_mask is not None:
+                    enc_attention_mask = enc_attention_mask.repeat_interleave(beam_size, dim=0)
+            enc_att = self.enc_attn(self_att, keys, values, attention_mask=enc_attention_mask, **kwargs)
 
         ff = self.pwff(enc_att)
         
@@ -36,19 +53,36 @@ class Decoder(Module):
         self.max_len = vocab.max_answer_length
         self.padding_idx = vocab.padding_idx
         self.N = config.LAYERS
+        self.gradient_checkpointing = config.GRADIENT_CHECKPOINTING if hasattr(config, "GRADIENT_CHECKPOINTING") else False
 
         self.word_emb = build_text_embedding(config.TEXT_EMBEDDING, vocab)
         self.pos_emb = nn.Embedding.from_pretrained(sinusoid_encoding_table(max_len=self.max_len+1,
                                                                             d_model=config.D_MODEL, padding_idx=0), freeze=True)
-        self.layers = ModuleList([DecoderLayer(config.ATTENTION) for _ in range(config.LAYERS)])
-        self.fc = nn.Linear(config.D_MODEL, len(vocab), bias=False)
+        self.layers = ModuleList([DecoderLayer(config.ATTENTION, max_len=self.max_len) for _ in range(config.LAYERS)])
+
+        # the output projection and the softmax can be restricted to the tokens of the training answers,
+        # the outputs then index the shortlist and are mapped back to vocab ids when decoding
+        self.output_shortlist = config.OUTPUT_SHORTLIST if hasattr(config, "OUTPUT_SHORTLIST") else False
+        if self.output_shortlist:
+            shortlist = torch.tensor(vocab.answer_token_ids(), dtype=torch.long)
+            to_shortlist = torch.full((len(vocab), ), vocab.unk_idx, dtype=torch.long)
+            to_shortlist[shortlist] = torch.arange(len(shortlist))
+            self.register_buffer("shortlist", shortlist, persistent=False)
+            self.register_buffer("to_shortlist", to_shortlist, persistent=False)
+            self.fc = nn.Linear(config.D_MODEL, len(shortlist), bias=False)
+        else:
+            self.fc = nn.Linear(config.D_MODEL, len(vocab), bias=False)
 
         self.register_state('running_mask_self_attention', torch.zeros((1, 1, 0)).bool())
         self.register_state('running_seq', torch.zeros((1,)).long())
 
-    def forward(self, answer_tokens: torch.Tensor, encoder_features: torch.Tensor, encoder_attention_mask: torch.Tensor):
+    def forward(self, answer_tokens: torch.Tensor, encoder_features: torch.Tensor, encoder_attention_mask: torch.Tensor, 
+                answer_lengths: torch.Tensor=None):
         b_s, seq_len = answer_tokens.shape
-        answer_padding_masks = generate_padding_mask(answer_tokens, self.padding_idx).to(answer_tokens.device)
+        if answer_lengths is None:
+            answer_padding_masks = generate_padding_mask(answer_tokens, self.padding_idx).to(answer_tokens.device)
+        else:
+            answer_padding_masks = generate_padding_mask_from_lengths(answer_lengths, seq_len)
         answer_self_attention_masks = generate_sequential_mask(seq_len).to(answer_tokens.device)
         answer_self_attention_masks = generate_self_attention_masks(answer_padding_masks, answer_self_attention_masks)
         
@@ -65,7 +99,7 @@ class Decoder(Module):
         embedded_answers, _ = self.word_emb(answer_tokens)
         out = embedded_answers + self.pos_emb(seq)
         for layer in self.layers:
-            out = layer(queries=out, 
+            out = run_layer(layer, self.gradient_checkpointing, queries=out, 
                         keys=encoder_features,
                         values=encoder_features,
                         self_attention_mask=answer_self_attention_masks,
@@ -73,7 +107,64 @@ class Decoder(Module):
 
         out = self.fc(out)
     
-        return F.log_softmax(out, dim=-1)
+        return F.log_softmax(out.float(), dim=-1)
+
+    def to_output_ids(self, tokens: torch.Tensor) -> torch.Tensor:
+        '''
+            Maps vocab ids to the indices of the output distribution.
+        '''
+        if not self.output_shortlist:
+            return tokens
+
+        return self.to_shortlist[tokens]
+
+    def from_output_ids(self, ids: torch.Tensor) -> torch.Tensor:
+        '''
+            Maps indices of the output distribution back to vocab ids.
+        '''
+        if not self.output_shortlist:
+            return ids
+
+        return self.shortlist[ids]
+
+class DecoderStepGraph(nn.Module):
+    '''
+        A single step of the stateful Decoder with its caches made explicit, so that it is a pure function
+        of its inputs. It is the decoder step exported to ONNX and compiled by BaseTransformer.
+        tokens: (b_s, 1), step: (1, ) the position of tokens in the answer
+        enc_keys, enc_values: (n_layers, b_s, h, n_enc, d), encoder_padding_mask: (b_s, 1, 1, n_enc)
+        past_keys, past_values: (n_layers, b_s, h, t, d), past_mask: (b_s, 1, 1, t)
+        return: the log-probabilities of the next token (b_s, vocab_len) and the caches extended by one position.
+        With an output shortlist, tokens and log_probs index the shortlist (see Decoder.from_output_ids).
+    '''
+    def __init__(self, decoder: Decoder):
+        super(DecoderStepGraph, self).__init__()
+
+        self.decoder = decoder
+
+    def forward(self, tokens, step, enc_keys, enc_values, encoder_padding_mask, past_keys, past_values, past_mask):
+        b_s = tokens.shape[0]
+        mask = torch.cat([past_mask, (tokens == self.decoder.padding_idx).view(b_s, 1, 1, 1)], dim=-1)
+        seq = (step + 1).view(1, 1).expand(b_s, 1)
+
+        out = self.decoder.word_emb(self.decoder.from_output_ids(tokens))[0] + self.decoder.pos_emb(seq)
+        present_keys = []
+        present_values = []
+        for ith, layer in enumerate(self.decoder.layers):
+            k, v = layer.self_attn.attention.project_keys_values(out, out)
+            k = torch.cat([past_keys[ith], k], dim=2)
+            v = torch.cat([past_values[ith], v], dim=2)
+            present_keys.append(k)
+            present_values.append(v)
+
+            self_att = layer.self_attn(out, out, out, attention_mask=mask, projected_keys_values=(k, v))
+            enc_att = layer.enc_attn(self_att, None, None, attention_mask=encoder_padding_mask,
+                                        projected_keys_values=(enc_keys[ith], enc_values[ith]))
+            out = layer.pwff(enc_att)
+
+        out = F.log_softmax(self.decoder.fc(out).float(), dim=-1)
+
+        return out[:, -1], torch.stack(present_keys), torch.stack(present_values), mask
 
 @META_DECODER.register()
 class AdaptiveDecoder(Module):
@@ -84,23 +175,28 @@ class AdaptiveDecoder(Module):
         self.max_len = vocab.max_answer_length
         self.padding_idx = vocab.padding_idx
         self.N = config.LAYERS
+        self.gradient_checkpointing = config.GRADIENT_CHECKPOINTING if hasattr(config, "GRADIENT_CHECKPOINTING") else False
 
         self.word_emb = build_text_embedding(config.TEXT_EMBEDDING)
         self.pos_emb = nn.Embedding.from_pretrained(sinusoid_encoding_table(max_len=self.max_len+1,
                                                                             d_model=config.D_MODEL, padding_idx=0), freeze=True)
-        self.layers = ModuleList([DecoderLayer(config.ATTENTION) if i < config.LAYERS else DecoderLayer(config.ADAPTIVE_ATTENTION) 
-                                                for i in range(config.LAYERS + 1)])
+        self.layers = ModuleList([DecoderLayer(config.ATTENTION, max_len=self.max_len) if i < config.LAYERS 
+                                    else DecoderLayer(config.ADAPTIVE_ATTENTION, max_len=self.max_len) for i in range(config.LAYERS + 1)])
         self.fc = nn.Linear(config.D_MODEL, len(vocab), bias=False)
 
         # load and froze the language model
         self.language_model = build_pretrained_language_model(config.LANGUAGE_MODEL)
 
-        self.register_state('running_mask_self_attention', torch.zeros((1, 1, 0)).byte())
+        self.register_state('running_mask_self_attention', torch.zeros((1, 1, 0)).bool())
         self.register_state('running_seq', torch.zeros((1,)).long())
 
-    def forward(self, answer_tokens: torch.Tensor, encoder_features: torch.Tensor, encoder_attention_mask: torch.Tensor):
+    def forward(self, answer_tokens: torch.Tensor, encoder_features: torch.Tensor, encoder_attention_mask: torch.Tensor, 
+                answer_lengths: torch.Tensor=None):
         b_s, seq_len = answer_tokens.shape
-        answer_padding_masks = generate_padding_mask(answer_tokens, self.padding_idx).to(answer_tokens.device)
+        if answer_lengths is None:
+            answer_padding_masks = generate_padding_mask(answer_tokens, self.padding_idx).to(answer_tokens.device)
+        else:
+            answer_padding_masks = generate_padding_mask_from_lengths(answer_lengths, seq_len)
         answer_self_attention_masks = generate_sequential_mask(seq_len).to(answer_tokens.device)
         answer_self_attention_masks = generate_self_attention_masks(answer_padding_masks, answer_self_attention_masks)
         
@@ -120,7 +216,7 @@ class AdaptiveDecoder(Module):
         embedded_answers, _ = self.word_emb(answer_tokens)
         out = embedded_answers + self.pos_emb(seq)
         for layer in self.layers:
-            out = layer(queries=out, 
+            out = run_layer(layer, self.gradient_checkpointing, queries=out, 
                         keys=encoder_features,
                         values=encoder_features,
                         language_signals=language_signals,
@@ -129,4 +225,4 @@ class AdaptiveDecoder(Module):
 
         out = self.fc(out)
 
-        return F.log_softmax(out, dim=-1)
+        return F.log_softmax(out.float(), dim=-1)
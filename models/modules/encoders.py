@@ -4,6 +4,7 @@ from torch import nn
 from models.modules.positionwise_feed_forward import PositionWiseFeedForward
 from models.modules.attentions import MultiHeadAttention
 from models.modules.pos_embeddings import SinusoidPositionalEmbedding
+from models.utils import box_relational_embedding, run_layer
 from builders.encoder_builder import META_ENCODER
 
 class EncoderLayer(nn.Module):
@@ -107,30 +108,41 @@ class Encoder(nn.Module):
         self.layer_norm = nn.LayerNorm(config.D_MODEL)
 
         self.d_model = config.D_MODEL
+        self.gradient_checkpointing = config.GRADIENT_CHECKPOINTING if hasattr(config, "GRADIENT_CHECKPOINTING") else False
         self.layers = nn.ModuleList([EncoderLayer(config.SELF_ATTENTION) for _ in range(config.LAYERS)])
 
     def forward(self, features: torch.Tensor, padding_mask: torch.Tensor):
         out = self.layer_norm(features) + self.pos_embedding(features)
         for layer in self.layers:
-            out = layer(queries=out, keys=out, values=out, attention_mask=padding_mask)
+            out = run_layer(layer, self.gradient_checkpointing, queries=out, keys=out, values=out, attention_mask=padding_mask)
 
         return out
 
 @META_ENCODER.register()
 class GeometricEncoder(nn.Module):
     def __init__(self, config):
-        super(Encoder, self).__init__()
+        super(GeometricEncoder, self).__init__()
         
         self.pos_embedding = SinusoidPositionalEmbedding(config.D_MODEL)
         self.layer_norm = nn.LayerNorm(config.D_MODEL)
 
         self.d_model = config.D_MODEL
+        self.gradient_checkpointing = config.GRADIENT_CHECKPOINTING if hasattr(config, "GRADIENT_CHECKPOINTING") else False
         self.layers = nn.ModuleList([EncoderLayer(config.SELF_ATTENTION) for _ in range(config.LAYERS)])
 
     def forward(self, features: torch.Tensor, boxes: torch.Tensor, padding_mask: torch.Tensor):    
+        # the geometry embedding only depends on the boxes, so it is computed once and shared by all the layers,
+        # unless the attention computes it in chunks to save memory
+        attention = self.layers[0].mhatt.attention
+        relative_geometry_embeddings = None
+        if attention.chunk_size is None:
+            relative_geometry_embeddings = box_relational_embedding(boxes, dim_g=attention.d_g, 
+                                                                    trignometric_embedding=attention.trignometric_embedding)
+
         out = self.layer_norm(features) + self.pos_embedding(features)
         for layer in self.layers:
-            out = layer(queries=out, keys=out, values=out, boxes=boxes, attention_mask=padding_mask)
+            out = run_layer(layer, self.gradient_checkpointing, queries=out, keys=out, values=out, boxes=boxes, 
+                            attention_mask=padding_mask, relative_geometry_embeddings=relative_geometry_embeddings)
 
         return out
 
@@ -146,6 +158,7 @@ class GuidedAttentionEncoder(nn.Module):
         self.layer_norm = nn.LayerNorm(config.D_MODEL)
 
         self.d_model = config.D_MODEL
+        self.gradient_checkpointing = config.GRADIENT_CHECKPOINTING if hasattr(config, "GRADIENT_CHECKPOINTING") else False
 
         self.guided_attn_layers = nn.ModuleList([GuidedEncoderLayer(config.GUIDED_ATTENTION) for _ in range(config.LAYERS)])
 
@@ -153,7 +166,7 @@ class GuidedAttentionEncoder(nn.Module):
                 language_features: torch.Tensor, language_padding_mask: torch.Tensor):
         out = self.layer_norm(vision_features) + self.pos_embedding(vision_features)
         for guided_attn_layer in self.guided_attn_layers:
-            out = guided_attn_layer(
+            out = run_layer(guided_attn_layer, self.gradient_checkpointing,
                 queries=out,
                 keys=language_features,
                 values=language_features,
@@ -176,6 +189,7 @@ class CoAttentionEncoder(nn.Module):
         self.language_layer_norm = nn.LayerNorm(config.D_MODEL)
 
         self.d_model = config.D_MODEL
+        self.gradient_checkpointing = config.GRADIENT_CHECKPOINTING if hasattr(config, "GRADIENT_CHECKPOINTING") else False
 
         # cross-attention layers
         self.vision_language_attn_layers = nn.ModuleList([EncoderLayer(config.VISION_LANGUAGE_ATTENTION) for _ in range(config.LAYERS)])
@@ -195,26 +209,26 @@ class CoAttentionEncoder(nn.Module):
                             self.language_self_attn_layers):
             vision_language_attn_layer, language_vision_attn_layer, vision_self_attn_layer, language_self_attn_layer = layers
             # performing cross-attention
-            vision_features = vision_language_attn_layer(
+            vision_features = run_layer(vision_language_attn_layer, self.gradient_checkpointing,
                 queries=vision_features,
                 keys=language_features,
                 values=language_features,
                 attention_mask=language_padding_mask
             )
-            language_features = language_vision_attn_layer(
+            language_features = run_layer(language_vision_attn_layer, self.gradient_checkpointing,
                 queries=language_features,
                 keys=vision_features,
                 values=vision_features,
                 attention_mask=vision_padding_mask
             )
             # performing self-attention
-            vision_features = vision_self_attn_layer(
+            vision_features = run_layer(vision_self_attn_layer, self.gradient_checkpointing,
                 queries=vision_features,
                 keys=vision_features,
                 values=vision_features,
                 attention_mask=vision_padding_mask
             )
-            language_features = language_self_attn_layer(
+            language_features = run_layer(language_self_attn_layer, self.gradient_checkpointing,
                 queries=language_features,
                 keys=language_features,
                 values=language_features,
@@ -236,6 +250,7 @@ class CrossModalityEncoder(nn.Module):
         self.language_layer_norm = nn.LayerNorm(config.D_MODEL)
 
         self.d_model = config.D_MODEL
+        self.gradient_checkpointing = config.GRADIENT_CHECKPOINTING if hasattr(config, "GRADIENT_CHECKPOINTING") else False
         self.layers = nn.ModuleList([CrossModalityEncoderLayer(config) for _ in range(config.LAYERS)])
 
     def forward(self, vision_features: torch.Tensor, vision_padding_mask: torch.Tensor, 
@@ -243,7 +258,7 @@ class CrossModalityEncoder(nn.Module):
         vision_features = self.vision_layer_norm(vision_features) + self.pos_embedding(vision_features)
         language_features = self.language_layer_norm(language_features) + self.pos_embedding(language_features)
         for layer in self.layers:
-            vision_features, language_features = layer(
+            vision_features, language_features = run_layer(layer, self.gradient_checkpointing,
                 vision_features=vision_features,
                 vision_padding_mask=vision_padding_mask,
                 language_features=language_features,
@@ -0,0 +1,41 @@
+import torch
+from data_utils.types import *
+
+class GreedySearch(object):
+    '''
+        Greedy decoding used in place of BeamSearch when beam_size is 1.
+        There is no beam to keep track of, so states are never re-gathered and the
+        selected tokens are written directly into a preallocated output tensor.
+    '''
+    def __init__(self, model, b_s: int, max_len: int, eos_idx: int, padding_idx: int, device):
+        self.model = model
+        self.max_len = max_len
+        self.eos_idx = eos_idx
+        self.padding_idx = padding_idx
+        self.b_s = b_s
+        self.device = device
+
+    def apply(self, **kwargs):
+        # finished sequences are filled with <pad> and zero log-probability, the same as BeamSearch yields
+        outputs = torch.full((self.b_s, self.max_len), self.padding_idx, dtype=torch.long, device=self.device)
+        log_probs = torch.zeros((self.b_s, self.max_len), device=self.device)
+        unfinished = torch.ones((self.b_s, ), dtype=torch.bool, device=self.device)
+
+        selected_words = None
+        for t in range(self.max_len):
+            word_logprob = self.model.step(t, selected_words, **kwargs)
+            word_logprob = word_logprob[:, -1] # (b_s, vocab_len)
+            this_word_logprob, words = word_logprob.max(dim=-1)
+
+            words = words.masked_fill(~unfinished, self.padding_idx)
+            this_word_logprob = this_word_logprob.masked_fill(~unfinished, 0)
+            outputs[:, t] = words
+            log_probs[:, t] = this_word_logprob
+
+            unfinished = unfinished & (words != self.eos_idx)
+            if not unfinished.any():
+                break
+
+            selected_words = words.unsqueeze(-1)
+
+        return outputs, log_probs
@@ -58,7 +58,7 @@ class SinusoidPositionalEmbedding(nn.Module):
     def forward(self, x, mask=None):
         if mask is None:
             mask = torch.zeros(x.shape[:-1], dtype=torch.bool, device=x.device)
-        not_mask = (mask == False)
+        not_mask = mask.logical_not()
         embed = not_mask.cumsum(1, dtype=torch.float32)
         if self.normalize:
             eps = 1e-6
@@ -4,7 +4,7 @@ from torch.nn import functional as F
 
 from builders.text_embedding_builder import META_TEXT_EMBEDDING
 from builders.word_embedding_builder import build_word_embedding
-from models.utils import generate_sequential_mask, generate_padding_mask
+from models.utils import generate_sequential_mask, generate_padding_mask, generate_padding_mask_from_lengths, accumulate_ngram_features
 
 from transformers.models.bert.modeling_bert import (
     BertConfig,
@@ -75,10 +75,13 @@ class UsualEmbedding(nn.Module):
                 nn.Dropout(config.DROPOUT)
             )
 
-    def forward(self, tokens):
-        padding_masks = generate_padding_mask(tokens, padding_idx=self.padding_idx).to(tokens.device)
-
+    def forward(self, tokens, lengths=None):
         seq_len = tokens.shape[-1]
+        if lengths is None:
+            padding_masks = generate_padding_mask(tokens, padding_idx=self.padding_idx).to(tokens.device)
+        else:
+            padding_masks = generate_padding_mask_from_lengths(lengths, seq_len)
+
         sequential_masks = generate_sequential_mask(seq_len).to(tokens.device)
 
         features = self.components(tokens)
@@ -239,9 +242,12 @@ class LSTMTextEmbedding(nn.Module):
 
         self.lstm = nn.LSTM(input_size=config.D_MODEL, hidden_size=config.D_MODEL, batch_first=True)
 
-    def forward(self, tokens):
-        padding_masks = generate_padding_mask(tokens, padding_idx=self.padding_idx).to(tokens.device)
+    def forward(self, tokens, lengths=None):
         seq_len = tokens.shape[-1]
+        if lengths is None:
+            padding_masks = generate_padding_mask(tokens, padding_idx=self.padding_idx).to(tokens.device)
+        else:
+            padding_masks = generate_padding_mask_from_lengths(lengths, seq_len)
         sequential_masks = generate_sequential_mask(seq_len).to(tokens.device)
 
         features = self.proj(self.embedding(tokens)) # (bs, seq_len, d_model)
@@ -267,22 +273,15 @@ class HierarchicalFeaturesExtractor(nn.Module):
 
         self.reduce_features = nn.Linear(config.D_MODEL, config.D_MODEL)
 
-    def forward(self, tokens: torch.Tensor):
-        features, (padding_masks, sequential_masks) = self.embedding(tokens)
+    def forward(self, tokens: torch.Tensor, lengths=None):
+        features, (padding_masks, sequential_masks) = self.embedding(tokens, lengths)
 
         ngrams_features = []
         for conv in self.convs:
             ngrams_features.append(conv(features.permute((0, -1, 1))).permute((0, -1, 1)))
         
-        features_len = features.shape[-1]
-        unigram_features = ngrams_features[0]
-        # for each token in the unigram
-        for ith in range(features_len):
-            # for each n-gram, we ignore the unigram
-            for ngram in range(1, max(self.ngrams)):
-                # summing all possible n-gram tokens into the unigram
-                for prev_ith in range(max(0, ith-ngram+1), min(ith+1, ngrams_features[ngram].shape[1])):
-                    unigram_features[:, ith] += ngrams_features[ngram][:, prev_ith]
+        # summing all n-gram features covering each token into the unigram
+        unigram_features = accumulate_ngram_features(ngrams_features, self.ngrams)
 
         return unigram_features, (padding_masks, sequential_masks)
 
@@ -300,7 +299,7 @@ class TextBert(BertPreTrainedModel):
         # txt_inds = torch.clamp(txt_inds, min=0, max=30521)  # Giới hạn trong phạm vi hợp lệ
         encoder_inputs = self.embeddings(txt_inds)
         
-        attention_mask = txt_mask
+        attention_mask = txt_mask.float() * -10e4 # the encoders of transformers expect additive masks
         head_mask = [None] * self.config.num_hidden_layers
         encoder_outputs = self.encoder(
             encoder_inputs, attention_mask, head_mask=head_mask
@@ -360,7 +359,7 @@ class TextAlbert(AlbertPreTrainedModel):
         embedded_inputs = self.embeddings(txt_inds)
         encoder_inputs = self.embedding_hidden_mapping_in(embedded_inputs)
         
-        attention_mask = txt_mask
+        attention_mask = txt_mask.float() * -10e4 # the encoders of transformers expect additive masks
         head_mask = [None] * self.config.num_hidden_layers
         encoder_outputs = self.encoder(
             encoder_inputs, attention_mask, head_mask=head_mask
@@ -418,7 +417,7 @@ class TextRoberta(RobertaPreTrainedModel):
     def forward(self, txt_inds, txt_mask):
         encoder_inputs = self.embeddings(txt_inds)
         
-        attention_mask = txt_mask
+        attention_mask = txt_mask.float() * -10e4 # the encoders of transformers expect additive masks
         head_mask = [None] * self.config.num_hidden_layers
         encoder_outputs = self.encoder(
             encoder_inputs, attention_mask, head_mask=head_mask
@@ -476,7 +475,7 @@ class TextDeberta_v2(DebertaV2PreTrainedModel):
     def forward(self, txt_inds, txt_mask):
         encoder_inputs = self.embeddings(txt_inds)
         
-        attention_mask = txt_mask
+        attention_mask = txt_mask.float() * -10e4 # the encoders of transformers expect additive masks
         head_mask = [None] * self.config.num_hidden_layers
         encoder_outputs = self.encoder(
             encoder_inputs, attention_mask, head_mask=head_mask
@@ -534,7 +533,7 @@ class TextXLM(XLMRobertaPreTrainedModel):
     def forward(self, txt_inds, txt_mask):
         encoder_inputs = self.embeddings(txt_inds)
         
-        attention_mask = txt_mask
+        attention_mask = txt_mask.float() * -10e4 # the encoders of transformers expect additive masks
         head_mask = [None] * self.config.num_hidden_layers
         encoder_outputs = self.encoder(
             encoder_inputs, attention_mask, head_mask=head_mask
@@ -609,9 +608,8 @@ class T5Embedding(nn.Module):
         # self.tokenizer.pad_token_id.shape = 1
         padding_mask = generate_padding_mask(inputs, padding_idx=self.tokenizer.pad_token_id)
        # Lấy embedding từ T5
-        print(inputs.shape)
-        print(padding_mask.shape)
-        features = self.embedding(input_ids=inputs, attention_mask=padding_mask).last_hidden_state
+        # T5EncoderModel builds the additive mask itself, it takes a (bs, seq_len) mask with 1 for the tokens to attend
+        features = self.embedding(input_ids=inputs, attention_mask=(~padding_mask).view(inputs.shape).long()).last_hidden_state
         # Chiếu về D_MODEL và apply activation
         out = self.proj(features)
         out = self.dropout(self.gelu(out))
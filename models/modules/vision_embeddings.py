@@ -5,7 +5,7 @@ from PIL import Image
 from typing import List
 
 from builders.vision_embedding_builder import META_VISION_EMBEDDING
-from models.utils import generate_padding_mask
+from models.utils import generate_padding_mask, generate_padding_mask_from_lengths
 
 @META_VISION_EMBEDDING.register()
 class FeatureEmbedding(nn.Module):
@@ -16,8 +16,11 @@ class FeatureEmbedding(nn.Module):
         self.gelu = nn.GELU()
         self.dropout = nn.Dropout(config.DROPOUT)
 
-    def forward(self, features):
-        masks = generate_padding_mask(features, padding_idx=0).to(features.device)
+    def forward(self, features, lengths=None):
+        if lengths is None:
+            masks = generate_padding_mask(features, padding_idx=0).to(features.device)
+        else:
+            masks = generate_padding_mask_from_lengths(lengths, features.shape[1])
 
         features = self.gelu(self.proj(features))
         features = self.dropout(features)
@@ -0,0 +1,111 @@
+import torch
+from torch import nn
+
+import os
+import json
+
+from models.base_transformer import BaseTransformer
+from models.modules.decoders import Decoder, DecoderStepGraph
+from models.modules.attentions import ScaledDotProductAttention
+from utils.instance import InstanceList
+
+ENCODER_INPUTS = ("region_features", "region_lengths", "question_tokens", "question_lengths")
+
+class EncoderGraph(nn.Module):
+    '''
+        encoder_forward followed by the projection of the encoder features into the keys and values of
+        the cross attention of every decoder layer, so they are computed once per sample.
+    '''
+    def __init__(self, model: BaseTransformer, input_names):
+        super(EncoderGraph, self).__init__()
+
+        self.model = model
+        self.input_names = list(input_names)
+
+    def forward(self, *inputs):
+        input_features = InstanceList()
+        for name, value in zip(self.input_names, inputs):
+            input_features.set(name, value)
+
+        encoder_features, encoder_padding_mask = self.model.encoder_forward(input_features)
+        enc_keys, enc_values = zip(*[layer.enc_attn.attention.project_keys_values(encoder_features, encoder_features)
+                                        for layer in self.model.decoder.layers])
+
+        return torch.stack(enc_keys), torch.stack(enc_values), encoder_padding_mask
+
+def check_exportable(model: BaseTransformer):
+    if not isinstance(model, BaseTransformer) or not isinstance(model.decoder, Decoder):
+        raise ValueError("ONNX export supports BaseTransformer models using the Decoder")
+    for layer in model.decoder.layers:
+        for attention in (layer.self_attn.attention, layer.enc_attn.attention):
+            if not isinstance(attention, ScaledDotProductAttention):
+                raise ValueError(f"ONNX export supports ScaledDotProductAttention only, got {type(attention).__name__}")
+
+def export_onnx(model: BaseTransformer, input_features: InstanceList, output_dir: str, opset_version: int=17):
+    '''
+        Writes encoder.onnx, decoder_step.onnx and the metadata the predictor needs (predictor.json)
+        into output_dir. input_features is a sample batch used for tracing.
+    '''
+    check_exportable(model)
+    model.eval()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    input_names = [name for name in ENCODER_INPUTS if input_features.has(name)]
+    inputs = tuple(input_features.get(name) for name in input_names)
+    encoder = EncoderGraph(model, input_names)
+    with torch.no_grad():
+        enc_keys, enc_values, encoder_padding_mask = encoder(*inputs)
+
+    dynamic_axes = {name: ({0: "batch", 1: name.split("_")[0] + "_len"} if input_features.get(name).dim() > 1 else {0: "batch"})
+                        for name in input_names}
+    dynamic_axes.update({
+        "enc_keys": {1: "batch", 3: "enc_len"},
+        "enc_values": {1: "batch", 3: "enc_len"},
+        "encoder_padding_mask": {0: "batch", 3: "enc_len"}
+    })
+    torch.onnx.export(encoder, inputs, os.path.join(output_dir, "encoder.onnx"),
+                        input_names=input_names, output_names=["enc_keys", "enc_values", "encoder_padding_mask"],
+                        dynamic_axes=dynamic_axes, opset_version=opset_version, dynamo=False)
+
+    # traced with a cache of one position, the length of the caches is a dynamic axis of the graph
+    b_s = enc_keys.shape[1]
+    attention = model.decoder.layers[0].self_attn.attention
+    n_layers = len(model.decoder.layers)
+    tokens = torch.full((b_s, 1), model.vocab.bos_idx, dtype=torch.long, device=enc_keys.device)
+    step = torch.ones((1, ), dtype=torch.long, device=enc_keys.device)
+    past_keys = torch.zeros((n_layers, b_s, attention.h, 1, attention.d_k), device=enc_keys.device)
+    past_values = torch.zeros((n_layers, b_s, attention.h, 1, attention.d_v), device=enc_keys.device)
+    past_mask = torch.zeros((b_s, 1, 1, 1), dtype=torch.bool, device=enc_keys.device)
+    torch.onnx.export(DecoderStepGraph(model.decoder),
+                        (tokens, step, enc_keys, enc_values, encoder_padding_mask, past_keys, past_values, past_mask),
+                        os.path.join(output_dir, "decoder_step.onnx"),
+                        input_names=["tokens", "step", "enc_keys", "enc_values", "encoder_padding_mask",
+                                        "past_keys", "past_values", "past_mask"],
+                        output_names=["log_probs", "present_keys", "present_values", "present_mask"],
+                        dynamic_axes={
+                            "tokens": {0: "batch"},
+                            "enc_keys": {1: "batch", 3: "enc_len"},
+                            "enc_values": {1: "batch", 3: "enc_len"},
+                            "encoder_padding_mask": {0: "batch", 3: "enc_len"},
+                            "past_keys": {1: "batch", 3: "past_len"},
+                            "past_values": {1: "batch", 3: "past_len"},
+                            "past_mask": {0: "batch", 3: "past_len"},
+                            "log_probs": {0: "batch"},
+                            "present_keys": {1: "batch", 3: "present_len"},
+                            "present_values": {1: "batch", 3: "present_len"},
+                            "present_mask": {0: "batch", 3: "present_len"}
+                        }, opset_version=opset_version, dynamo=False)
+
+    json.dump({
+        "encoder_inputs": input_names,
+        "n_layers": n_layers,
+        "head": attention.h,
+        "d_key": attention.d_k,
+        "d_value": attention.d_v,
+        "max_len": model.max_len,
+        "bos_idx": model.vocab.bos_idx,
+        "eos_idx": model.vocab.eos_idx,
+        "padding_idx": model.vocab.padding_idx,
+        "output_ids": model.decoder.shortlist.tolist() if model.decoder.output_shortlist else None
+    }, open(os.path.join(output_dir, "predictor.json"), "w+"))
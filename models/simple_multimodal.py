@@ -32,7 +32,8 @@ class SimpleMultimodal(BaseClassificationModel):
 
     def forward(self, input_features: Instance):
         vision_features = input_features.region_features
-        vision_features, vision_padding_mask = self.vision_embedding(vision_features)
+        region_lengths = input_features.region_lengths if input_features.has("region_lengths") else None
+        vision_features, vision_padding_mask = self.vision_embedding(vision_features, region_lengths)
         
         # Pooling vision features: (batch, num_obj, dim) -> (batch, dim)
         # Handle masking for correct mean
@@ -45,7 +46,8 @@ class SimpleMultimodal(BaseClassificationModel):
         vision_features = vision_features.mean(dim=1)
 
         question_tokens = input_features.question_tokens
-        text_features, (text_padding_mask, _) = self.text_embedding(question_tokens)
+        question_lengths = input_features.question_lengths if input_features.has("question_lengths") else None
+        text_features, (text_padding_mask, _) = self.text_embedding(question_tokens, question_lengths)
         
         # Pooling text features: (batch, seq_len, dim) -> (batch, dim)
         text_features = text_features.mean(dim=1)
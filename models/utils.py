@@ -1,7 +1,9 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from data_utils.types import *
+from typing import List
 import copy
 
 def get_batch_size(x: TensorOrSequence) -> int:
@@ -37,6 +39,16 @@ def sinusoid_encoding_table(max_len, d_model, padding_idx=None) -> torch.Tensor:
         out[padding_idx] = 0
     return out
 
+def run_layer(layer: nn.Module, gradient_checkpointing: bool, **kwargs):
+    '''
+        Runs the layer. With gradient checkpointing its activations are not kept for backward
+        but recomputed from its inputs, trading compute for memory. It only applies when gradients are computed.
+    '''
+    if gradient_checkpointing and layer.training and torch.is_grad_enabled():
+        return checkpoint(layer, use_reentrant=False, **kwargs)
+
+    return layer(**kwargs)
+
 def clones(module, n):
     "Produce N identical layers."
     return nn.ModuleList([copy.deepcopy(module) for _ in range(n)])
@@ -49,26 +61,65 @@ def generate_padding_mask(sequences: TensorOrNone, padding_idx: int) -> torch.Bo
         return None
 
     if len(sequences.shape) == 2: # (bs, seq_len)
-        __seq = sequences.unsqueeze(dim=-1) # (bs, seq_len, 1)
+        mask = (sequences == padding_idx) # (b_s, seq_len), True indicates masking
     else:
-        __seq = sequences
-
-    mask = (torch.sum(__seq, dim=-1) == (padding_idx*__seq.shape[-1])).long() * -10e4 # (b_s, seq_len)
+        mask = (torch.sum(sequences, dim=-1) == (padding_idx*sequences.shape[-1])) # (b_s, seq_len)
     return mask.unsqueeze(1).unsqueeze(1) # (bs, 1, 1, seq_len)
 
+_positions = {}
+
+def get_positions(max_len: int, device) -> torch.Tensor:
+    '''
+        Returns arange(max_len) on the given device. The tensor is cached and sliced for every later request.
+    '''
+    positions = _positions.get(device)
+    if positions is None or positions.shape[0] < max_len:
+        positions = torch.arange(max(max_len, 64), device=device)
+        _positions[device] = positions
+
+    return positions[:max_len]
+
+def generate_padding_mask_from_lengths(lengths: torch.Tensor, max_len: int) -> torch.BoolTensor:
+    '''
+        lengths: (bs, ), the true lengths of the padded sequences
+    '''
+    mask = get_positions(max_len, lengths.device).unsqueeze(0) >= lengths.unsqueeze(-1) # (bs, max_len), True indicates masking
+    return mask.unsqueeze(1).unsqueeze(1) # (bs, 1, 1, max_len)
+
+def accumulate_ngram_features(ngrams_features: List[torch.Tensor], ngrams: List[int]) -> torch.Tensor:
+    '''
+        ngrams_features: the outputs of the n-gram convolutions (bs, seq_len - n + 1, d_model), one per n in ngrams,
+            the first one being the features the others are accumulated into.
+        Every position receives the features of all the n-gram windows covering it, for each n-gram size after 
+        the first one. The sums are done at once with a banded (len, total n-gram len) matrix.
+    '''
+    unigram_features = ngrams_features[0]
+    if len(ngrams_features) == 1:
+        return unigram_features
+
+    device = unigram_features.device
+    positions = get_positions(unigram_features.shape[1], device).unsqueeze(-1) # (len, 1)
+    bands = []
+    for ngram, features in zip(ngrams[1:], ngrams_features[1:]):
+        starts = get_positions(features.shape[1], device).unsqueeze(0) # (1, n-gram len)
+        bands.append((positions >= starts) & (positions < starts + ngram))
+    bands = torch.cat(bands, dim=-1).to(unigram_features.dtype) # (len, total n-gram len)
+
+    return unigram_features + torch.matmul(bands, torch.cat(ngrams_features[1:], dim=1))
+
 def generate_sequential_mask(seq_len: int) -> torch.BoolTensor:
     '''
         Mask out subsequent positions
     '''
     attn_shape = (seq_len, seq_len)
-    subsequent_mask = torch.triu(torch.ones(attn_shape), diagonal=1) * -10e4 # (seq_len, seq_len)
+    subsequent_mask = torch.triu(torch.ones(attn_shape, dtype=torch.bool), diagonal=1) # (seq_len, seq_len)
 
     return subsequent_mask.unsqueeze(0).unsqueeze(0) # (1, 1, seq_len, seq_len)
 
-def generate_self_attention_masks(padding_masks: torch.Tensor, sequential_masks: torch.Tensor):
+def generate_self_attention_masks(padding_masks: torch.Tensor, sequential_masks: torch.Tensor) -> torch.BoolTensor:
     padding_masks = padding_masks != 0
     sequential_masks = sequential_masks != 0
-    self_attention_masks = torch.logical_or(padding_masks, sequential_masks).long() * -10e4
+    self_attention_masks = torch.logical_or(padding_masks, sequential_masks)
     
     return self_attention_masks
 
@@ -99,7 +150,7 @@ def get_grids_position(grid_size):
 
     return boxes
 
-def box_relational_embedding(f_g, dim_g=64, wave_len=1000, trignometric_embedding=True):
+def box_relational_embedding(f_g, dim_g=64, wave_len=1000, trignometric_embedding=True, query_boxes=None):
     """
     Given a tensor with bbox coordinates for detected objects on each batch image,
     this function computes a matrix for each image
@@ -108,6 +159,8 @@ def box_relational_embedding(f_g, dim_g=64, wave_len=1000, trignometric_embeddin
     displacement between the coordinates of bbox_i, and bbox_j
 
     input: np.array of shape=(batch_size, max_nr_bounding_boxes, 4)
+    query_boxes: optional subset of the boxes (batch_size, n_rows, 4) giving the rows i of the matrix,
+        so that the embedding can be computed in chunks of rows
     output: np.array of shape=(batch_size, max_nr_bounding_boxes, max_nr_bounding_boxes, 64)
     """
     # returns a relational embedding for each pair of bboxes, with dimension = dim_g
@@ -122,17 +175,26 @@ def box_relational_embedding(f_g, dim_g=64, wave_len=1000, trignometric_embeddin
     w = (x_max - x_min) + 1.
     h = (y_max - y_min) + 1.
 
-    # cx.view(1, -1) transposes the vector cx, and so dim(delta_x) = (dim(cx), dim(cx))
-    delta_x = cx - cx.view(batch_size, 1, -1)
-    delta_x = torch.clamp(torch.abs(delta_x / w), min=1e-3)
+    if query_boxes is None:
+        cx_q, cy_q, w_q, h_q = cx, cy, w, h
+    else:
+        x_min_q, y_min_q, x_max_q, y_max_q = torch.chunk(query_boxes, chunks=4, dim=-1)
+        cx_q = (x_min_q + x_max_q) * 0.5
+        cy_q = (y_min_q + y_max_q) * 0.5
+        w_q = (x_max_q - x_min_q) + 1.
+        h_q = (y_max_q - y_min_q) + 1.
+
+    # cx.view(1, -1) transposes the vector cx, and so dim(delta_x) = (dim(cx_q), dim(cx))
+    delta_x = cx_q - cx.view(batch_size, 1, -1)
+    delta_x = torch.clamp(torch.abs(delta_x / w_q), min=1e-3)
     delta_x = torch.log(delta_x)
 
-    delta_y = cy - cy.view(batch_size, 1, -1)
-    delta_y = torch.clamp(torch.abs(delta_y / h), min=1e-3)
+    delta_y = cy_q - cy.view(batch_size, 1, -1)
+    delta_y = torch.clamp(torch.abs(delta_y / h_q), min=1e-3)
     delta_y = torch.log(delta_y)
 
-    delta_w = torch.log(w / w.view(batch_size, 1, -1))
-    delta_h = torch.log(h / h.view(batch_size, 1, -1))
+    delta_w = torch.log(w_q / w.view(batch_size, 1, -1))
+    delta_h = torch.log(h_q / h.view(batch_size, 1, -1))
 
     matrix_size = delta_h.size()
     delta_x = delta_x.view(batch_size, matrix_size[1], matrix_size[2], 1)
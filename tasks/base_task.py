@@ -1,14 +1,24 @@
 import torch
-from torch.utils.data import DataLoader
+from torch import nn
+from torch import distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 from torch.nn import NLLLoss
 from torch.optim import Adam
 from torch.optim.lr_scheduler import LambdaLR
 from builders.vocab_builder import build_vocab
 
 from utils.logging_utils import setup_logger
+from utils.checkpoint import CheckpointWriter, checkpoint_exists, read_checkpoint
+from utils.running_metrics import RunningMetrics
 from builders.model_builder import build_model
+from models.modules.attentions import ScaledDotProductAttention
+import evaluation
 
 import os
+import io
+import itertools
+import time
 import numpy as np
 import pickle
 import random
@@ -17,6 +27,14 @@ logger = setup_logger()
 
 class BaseTask:
     def __init__(self, config):
+        # set when the process group was initialized by train.py, i.e. when launched with torchrun
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+
+        if self.rank != 0:
+            # the checkpoint path and the vocab are created by rank 0
+            dist.barrier()
 
         self.checkpoint_path = os.path.join(config.TRAINING.CHECKPOINT_PATH, config.MODEL.NAME)
         if not os.path.isdir(self.checkpoint_path):
@@ -32,14 +50,33 @@ class BaseTask:
             logger.info("Loading vocab from %s" % os.path.join(self.checkpoint_path, "vocab.bin"))
             self.vocab = pickle.load(open(os.path.join(self.checkpoint_path, "vocab.bin"), "rb"))
 
+        if self.distributed and self.rank == 0:
+            dist.barrier()
+
         logger.info("Loading data")
         self.load_datasets(config.DATASET)
         self.create_dataloaders(config)
 
         logger.info("Building model")
         self.model = build_model(config.MODEL, self.vocab)
+        # the forward passes of training go through DDP so that the gradients are averaged over the ranks,
+        # while decoding and checkpointing use the bare model
+        if self.distributed:
+            # the extra traversal of the graph after every forward pass is only paid by the models
+            # which leave parameters without gradient
+            find_unused_parameters = config.TRAINING.FIND_UNUSED_PARAMETERS if hasattr(config.TRAINING, "FIND_UNUSED_PARAMETERS") else False
+            self.training_model = DistributedDataParallel(self.model, find_unused_parameters=find_unused_parameters)
+        else:
+            self.training_model = self.model
         self.config = config
         self.device = torch.device(config.MODEL.DEVICE)
+        self.precision = config.TRAINING.PRECISION if hasattr(config.TRAINING, "PRECISION") else "float32"
+        if self.precision not in ("float32", "bfloat16"):
+            raise ValueError(f"Unsupported precision {self.precision}, expected float32 or bfloat16")
+        # the running losses are read back from the device and shown every LOG_EVERY steps
+        self.log_every = config.TRAINING.LOG_EVERY if hasattr(config.TRAINING, "LOG_EVERY") else 50
+        # the number of batches the quantized model is compared to the float32 one on, no comparison when 0
+        self.quantize_compare_batches = config.TRAINING.QUANTIZE_COMPARE_BATCHES if hasattr(config.TRAINING, "QUANTIZE_COMPARE_BATCHES") else 0
 
         logger.info("Defining optimizer and objective function")
         self.configuring_hyperparameters(config)
@@ -47,6 +84,9 @@ class BaseTask:
         self.scheduler = LambdaLR(self.optim, self.lambda_lr)
         self.loss_fn = NLLLoss(ignore_index=self.vocab.padding_idx)
 
+        # checkpoints are written on a background thread, training only waits for their CPU snapshot
+        self.checkpoint_writer = CheckpointWriter()
+
     def configuring_hyperparameters(self, config):
         raise NotImplementedError
 
@@ -61,6 +101,92 @@ class BaseTask:
     def create_dataloaders(self, config):
         raise NotImplementedError
 
+    def build_dataloader(self, dataset, batch_size: int, shuffle: bool, collate_fn, num_workers: int=0) -> DataLoader:
+        '''
+            In distributed mode every rank iterates over its own shard of the dataset. The shards have
+            the same length, so all the ranks run the same number of steps per epoch.
+        '''
+        sampler = DistributedSampler(dataset, num_replicas=self.world_size, rank=self.rank, shuffle=shuffle) if self.distributed else None
+
+        return DataLoader(
+            dataset=dataset,
+            batch_size=batch_size,
+            shuffle=shuffle if sampler is None else False,
+            sampler=sampler,
+            num_workers=num_workers,
+            collate_fn=collate_fn
+        )
+
+    def set_epoch(self, dataloader: DataLoader):
+        # reshuffles the shards of the ranks at every epoch
+        if isinstance(dataloader.sampler, DistributedSampler):
+            dataloader.sampler.set_epoch(self.epoch)
+
+    def gather_objects(self, obj) -> list:
+        '''
+            Returns the objects of all the ranks on rank 0 and an empty list on the others,
+            or [obj] when not distributed.
+        '''
+        if not self.distributed:
+            return [obj]
+
+        objects = [None] * self.world_size if self.rank == 0 else None
+        dist.gather_object(obj, objects, dst=0)
+
+        return objects if self.rank == 0 else []
+
+    def merge_across_ranks(self, results: dict) -> dict:
+        '''
+            results are keyed by something unique to each sample (question id, dataset index), so the
+            samples repeated by DistributedSampler to even out the shards collapse into one entry.
+        '''
+        merged = {}
+        for rank_results in self.gather_objects(results):
+            merged.update(rank_results)
+
+        return merged
+
+    def all_reduce_gradients(self):
+        '''
+            Averages the gradients over the ranks, for the losses which are not computed by a forward pass
+            of the DDP wrapper (e.g. the self-critical loss computed on beam search) and so are not reduced by it.
+            The parameters without gradient on a rank count as zero gradients.
+        '''
+        if not self.distributed:
+            return
+
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        for p in params:
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+        # a single all-reduce over the flattened gradients
+        grads = torch.cat([p.grad.view(-1) for p in params])
+        dist.all_reduce(grads)
+        grads /= self.world_size
+        for p, grad in zip(params, grads.split([p.numel() for p in params])):
+            p.grad.copy_(grad.view_as(p))
+
+    def compute_scores(self, gts: dict, gens: dict) -> dict:
+        '''
+            Scores the answers of all the ranks once on rank 0 and shares the scores with the other ranks.
+            The answers are scored in the order of their keys, so the scores do not depend on how the
+            dataset was sharded or shuffled.
+        '''
+        gts = self.merge_across_ranks(gts)
+        gens = self.merge_across_ranks(gens)
+
+        scores = None
+        if self.rank == 0:
+            keys = sorted(gts)
+            scores, _ = evaluation.compute_scores({key: gts[key] for key in keys}, {key: gens[key] for key in keys})
+
+        if self.distributed:
+            scores = [scores]
+            dist.broadcast_object_list(scores, src=0)
+            scores = scores[0]
+
+        return scores
+
     def evaluate_loss(self, dataloader: DataLoader):
         raise NotImplementedError
 
@@ -70,34 +196,81 @@ class BaseTask:
     def train(self):
         raise NotImplementedError
 
+    def autocast(self):
+        '''
+            Runs the forward passes in bfloat16 when TRAINING.PRECISION is bfloat16. Parameters stay
+            in float32, so the optimizer steps and the saved checkpoints are in full precision.
+        '''
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, 
+                              enabled=self.precision == "bfloat16")
+
     def lambda_lr(self, step):
+        # the schedule counts optimizer steps whatever the number of ranks, so that a run resumed with another
+        # number of ranks continues where it stopped. WARMUP is in optimizer steps: every step of a distributed
+        # run sees world_size batches, the warmup of a single-process run over as many samples is WARMUP / world_size
         warm_up = self.warmup
         step += 1
         return (self.model.d_model ** -.5) * min(step ** -.5, step * warm_up ** -1.5)
 
-    def load_checkpoint(self, fname) -> dict:
-        if not os.path.exists(fname):
-            return None
+    def has_checkpoint(self, name: str) -> bool:
+        stem = os.path.join(self.checkpoint_path, name)
+        # <name>.pth is a checkpoint saved in a single torch.save file by former versions
+        return checkpoint_exists(stem) or os.path.isfile(stem + ".pth")
 
-        logger.info("Loading checkpoint from %s", fname)
+    def load_checkpoint(self, name: str, weights_only: bool=False) -> dict:
+        '''
+            weights_only: only the weights and the epoch are loaded, for prediction. The optimizer and 
+                scheduler states are not read and the RNG states are not restored.
+        '''
+        # the checkpoints still being written by this process are finished first
+        self.checkpoint_writer.wait()
 
-        checkpoint = torch.load(fname, weights_only=False)
+        start_time = time.perf_counter()
+        stem = os.path.join(self.checkpoint_path, name)
+        fields = ("state_dict", "epoch") if weights_only else None
+        if checkpoint_exists(stem):
+            logger.info("Loading checkpoint from %s", stem)
+            checkpoint = read_checkpoint(stem, fields)
+        elif os.path.isfile(stem + ".pth"):
+            logger.info("Loading checkpoint from %s", stem + ".pth")
+            # memory-mapped, the entries which are not used are never read from disk
+            checkpoint = torch.load(stem + ".pth", map_location="cpu", mmap=True, weights_only=False)
+        else:
+            return None
 
-        torch.set_rng_state(checkpoint['torch_rng_state'])
-        torch.cuda.set_rng_state(checkpoint['cuda_rng_state'])
-        np.random.set_state(checkpoint['numpy_rng_state'])
-        random.setstate(checkpoint['random_rng_state'])
+        if not weights_only:
+            torch.set_rng_state(checkpoint['torch_rng_state'])
+            # checkpoints saved on CPU have no CUDA RNG state, and CPU runs leave CUDA untouched
+            if self.device.type == "cuda" and checkpoint.get('cuda_rng_state') is not None:
+                torch.cuda.set_rng_state(checkpoint['cuda_rng_state'])
+            np.random.set_state(checkpoint['numpy_rng_state'])
+            random.setstate(checkpoint['random_rng_state'])
 
-        self.model.load_state_dict(checkpoint['state_dict'], strict=False)
+        # the layers converted when loading (e.g. fc_q, fc_k and fc_v into fc_qkv) must not be left at their initialization
+        incompatible_keys = self.model.load_state_dict(checkpoint['state_dict'], strict=False)
+        if len(incompatible_keys.missing_keys) > 0 or len(incompatible_keys.unexpected_keys) > 0:
+            raise RuntimeError(f"The checkpoint {stem} does not match the model: missing keys {incompatible_keys.missing_keys}, "
+                                f"unexpected keys {incompatible_keys.unexpected_keys}")
 
-        logger.info("Resuming from epoch %s", checkpoint['epoch'])
+        logger.info("Checkpoint of epoch %s loaded in %.2fs", checkpoint['epoch'], time.perf_counter() - start_time)
 
         return checkpoint
 
+    def load_optimizer_state(self, checkpoint: dict) -> None:
+        try:
+            self.optim.load_state_dict(checkpoint['optimizer'])
+        except ValueError:
+            # e.g. checkpoints saved before the q, k and v projections were fused have other parameter shapes
+            logger.warning("The optimizer state of the checkpoint does not match the model parameters, starting with a fresh optimizer")
+
     def save_checkpoint(self, dict_for_updating: dict) -> None:
+        # the ranks hold the same weights, only rank 0 writes them
+        if self.rank != 0:
+            return
+
         dict_for_saving = {
             'torch_rng_state': torch.get_rng_state(),
-            'cuda_rng_state': torch.cuda.get_rng_state(),
+            'cuda_rng_state': torch.cuda.get_rng_state() if self.device.type == "cuda" else None,
             'numpy_rng_state': np.random.get_state(),
             'random_rng_state': random.getstate(),
             'epoch': self.epoch,
@@ -109,10 +282,78 @@ class BaseTask:
         for key, value in dict_for_updating.items():
             dict_for_saving[key] = value
 
-        torch.save(dict_for_saving, os.path.join(self.checkpoint_path, "last_model.pth"))
-        print("Checkpoint saved to %s" % os.path.join(self.checkpoint_path, "last_model.pth"))
+        stall_time = self.checkpoint_writer.save(dict_for_saving, os.path.join(self.checkpoint_path, "last_model"))
+        logger.info("Checkpoint of epoch %d snapshotted in %.3fs, writing it in background", self.epoch, stall_time)
+
+    def promote_checkpoint(self, source: str, target: str) -> None:
+        '''
+            Makes the checkpoint target the same as source once source is written, without copying it.
+        '''
+        if self.rank != 0:
+            return
+
+        self.checkpoint_writer.promote(os.path.join(self.checkpoint_path, source), 
+                                        os.path.join(self.checkpoint_path, target))
+
+    def log_running_metrics(self, desc: str, running_metrics: RunningMetrics) -> dict:
+        means = running_metrics.means()
+        logger.info("%s: %s - %.2f steps/s", desc, 
+                    ", ".join(f"{name} {value:.4f}" for name, value in means.items()), running_metrics.steps_per_second())
+
+        return means
+
+    def model_size(self) -> int:
+        buffer = io.BytesIO()
+        torch.save(self.model.state_dict(), buffer)
+
+        return buffer.getbuffer().nbytes
+
+    def quantize_model(self, scheme: str, dataloader: DataLoader):
+        '''
+            Applies dynamic int8 quantization to the nn.Linear layers of the model for CPU inference and
+            reports the model size. When TRAINING.QUANTIZE_COMPARE_BATCHES is set, latency and metric deltas
+            against float32 are reported on that many batches of the given dataloader.
+            The quantized weights are saved to quantized_model.pth, they can be loaded back only into 
+            a model quantized the same way.
+        '''
+        if scheme != "dynamic-int8":
+            raise ValueError(f"Unsupported quantization scheme {scheme}, expected dynamic-int8")
+
+        # quantized kernels only run on CPU
+        self.device = torch.device("cpu")
+        self.model.device = self.device
+        self.model = self.model.to(self.device)
+        self.model.eval()
+
+        # the same batches are decoded by both models
+        batches = list(itertools.islice(dataloader, self.quantize_compare_batches))
+        if len(batches) > 0:
+            start_time = time.perf_counter()
+            float_scores = self.evaluate_metrics(batches)
+            float_time = time.perf_counter() - start_time
+        float_size = self.model_size()
+
+        for module in list(self.model.modules()):
+            if isinstance(module, ScaledDotProductAttention):
+                module.split_projections()
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8)
+        torch.save(self.model.state_dict(), os.path.join(self.checkpoint_path, "quantized_model.pth"))
+        logger.info("Quantized model saved to %s" % os.path.join(self.checkpoint_path, "quantized_model.pth"))
+        quantized_size = self.model_size()
+
+        logger.info("Model size: %.2fMB (float32) -> %.2fMB (%s)", float_size / 2**20, quantized_size / 2**20, scheme)
+        if len(batches) > 0:
+            start_time = time.perf_counter()
+            quantized_scores = self.evaluate_metrics(batches)
+            quantized_time = time.perf_counter() - start_time
+
+            logger.info("Latency on %d batches: %.2fs (float32) -> %.2fs (%s)", len(batches), float_time, quantized_time, scheme)
+            logger.info("Metric deltas against float32: %s", {
+                key: quantized_scores[key] - float_scores[key] for key in float_scores
+            })
+
     def start(self):
         raise NotImplementedError
 
-    def get_predictions(self, dataset, get_scores=True):
+    def get_predictions(self, quantize: str=None):
         raise NotImplementedError
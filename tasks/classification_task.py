@@ -8,10 +8,11 @@ from .base_task import BaseTask
 from builders.dataset_builder import build_dataset
 from builders.task_builder import META_TASK
 from utils.logging_utils import setup_logger
+from utils.running_metrics import RunningMetrics
 import evaluation
 
 import os
-from shutil import copyfile
+from functools import partial
 from tqdm import tqdm
 import json
 
@@ -54,22 +55,30 @@ class ClassificationTask(BaseTask):
         print("dev_dataset", len(self.dev_dataset))
         print("test_dataset", len(self.test_dataset))
 
+    def get_collate_fn(self, config):
+        pad_to_multiple_of = config.DATASET.PAD_TO_MULTIPLE_OF if hasattr(config.DATASET, "PAD_TO_MULTIPLE_OF") else 1
+
+        # answers are class labels here, so only the questions are trimmed
+        return partial(collate_fn, padding_idx=self.vocab.padding_idx, answer_is_sequence=False, 
+                       trim_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+
     def create_dataloaders(self, config):
-        self.train_dataloader = DataLoader(
+        collate_fn = self.get_collate_fn(config)
+        self.train_dataloader = self.build_dataloader(
             dataset=self.train_dataset,
             batch_size=config.DATASET.FEATURE_DATASET.BATCH_SIZE,
             shuffle=True,
             num_workers=config.DATASET.FEATURE_DATASET.WORKERS,
             collate_fn=collate_fn
         )
-        self.dev_dataloader = DataLoader(
+        self.dev_dataloader = self.build_dataloader(
             dataset=self.dev_dataset,
             batch_size=config.DATASET.FEATURE_DATASET.BATCH_SIZE,
             shuffle=True,
             num_workers=config.DATASET.FEATURE_DATASET.WORKERS,
             collate_fn=collate_fn
         )
-        self.test_dataloader = DataLoader(
+        self.test_dataloader = self.build_dataloader(
             dataset=self.test_dataset,
             batch_size=1,
             shuffle=True,
@@ -83,23 +92,23 @@ class ClassificationTask(BaseTask):
 
     def evaluate_loss(self, dataloader: DataLoader):
         self.model.eval()
-        running_loss = .0
+        running_metrics = RunningMetrics(self.log_every)
         with tqdm(desc='Epoch %d - Validation' % self.epoch, unit='it', total=len(dataloader)) as pbar:
             with torch.no_grad():
                 for it, items in enumerate(dataloader):
                     items = items.to(self.device)
-                    with torch.no_grad():
-                        out = self.model(items).contiguous()
+                    with self.autocast():
+                        out = self.model(items).contiguous().float()
                     
                     answer = items.answer_tokens
                     loss = self.loss_fn(out.view(-1, self.vocab.total_answers), answer.view(-1))
-                    this_loss = loss.item()
-                    running_loss += this_loss
+                    running_metrics.update(loss=loss)
 
-                    pbar.set_postfix(loss=running_loss / (it + 1))
+                    if running_metrics.should_log():
+                        pbar.set_postfix(**running_metrics.means())
                     pbar.update()
 
-        val_loss = running_loss / len(dataloader)
+        val_loss = self.log_running_metrics('Epoch %d - Validation' % self.epoch, running_metrics)["loss"]
 
         return val_loss
 
@@ -110,52 +119,60 @@ class ClassificationTask(BaseTask):
         with tqdm(desc='Epoch %d - Evaluation' % self.epoch, unit='it', total=len(dataloader)) as pbar:
             for it, items in enumerate(dataloader):
                 items = items.to(self.device)
-                with torch.no_grad():
+                with torch.no_grad(), self.autocast():
                     outs = self.model(items).contiguous()
 
                 answers_gt = self.vocab.decode_answer(items.answer_tokens.squeeze(-1), join_word=True)
                 answers_gen = self.vocab.decode_answer(outs.argmax(dim=-1), join_word=True)
+                # keyed by dataset index: a question has one row per answer, and the rows repeated by
+                # DistributedSampler to even out the shards collapse into one entry
                 for i, (gts_i, gen_i) in enumerate(zip(answers_gt, answers_gen)):
-                    gens['%d_%d' % (it, i)] = [gen_i, ]
-                    gts['%d_%d' % (it, i)] = [gts_i, ]
+                    gens[str(items.sample_idx[i])] = [gen_i, ]
+                    gts[str(items.sample_idx[i])] = [gts_i, ]
                 pbar.update()
 
-        scores, _ = evaluation.compute_scores(gts, gens)
+        # scored once on rank 0 over the answers of all the shards, every rank gets the scores to take the same decisions
+        scores = self.compute_scores(gts, gens)
 
         return scores
 
     def train(self):
         self.model.train()
 
-        running_loss = .0
-        
+        running_metrics = RunningMetrics(self.log_every)
+        self.set_epoch(self.train_dataloader)
         with tqdm(desc='Epoch %d - Training' % self.epoch, unit='it', total=len(self.train_dataloader)) as pbar:
             for it, items in enumerate(self.train_dataloader):
                 items = items.to(self.device)
-                out = self.model(items).contiguous()
+                with self.autocast():
+                    out = self.training_model(items).contiguous()
+                # the loss is computed in float32 whatever precision the forward pass ran in
+                out = out.float()
                 answer = items.answer_tokens
                 self.optim.zero_grad()
                 loss = self.loss_fn(out.view(-1, self.vocab.total_answers), answer.view(-1))
                 loss.backward()
 
                 self.optim.step()
-                this_loss = loss.item()
-                running_loss += this_loss
+                running_metrics.update(loss=loss)
 
-                pbar.set_postfix(loss=running_loss / (it + 1))
+                if running_metrics.should_log():
+                    pbar.set_postfix(**running_metrics.means())
                 pbar.update()
                 self.scheduler.step()
 
+        self.log_running_metrics('Epoch %d - Training' % self.epoch, running_metrics)
+
     def lambda_lr(self, step):
         return self.learning_rate
 
     def start(self):
-        if os.path.isfile(os.path.join(self.checkpoint_path, "last_model.pth")):
-            checkpoint = self.load_checkpoint(os.path.join(self.checkpoint_path, "last_model.pth"))
+        if self.has_checkpoint("last_model"):
+            checkpoint = self.load_checkpoint("last_model")
             best_val_score = checkpoint["best_val_score"]
             patience = checkpoint["patience"]
             self.epoch = checkpoint["epoch"] + 1
-            self.optim.load_state_dict(checkpoint['optimizer'])
+            self.load_optimizer_state(checkpoint)
             self.scheduler.load_state_dict(checkpoint['scheduler'])
         else:
             best_val_score = .0
@@ -190,29 +207,34 @@ class ClassificationTask(BaseTask):
             })
 
             if best:
-                copyfile(os.path.join(self.checkpoint_path, "last_model.pth"), 
-                        os.path.join(self.checkpoint_path, "best_model.pth"))
+                self.promote_checkpoint("last_model", "best_model")
 
             if exit_train:
                 break
 
             self.epoch += 1
 
-    def get_predictions(self):
-        if not os.path.isfile(os.path.join(self.checkpoint_path, 'best_model.pth')):
+        # the checkpoints have to be on disk when start returns, the other ranks then read best_model
+        self.checkpoint_writer.wait()
+
+    def get_predictions(self, quantize: str=None):
+        if not self.has_checkpoint("best_model"):
             logger.error("Prediction require the model must be trained. There is no weights to load for model prediction!")
-            raise FileNotFoundError("Make sure your checkpoint path is correct or the best_model.pth is available in your checkpoint path")
+            raise FileNotFoundError("Make sure your checkpoint path is correct or the best_model checkpoint is available in your checkpoint path")
+
+        self.load_checkpoint("best_model", weights_only=True)
 
-        self.load_checkpoint(os.path.join(self.checkpoint_path, "best_model.pth"))
+        if quantize is not None:
+            self.quantize_model(quantize, self.test_dataloader)
 
         self.model.eval()
-        results = []
+        results = {}
         overall_gens = {}
         overall_gts = {}
         with tqdm(desc='Getting predictions: ', unit='it', total=len(self.test_dataloader)) as pbar:
             for it, items in enumerate(self.test_dataloader):
                 items = items.to(self.device)
-                with torch.no_grad():
+                with torch.no_grad(), self.autocast():
                     outs = self.model(items)
 
                 answers_gt = self.vocab.decode_answer(items.answer_tokens.squeeze(-1), join_word=True)
@@ -220,26 +242,30 @@ class ClassificationTask(BaseTask):
                 gts = {}
                 gens = {}
                 for i, (gts_i, gen_i) in enumerate(zip(answers_gt, answers_gen)):
-                    gens['%d_%d' % (it, i)] = gen_i
-                    gts['%d_%d' % (it, i)] = gts_i
-                    overall_gens['%d_%d' % (it, i)] = [gen_i, ]
-                    overall_gts['%d_%d' % (it, i)] = [gts_i, ]
+                    gens[str(items.sample_idx[i])] = gen_i
+                    gts[str(items.sample_idx[i])] = gts_i
+                    overall_gens[str(items.sample_idx[i])] = [gen_i, ]
+                    overall_gts[str(items.sample_idx[i])] = [gts_i, ]
                 pbar.update()
 
-                results.append({
+                results[tuple(items.sample_idx)] = {
                     "id": items.question_id,
                     "filename": items.filename,
                     "gens": gens,
                     "gts": gts
-                })
+                }
 
                 pbar.update()
 
-        scores, _ = evaluation.compute_scores(overall_gts, overall_gens)
+        # the samples repeated by DistributedSampler to even out the shards show up in several results
+        results = self.merge_across_ranks(results)
+        results = [results[key] for key in sorted(results)]
+        scores = self.compute_scores(overall_gts, overall_gens)
         scores = {key: value for key, value in scores.items() if key in self.config.TRAINING.VERBOSE_SCORES}
         logger.info("Evaluation scores on test: %s", scores)
 
-        json.dump({
-            "results": results,
-            **scores,
-        }, open(os.path.join(self.checkpoint_path, "test_results.json"), "w+", encoding='utf8'), ensure_ascii=False)
\ No newline at end of file
+        if self.rank == 0:
+            json.dump({
+                "results": results,
+                **scores,
+            }, open(os.path.join(self.checkpoint_path, "test_results.json"), "w+", encoding='utf8'), ensure_ascii=False)
\ No newline at end of file
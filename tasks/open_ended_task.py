@@ -3,19 +3,22 @@ from torch.utils.data import DataLoader
 from torch.optim import Adam
 
 from utils.logging_utils import setup_logger
+from utils.running_metrics import RunningMetrics
 from utils.instance import Instance
 from data_utils.utils import collate_fn
 from .base_task import BaseTask
 from builders.task_builder import META_TASK
 from builders.dataset_builder import build_dataset
+from models.modules.answer_trie import AnswerTrie
 import evaluation
-from evaluation import Cider
+from evaluation import CiderReward
 
 import os
 import numpy as np
 from tqdm import tqdm
 import itertools
-from shutil import copyfile
+import time
+from functools import partial
 import json
 
 logger = setup_logger()
@@ -43,23 +46,29 @@ class OpenEndedTask(BaseTask):
         self.train_dataset, self.dev_dataset, self.test_dataset = self.load_feature_datasets(config)
         self.train_dict_dataset, self.dev_dict_dataset, self.test_dict_dataset = self.load_dict_datasets(config)
 
+    def get_collate_fn(self, config):
+        pad_to_multiple_of = config.DATASET.PAD_TO_MULTIPLE_OF if hasattr(config.DATASET, "PAD_TO_MULTIPLE_OF") else 1
+
+        return partial(collate_fn, padding_idx=self.vocab.padding_idx, trim_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+
     def create_feature_dataloaders(self, config):
+        collate_fn = self.get_collate_fn(config)
         # creating iterable-dataset data loader
-        self.train_dataloader = DataLoader(
+        self.train_dataloader = self.build_dataloader(
             dataset=self.train_dataset,
             batch_size=config.DATASET.FEATURE_DATASET.BATCH_SIZE,
             shuffle=True,
             num_workers=config.DATASET.FEATURE_DATASET.WORKERS,
             collate_fn=collate_fn
         )
-        self.dev_dataloader = DataLoader(
+        self.dev_dataloader = self.build_dataloader(
             dataset=self.dev_dataset,
             batch_size=config.DATASET.FEATURE_DATASET.BATCH_SIZE,
             shuffle=True,
             num_workers=config.DATASET.FEATURE_DATASET.WORKERS,
             collate_fn=collate_fn
         )
-        self.test_dataloader = DataLoader(
+        self.test_dataloader = self.build_dataloader(
             dataset=self.test_dataset,
             batch_size=1,
             shuffle=True,
@@ -68,20 +77,21 @@ class OpenEndedTask(BaseTask):
         )
 
     def create_dict_dataloaders(self, config):
+        collate_fn = self.get_collate_fn(config)
         # creating dictionary iterable-dataset data loader
-        self.train_dict_dataloader = DataLoader(
+        self.train_dict_dataloader = self.build_dataloader(
             dataset=self.train_dict_dataset,
             batch_size=config.DATASET.DICT_DATASET.BATCH_SIZE // config.TRAINING.TRAINING_BEAM_SIZE,
             shuffle=True,
             collate_fn=collate_fn
         )
-        self.dev_dict_dataloader = DataLoader(
+        self.dev_dict_dataloader = self.build_dataloader(
             dataset=self.dev_dict_dataset,
             batch_size=config.DATASET.DICT_DATASET.BATCH_SIZE // config.TRAINING.EVALUATING_BEAM_SIZE,
             shuffle=True,
             collate_fn=collate_fn
         )
-        self.test_dict_dataloader = DataLoader(
+        self.test_dict_dataloader = self.build_dataloader(
             dataset=self.test_dict_dataset,
             batch_size=1,
             shuffle=True,
@@ -101,30 +111,76 @@ class OpenEndedTask(BaseTask):
         self.training_beam_size = config.TRAINING.TRAINING_BEAM_SIZE
         self.evaluating_beam_size = config.TRAINING.EVALUATING_BEAM_SIZE
         self.patience = config.TRAINING.PATIENCE
-        self.train_cider = Cider({f"{idx}": answer for idx, answer in enumerate(self.train_dataset.answers)})
+        # references of the self-critical reward, their tf-idf vectors are computed once here
+        train_references = {}
+        for ann in self.train_dict_dataset.annotations:
+            train_references.setdefault(str(ann["question_id"]), []).append(" ".join(ann["answers"]))
+        self.train_cider = CiderReward(train_references)
+        # decoding restricted to the answers of the training set, with free generation for the questions
+        # whose best candidate has a mean log-probability per token below CANDIDATE_FALLBACK_THRESHOLD
+        self.candidate_answers = config.TRAINING.CANDIDATE_ANSWERS if hasattr(config.TRAINING, "CANDIDATE_ANSWERS") else False
+        self.candidate_fallback_threshold = config.TRAINING.CANDIDATE_FALLBACK_THRESHOLD if hasattr(config.TRAINING, "CANDIDATE_FALLBACK_THRESHOLD") else None
+        self.answer_trie = None
 
     def evaluate_loss(self, dataloader):
         self.model.eval()
-        running_loss = .0
+        running_metrics = RunningMetrics(self.log_every)
         with tqdm(desc='Epoch %d - Validation' % self.epoch, unit='it', total=len(dataloader)) as pbar:
             with torch.no_grad():
                 for it, items in enumerate(dataloader):
                     items = items.to(self.device)
-                    with torch.no_grad():
+                    with self.autocast():
                         out = self.model(items).contiguous()
                     
-                    shifted_right_answer_tokens = items.shifted_right_answer_tokens
+                    shifted_right_answer_tokens = self.model.to_output_ids(items.shifted_right_answer_tokens)
                     loss = self.loss_fn(out.view(-1, out.shape[-1]), shifted_right_answer_tokens.view(-1))
-                    this_loss = loss.item()
-                    running_loss += this_loss
+                    running_metrics.update(loss=loss)
 
-                    pbar.set_postfix(loss=running_loss / (it + 1))
+                    if running_metrics.should_log():
+                        pbar.set_postfix(**running_metrics.means())
                     pbar.update()
 
-        val_loss = running_loss / len(dataloader)
+        val_loss = self.log_running_metrics('Epoch %d - Validation' % self.epoch, running_metrics)["loss"]
 
         return val_loss
 
+    def get_answer_trie(self):
+        if self.answer_trie is None:
+            answers = [[self.vocab.stoi.get(token, self.vocab.unk_idx) for token in ann["answers"]] 
+                            for ann in self.train_dict_dataset.annotations]
+            # the trie is built over the ids of the output distribution, which differ with an output shortlist
+            answers = [self.model.to_output_ids(torch.tensor(answer, dtype=torch.long, device=self.device)).tolist()
+                            for answer in answers]
+            self.answer_trie = AnswerTrie(answers, self.vocab.eos_idx)
+            logger.info("Decoding restricted to %d candidate answers", len(self.answer_trie))
+
+        return self.answer_trie
+
+    def decode(self, items, **kwargs):
+        # beam search with a single beam reduces to greedy decoding, which has a cheaper dedicated path
+        if self.evaluating_beam_size == 1:
+            return self.model.greedy_decode(items, batch_size=items.batch_size, **kwargs)
+
+        return self.model.beam_search(items, batch_size=items.batch_size, beam_size=self.evaluating_beam_size, out_size=1, **kwargs)
+
+    def generate(self, items):
+        if not self.candidate_answers:
+            return self.decode(items)
+
+        outs, log_probs = self.decode(items, answer_trie=self.get_answer_trie())
+        if self.candidate_fallback_threshold is not None:
+            lengths = (outs != self.vocab.padding_idx).sum(dim=-1).clamp(min=1)
+            fallback = log_probs.sum(dim=-1) / lengths < self.candidate_fallback_threshold
+            if fallback.any():
+                # only the questions below the threshold are decoded again, without the candidates
+                fallback_idxs = fallback.nonzero().squeeze(-1)
+                fallback_items = items.index_select(fallback_idxs)
+                free_outs, free_log_probs = self.decode(fallback_items)
+                outs = outs.index_copy(0, fallback_idxs, free_outs)
+                log_probs = log_probs.index_copy(0, fallback_idxs, free_log_probs.to(log_probs.dtype))
+
+        return outs, log_probs
+
     def evaluate_metrics(self, dataloader):
         self.model.eval()
         gens = {}
@@ -132,8 +188,8 @@ class OpenEndedTask(BaseTask):
         with tqdm(desc='Epoch %d - Evaluation' % self.epoch, unit='it', total=len(dataloader)) as pbar:
             for it, items in enumerate(dataloader):
                 items = items.to(self.device)
-                with torch.no_grad():
-                    outs, _ = self.model.beam_search(items, batch_size=items.batch_size, beam_size=self.evaluating_beam_size, out_size=1)
+                with torch.no_grad(), self.autocast():
+                    outs, _ = self.generate(items)
 
                 answers_gt = items.answers
                 answers_gen = self.vocab.decode_answer(outs.contiguous().view(-1, self.vocab.max_answer_length), join_words=False)
@@ -141,44 +197,47 @@ class OpenEndedTask(BaseTask):
                 for i, (gts_i, gen_i) in enumerate(zip(answers_gt, answers_gen)):
                     gen_i = ' '.join([k for k, g in itertools.groupby(gen_i)])
                     gts_i = ' '.join([k for k, g in itertools.groupby(gts_i)])
-                    gens['%d_%d' % (it, i)] = [gen_i, ]
-                    gts['%d_%d' % (it, i)] = [gts_i, ]
+                    gens[str(items.question_id[i])] = [gen_i, ]
+                    gts[str(items.question_id[i])] = [gts_i, ]
 
                 pbar.update()
 
-        scores, _ = evaluation.compute_scores(gts, gens)
+        # scored once on rank 0 over the answers of all the shards, every rank gets the scores to take the same decisions
+        scores = self.compute_scores(gts, gens)
 
         return scores
 
     def train(self):
         self.model.train()
 
-        running_loss = .0
+        running_metrics = RunningMetrics(self.log_every)
+        self.set_epoch(self.train_dataloader)
         with tqdm(desc='Epoch %d - Training with cross-entropy loss' % self.epoch, unit='it', total=len(self.train_dataloader)) as pbar:
             for it, items in enumerate(self.train_dataloader):
                 items = items.to(self.device)
-                out = self.model(items).contiguous()
-                shifted_right_answer_tokens = items.shifted_right_answer_tokens
+                with self.autocast():
+                    out = self.training_model(items).contiguous()
+                shifted_right_answer_tokens = self.model.to_output_ids(items.shifted_right_answer_tokens)
                 self.optim.zero_grad()
                 loss = self.loss_fn(out.view(-1, out.shape[-1]), shifted_right_answer_tokens.view(-1))
                 loss.backward()
 
                 self.optim.step()
-                this_loss = loss.item()
-                running_loss += this_loss
+                running_metrics.update(loss=loss)
 
-                pbar.set_postfix(loss=running_loss / (it + 1))
+                if running_metrics.should_log():
+                    pbar.set_postfix(**running_metrics.means())
                 pbar.update()
                 self.scheduler.step()
 
+        self.log_running_metrics('Epoch %d - Training with cross-entropy loss' % self.epoch, running_metrics)
+
     def train_scst(self):
         # design especially for self-critical sequential learning
-        running_reward = .0
-        running_reward_baseline = .0
-
         self.model.train()
 
-        running_loss = .0
+        running_metrics = RunningMetrics(self.log_every)
+        self.set_epoch(self.train_dict_dataloader)
         with tqdm(desc='Epoch %d - Training with self-critical learning' % self.epoch, unit='it', total=len(self.train_dict_dataloader)) as pbar:
             for it, items in enumerate(self.train_dict_dataloader):
                 items = items.to(self.device)
@@ -189,35 +248,34 @@ class OpenEndedTask(BaseTask):
 
                 # Rewards
                 bs = items.question_tokens.shape[0]
-                answers_gt = items.answers
                 answers_gen = self.vocab.decode_answer(outs.contiguous().view(-1, self.vocab.max_answer_length), join_words=True)
-                answers_gt = list(itertools.chain(*([a, ] * self.training_beam_size for a in answers_gt)))
-                gens = {f"{idx}": [answer_gen, ] for idx, answer_gen in enumerate(answers_gen)}
-                gts = {f"{idx}": answer_gt for idx, answer_gt in enumerate(answers_gt)}
-                reward = self.train_cider.compute_score(gts, gens)[1].astype(np.float32)
+                keys = list(itertools.chain(*([str(question_id), ] * self.training_beam_size for question_id in items.question_id)))
+                reward = self.train_cider.compute_score(keys, answers_gen)[1].astype(np.float32)
                 reward = torch.from_numpy(reward).to(self.device).view(bs, self.training_beam_size)
                 reward_baseline = torch.mean(reward, dim=-1, keepdim=True)
                 loss = -torch.mean(log_probs, -1) * (reward - reward_baseline)
 
                 loss = loss.mean()
                 loss.backward()
+                # beam search does not go through the DDP wrapper, so the gradients are averaged here
+                self.all_reduce_gradients()
                 self.optim.step()
 
-                running_loss += loss.item()
-                running_reward += reward.mean().item()
-                running_reward_baseline += reward_baseline.mean().item()
-                pbar.set_postfix(loss=running_loss / (it + 1), reward=running_reward / (it + 1),
-                                reward_baseline=running_reward_baseline / (it + 1))
+                running_metrics.update(loss=loss, reward=reward.mean(), reward_baseline=reward_baseline.mean())
+                if running_metrics.should_log():
+                    pbar.set_postfix(**running_metrics.means())
                 pbar.update()
 
+        self.log_running_metrics('Epoch %d - Training with self-critical learning' % self.epoch, running_metrics)
+
     def start(self):
-        if os.path.isfile(os.path.join(self.checkpoint_path, "last_model.pth")):
-            checkpoint = self.load_checkpoint(os.path.join(self.checkpoint_path, "last_model.pth"))
+        if self.has_checkpoint("last_model"):
+            checkpoint = self.load_checkpoint("last_model")
             # use_rl = checkpoint["use_rl"]
             best_val_score = checkpoint["best_val_score"]
             patience = checkpoint["patience"]
             self.epoch = checkpoint["epoch"] + 1
-            self.optim.load_state_dict(checkpoint['optimizer'])
+            self.load_optimizer_state(checkpoint)
             self.scheduler.load_state_dict(checkpoint['scheduler'])
         else:
             # use_rl = False
@@ -266,7 +324,7 @@ class OpenEndedTask(BaseTask):
                 exit_train = True
 
             # if switch_to_rl and not best:
-            #     self.load_checkpoint(os.path.join(self.checkpoint_path, "best_model.pth"))
+            #     self.load_checkpoint("best_model")
 
             self.save_checkpoint({
                 'best_val_score': best_val_score,
@@ -275,30 +333,39 @@ class OpenEndedTask(BaseTask):
             })
 
             if best:
-                copyfile(os.path.join(self.checkpoint_path, "last_model.pth"), 
-                        os.path.join(self.checkpoint_path, "best_model.pth"))
+                self.promote_checkpoint("last_model", "best_model")
 
             if exit_train:
                 break
 
             self.epoch += 1
 
-    def get_predictions(self):
-        if not os.path.isfile(os.path.join(self.checkpoint_path, 'best_model.pth')):
+        # the checkpoints have to be on disk when start returns, the other ranks then read best_model
+        self.checkpoint_writer.wait()
+
+    def get_predictions(self, quantize: str=None):
+        if not self.has_checkpoint("best_model"):
             logger.error("Prediction require the model must be trained. There is no weights to load for model prediction!")
-            raise FileNotFoundError("Make sure your checkpoint path is correct or the best_model.pth is available in your checkpoint path")
+            raise FileNotFoundError("Make sure your checkpoint path is correct or the best_model checkpoint is available in your checkpoint path")
 
-        self.load_checkpoint(os.path.join(self.checkpoint_path, "best_model.pth"))
+        self.load_checkpoint("best_model", weights_only=True)
+
+        if quantize is not None:
+            self.quantize_model(quantize, self.test_dict_dataloader)
 
         self.model.eval()
         results = []
         overall_gens = {}
         overall_gts = {}
+        # the first batch also pays for the compilation when MODEL.COMPILE_INFERENCE is set, so it is timed apart
+        latencies = []
         with tqdm(desc='Getting predictions: ', unit='it', total=len(self.test_dict_dataloader)) as pbar:
             for it, items in enumerate(self.test_dict_dataloader):
                 items = items.to(self.device)
-                with torch.no_grad():
-                    outs, _ = self.model.beam_search(items, batch_size=items.batch_size, beam_size=self.evaluating_beam_size, out_size=1)
+                start_time = time.perf_counter()
+                with torch.no_grad(), self.autocast():
+                    outs, _ = self.generate(items)
+                latencies.append(time.perf_counter() - start_time)
                 answers_gt = items.answers
                 answers_gen = self.vocab.decode_answer(outs.contiguous().view(-1, self.vocab.max_answer_length), join_words=False)
                 gts = {}
@@ -306,10 +373,10 @@ class OpenEndedTask(BaseTask):
                 for i, (gts_i, gen_i) in enumerate(zip(answers_gt, answers_gen)):
                     gen_i = ' '.join([k for k, g in itertools.groupby(gen_i)])
                     gts_i = ' '.join([k for k, g in itertools.groupby(gts_i)])
-                    gens['%d_%d' % (it, i)] = gen_i
-                    gts['%d_%d' % (it, i)] = gts_i
-                    overall_gens['%d_%d' % (it, i)] = [gen_i, ]
-                    overall_gts['%d_%d' % (it, i)] = [gts_i, ]
+                    gens[str(items.question_id[i])] = gen_i
+                    gts[str(items.question_id[i])] = gts_i
+                    overall_gens[str(items.question_id[i])] = [gen_i, ]
+                    overall_gts[str(items.question_id[i])] = [gts_i, ]
                 pbar.update()
 
                 results.append({
@@ -322,10 +389,19 @@ class OpenEndedTask(BaseTask):
 
                 pbar.update()
 
-        scores, _ = evaluation.compute_scores(overall_gts, overall_gens)
+        if len(latencies) > 0:
+            logger.info("Warm-up latency: %.4fs", latencies[0])
+        if len(latencies) > 1:
+            logger.info("Steady-state latency: %.4fs per batch", np.mean(latencies[1:]))
+
+        # the samples repeated by DistributedSampler to even out the shards show up in several results
+        results = {str(result["id"]): result for rank_results in self.gather_objects(results) for result in rank_results}
+        results = [results[key] for key in sorted(results)]
+        scores = self.compute_scores(overall_gts, overall_gens)
         logger.info("Evaluation scores on test: %s", scores)
 
-        json.dump({
-            "results": results,
-            **scores,
-        }, open(os.path.join(self.checkpoint_path, "test_results.json"), "w+",encoding="utf-8"), ensure_ascii=False)
\ No newline at end of file
+        if self.rank == 0:
+            json.dump({
+                "results": results,
+                **scores,
+            }, open(os.path.join(self.checkpoint_path, "test_results.json"), "w+",encoding="utf-8"), ensure_ascii=False)
\ No newline at end of file
@@ -0,0 +1,7 @@
+# models, tasks and data_utils import each other through the registries in builders, the entry points
+# (train.py, export_onnx.py) import builders.task_builder first so the cycle resolves, the tests do the same
+try:
+    import builders.task_builder
+except ImportError:
+    # without torch the test modules skip themselves
+    pass
@@ -0,0 +1,57 @@
+import os
+from types import SimpleNamespace
+
+def attention_config(architecture: str="ScaledDotProductAttention", **kwargs):
+    '''
+        A small attention config, in place of the yacs nodes of the yaml files.
+    '''
+    config = dict(
+        ARCHITECTURE=architecture,
+        HEAD=2,
+        D_MODEL=16,
+        D_KEY=8,
+        D_VALUE=8,
+        D_FF=32,
+        DROPOUT=0.,
+        USE_AOA=False,
+        CAN_BE_STATEFUL=False
+    )
+    config.update(kwargs)
+
+    return SimpleNamespace(**config)
+
+class TinyVocab(object):
+    '''
+        The attributes of a Vocab the models read, for models built without a dataset.
+    '''
+    def __init__(self, size: int=20, max_answer_length: int=6):
+        self.size = size
+        self.padding_idx = 0
+        self.bos_idx = 1
+        self.eos_idx = 2
+        self.unk_idx = 3
+        self.padding_token = "<pad>"
+        self.max_answer_length = max_answer_length
+
+    def __len__(self):
+        return self.size
+
+def tiny_model_config(yaml_file: str="configs/iterative_mcan_ds102.yaml"):
+    '''
+        The MODEL node of a yaml config shrunk to a few dimensions, on CPU and without dropout.
+    '''
+    from configs.utils import get_config
+
+    sizes = dict(D_MODEL=16, D_FEATURE=8, D_EMBEDDING=8, HEAD=2, D_KEY=8, D_VALUE=8, D_FF=32, LAYERS=2, DROPOUT=0.)
+    def shrink(node):
+        for key, value in node.items():
+            if isinstance(value, dict):
+                shrink(value)
+            elif key in sizes:
+                node[key] = sizes[key]
+
+    config = get_config(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), yaml_file)).MODEL
+    shrink(config)
+    config.DEVICE = "cpu"
+
+    return config
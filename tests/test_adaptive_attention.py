@@ -0,0 +1,64 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+import numpy as np
+
+from models.modules.attentions import AdaptiveScaledDotProductAttention, MultiHeadAttention
+from models.utils import generate_sequential_mask
+from tests.helpers import attention_config
+
+def loop_adaptive_attention(attention, queries, keys, values, language_signals, attention_mask=None):
+    '''
+        The per-query implementation AdaptiveScaledDotProductAttention had before it was batched.
+    '''
+    b_s, nq = queries.shape[:2]
+    nk = keys.shape[1]
+    h, d_k, d_v = attention.h, attention.d_k, attention.d_v
+
+    q = attention.fc_q(queries).view(b_s, nq, h, d_k).permute(0, 2, 1, 3)
+    s = attention.fc_s(language_signals).view(b_s, nq, h, d_k).permute(0, 2, 1, 3)
+    k = attention.fc_k(keys).view(b_s, nk, h, d_k).permute(0, 2, 3, 1)
+    v = attention.fc_v(values).view(b_s, nk, h, d_v).permute(0, 2, 1, 3)
+
+    attn = torch.matmul(q, k) / np.sqrt(d_k)
+    if attention_mask is not None:
+        attn = attn.masked_fill(attention_mask, -10e4)
+
+    language_attn = torch.matmul(q, s.permute(0, 1, 3, 2)) / np.sqrt(d_k)
+    language_attn = torch.cat([language_attn[:, :, i, i].unsqueeze(-1) for i in range(nq)], -1)
+
+    combined_attn = torch.cat([attn, language_attn.unsqueeze(-1)], dim=-1)
+    combined_attn = [torch.softmax(combined_attn[:, :, i, :].unsqueeze(2), dim=-1) for i in range(nq)]
+    combined_v = [torch.cat([v, s[:, :, i, :].unsqueeze(2)], 2) for i in range(nq)]
+    out = torch.cat([torch.matmul(combined_attn[i], combined_v[i]) for i in range(nq)], dim=2)
+
+    out = out.permute(0, 2, 1, 3).contiguous().view(b_s, nq, h * d_v)
+
+    return attention.fc_o(out), torch.cat(combined_attn, dim=2)
+
+@pytest.mark.parametrize("masked", [False, True])
+def test_matches_per_query_loop(masked):
+    torch.manual_seed(0)
+    attention = AdaptiveScaledDotProductAttention(attention_config("AdaptiveScaledDotProductAttention")).eval()
+    queries = torch.randn(3, 6, 16)
+    language_signals = torch.randn(3, 6, 16)
+    mask = generate_sequential_mask(6) if masked else None
+
+    with torch.no_grad():
+        out, att = attention(queries, queries, queries, mask, language_signals=language_signals)
+        expected_out, expected_att = loop_adaptive_attention(attention, queries, queries, queries, language_signals, mask)
+
+    torch.testing.assert_close(out, expected_out, atol=1e-5, rtol=1e-5)
+    torch.testing.assert_close(att, expected_att, atol=1e-5, rtol=1e-5)
+
+def test_called_through_multi_head_attention():
+    # MultiHeadAttention passes the mask positionally and the language signals as a keyword, as AdaptiveDecoder does
+    torch.manual_seed(0)
+    attention = MultiHeadAttention(attention_config("AdaptiveScaledDotProductAttention")).eval()
+    queries = torch.randn(2, 4, 16)
+    keys = torch.randn(2, 7, 16)
+
+    with torch.no_grad():
+        out = attention(queries, keys, keys, attention_mask=None, language_signals=torch.randn(2, 4, 16))
+
+    assert out.shape == (2, 4, 16)
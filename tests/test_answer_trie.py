@@ -0,0 +1,103 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import random
+
+from models.modules.answer_trie import AnswerTrie
+from tasks.open_ended_task import OpenEndedTask
+from utils.instance import InstanceList
+
+EOS_IDX = 2
+VOCAB_LEN = 12
+
+def build_children(answers):
+    # the prefix tree as dictionaries, walked token by token as the former implementation did
+    children = [{}]
+    for answer in {tuple(answer) for answer in answers}:
+        node = 0
+        for token in answer + (EOS_IDX, ):
+            if token not in children[node]:
+                children[node][token] = len(children)
+                children.append({})
+            node = children[node][token]
+
+    return children
+
+def random_answers(n_answers: int):
+    rng = random.Random(0)
+
+    return [[rng.randrange(3, VOCAB_LEN) for _ in range(rng.randint(1, 4))] for _ in range(n_answers)]
+
+def test_decoding_steps_match_dictionaries():
+    answers = random_answers(30)
+    trie = AnswerTrie(answers, EOS_IDX)
+    children = build_children(answers)
+    torch.manual_seed(0)
+
+    nodes = trie.root(16, "cpu")
+    expected_nodes = [0] * 16
+    for _ in range(6):
+        mask = trie.disallowed_mask(nodes, VOCAB_LEN)
+        for row, node in enumerate(expected_nodes):
+            allowed = set(children[node]) if len(children[node]) > 0 else set(range(VOCAB_LEN))
+            assert set(torch.nonzero(~mask[row]).view(-1).tolist()) == allowed
+
+        # mostly allowed tokens, and some which do not extend the prefixes
+        tokens = torch.multinomial((~mask).float() + 0.05, 1)
+        nodes = trie.advance(nodes, tokens)
+        expected_nodes = [children[node].get(token, node) for node, token in zip(expected_nodes, tokens.view(-1).tolist())]
+        assert nodes.tolist() == expected_nodes
+
+def test_decoded_answers_belong_to_the_set():
+    answers = random_answers(30)
+    trie = AnswerTrie(answers, EOS_IDX)
+    torch.manual_seed(0)
+
+    nodes = trie.root(32, "cpu")
+    decoded = torch.zeros((32, 0), dtype=torch.long)
+    for _ in range(5):
+        logits = torch.randn(32, VOCAB_LEN).masked_fill(trie.disallowed_mask(nodes, VOCAB_LEN), -10e4)
+        tokens = logits.argmax(dim=-1, keepdim=True)
+        nodes = trie.advance(nodes, tokens)
+        decoded = torch.cat([decoded, tokens], dim=-1)
+
+    answer_set = {tuple(answer) for answer in answers}
+    for sequence in decoded.tolist():
+        assert tuple(sequence[:sequence.index(EOS_IDX)]) in answer_set
+
+class RecordingDecoder(object):
+    '''
+        greedy_decode of a model: the candidates decode the question ids with a low log-probability for the odd ones,
+        the free decoding their negatives. The batches decoded freely are recorded.
+    '''
+    def __init__(self):
+        self.free_batches = []
+
+    def greedy_decode(self, items, batch_size, answer_trie=None):
+        assert batch_size == items.batch_size
+        question_ids = torch.tensor(items.question_id)
+        outs = question_ids.view(-1, 1).expand(-1, 3)
+        if answer_trie is None:
+            self.free_batches.append(items.question_id)
+            return -outs, torch.full((batch_size, 3), -.1)
+
+        return outs, torch.where(question_ids % 2 == 1, -5., -.1).view(-1, 1).expand(-1, 3)
+
+def test_only_the_questions_below_the_threshold_are_decoded_freely():
+    task = OpenEndedTask.__new__(OpenEndedTask)
+    task.model = RecordingDecoder()
+    task.vocab = type("Vocab", (), {"padding_idx": 0})()
+    task.evaluating_beam_size = 1
+    task.candidate_answers = True
+    task.candidate_fallback_threshold = -1.
+    task.get_answer_trie = lambda: "trie"
+    items = InstanceList()
+    items.question_id = [4, 7, 6, 9]
+    items.question_tokens = torch.arange(8).view(4, 2)
+
+    outs, log_probs = task.generate(items)
+
+    assert task.model.free_batches == [[7, 9]]
+    assert outs[:, 0].tolist() == [4, -7, 6, -9]
+    torch.testing.assert_close(log_probs, torch.full((4, 3), -.1))
@@ -0,0 +1,84 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.modules.attentions import ScaledDotProductAttention
+from models.utils import generate_padding_mask_from_lengths, generate_sequential_mask
+from tests.helpers import attention_config
+
+def build_attentions():
+    torch.manual_seed(0)
+    math_attention = ScaledDotProductAttention(attention_config(BACKEND="math")).eval()
+    fused_attention = ScaledDotProductAttention(attention_config(BACKEND="fused")).eval()
+    fused_attention.load_state_dict(math_attention.state_dict())
+
+    return math_attention, fused_attention
+
+def additive_attention(attention, queries, keys, attention_mask):
+    # the former path, with the mask scaled by -10e4 and added to the scores
+    q = attention.project_queries(queries)
+    k, v = attention.project_keys_values(keys, keys)
+    att = q @ k.transpose(-2, -1) / attention.d_k ** 0.5 + attention_mask.float() * -10e4
+    out = (torch.softmax(att, dim=-1) @ v).permute(0, 2, 1, 3).reshape(*queries.shape[:2], -1)
+
+    return attention.fc_o(out)
+
+def test_backends_match_on_padding_masks():
+    math_attention, fused_attention = build_attentions()
+    queries = torch.randn(3, 5, 16)
+    keys = torch.randn(3, 7, 16)
+    attention_mask = generate_padding_mask_from_lengths(torch.tensor([7, 4, 1]), 7)
+
+    with torch.no_grad():
+        expected = additive_attention(math_attention, queries, keys, attention_mask)
+        math_out, _ = math_attention(queries, keys, keys, attention_mask=attention_mask)
+        fused_out, _ = fused_attention(queries, keys, keys, attention_mask=attention_mask)
+
+    torch.testing.assert_close(math_out, expected)
+    torch.testing.assert_close(fused_out, expected)
+
+def test_backends_match_on_causal_masks():
+    math_attention, fused_attention = build_attentions()
+    x = torch.randn(3, 6, 16)
+    attention_mask = generate_sequential_mask(6) | generate_padding_mask_from_lengths(torch.tensor([6, 4, 2]), 6)
+
+    with torch.no_grad():
+        expected = additive_attention(math_attention, x, x, attention_mask)
+        math_out, _ = math_attention(x, x, x, attention_mask=attention_mask)
+        fused_out, _ = fused_attention(x, x, x, attention_mask=attention_mask)
+
+    torch.testing.assert_close(math_out, expected)
+    torch.testing.assert_close(fused_out, expected)
+
+def test_backends_match_on_beam_invariant_keys():
+    # keys kept once per sample are broadcast over the beams of the queries
+    math_attention, fused_attention = build_attentions()
+    queries = torch.randn(6, 1, 16)
+    keys = torch.randn(2, 7, 16)
+    attention_mask = generate_padding_mask_from_lengths(torch.tensor([7, 3]), 7)
+
+    with torch.no_grad():
+        projected_keys_values = math_attention.project_keys_values(keys, keys)
+        math_out, _ = math_attention(queries, keys, keys, attention_mask=attention_mask, projected_keys_values=projected_keys_values)
+        fused_out, _ = fused_attention(queries, keys, keys, attention_mask=attention_mask, projected_keys_values=projected_keys_values)
+        expected = additive_attention(math_attention, queries, keys.repeat_interleave(3, dim=0), attention_mask.repeat_interleave(3, dim=0))
+
+    torch.testing.assert_close(math_out, expected)
+    torch.testing.assert_close(fused_out, expected)
+
+def test_backends_match_on_fully_masked_rows():
+    # an all-padding sample: the math backend attends uniformly over its keys, the fused one used to yield NaN
+    math_attention, fused_attention = build_attentions()
+    queries = torch.randn(3, 5, 16)
+    keys = torch.randn(3, 7, 16)
+    attention_mask = generate_padding_mask_from_lengths(torch.tensor([7, 0, 3]), 7)
+
+    with torch.no_grad():
+        math_out, _ = math_attention(queries, keys, keys, attention_mask=attention_mask)
+        fused_out, _ = fused_attention(queries, keys, keys, attention_mask=attention_mask)
+        _, v = math_attention.project_keys_values(keys[1:2], keys[1:2])
+        uniform = math_attention.fc_o(v.mean(dim=-2).reshape(1, 1, -1)).expand(1, 5, -1)
+
+    assert torch.isfinite(fused_out).all()
+    torch.testing.assert_close(fused_out, math_out)
+    torch.testing.assert_close(fused_out[1:2], uniform)
@@ -0,0 +1,155 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import os
+import threading
+from torch.optim import Adam
+from torch.optim.lr_scheduler import LambdaLR
+
+import utils.checkpoint
+from builders.model_builder import build_model
+from tasks.base_task import BaseTask
+from utils.checkpoint import CheckpointWriter, checkpoint_exists, checkpoint_files, read_checkpoint
+from tests.helpers import TinyVocab, tiny_model_config
+
+def build_tiny_model(seed: int=0):
+    torch.manual_seed(seed)
+
+    return build_model(tiny_model_config(), TinyVocab()).eval()
+
+def to_baseline_format(model) -> dict:
+    '''
+        The state_dict the model had before this series: separate fc_q, fc_k and fc_v projections and
+        empty running_keys and running_values buffers in the stateful self-attention of the decoder.
+    '''
+    state_dict = {}
+    for name, value in model.state_dict().items():
+        if ".fc_qkv." in name:
+            prefix, param = name.split(".fc_qkv.")
+            attention = model.get_submodule(prefix)
+            q, k, v = value.split([attention.h * attention.d_k, attention.h * attention.d_k, attention.h * attention.d_v])
+            for fc, part in (("fc_q", q), ("fc_k", k), ("fc_v", v)):
+                state_dict[f"{prefix}.{fc}.{param}"] = part.clone()
+        else:
+            state_dict[name] = value.clone()
+    for ith in range(len(model.decoder.layers)):
+        state_dict[f"decoder.layers.{ith}.self_attn.running_keys"] = torch.zeros((0, model.d_model))
+        state_dict[f"decoder.layers.{ith}.self_attn.running_values"] = torch.zeros((0, model.d_model))
+
+    return state_dict
+
+def build_task(model, checkpoint_path: str):
+    # load_checkpoint only needs the model and the checkpoint files, not the datasets
+    task = BaseTask.__new__(BaseTask)
+    task.model = model
+    task.device = torch.device("cpu")
+    task.checkpoint_path = checkpoint_path
+    task.checkpoint_writer = CheckpointWriter()
+
+    return task
+
+def test_loads_baseline_checkpoint(tmp_path):
+    model = build_tiny_model()
+    torch.save({"epoch": 3, "state_dict": to_baseline_format(model)}, os.path.join(tmp_path, "last_model.pth"))
+
+    loaded = build_tiny_model(seed=1)
+    checkpoint = build_task(loaded, str(tmp_path)).load_checkpoint("last_model", weights_only=True)
+
+    assert checkpoint["epoch"] == 3
+    for name, value in model.state_dict().items():
+        torch.testing.assert_close(loaded.state_dict()[name], value, msg=name)
+
+def test_raises_on_unloaded_weights(tmp_path):
+    model = build_tiny_model()
+    state_dict = model.state_dict()
+    del state_dict["decoder.fc.weight"]
+    torch.save({"epoch": 3, "state_dict": state_dict}, os.path.join(tmp_path, "last_model.pth"))
+
+    with pytest.raises(RuntimeError, match="decoder.fc.weight"):
+        build_task(build_tiny_model(), str(tmp_path)).load_checkpoint("last_model", weights_only=True)
+
+def build_training_task(checkpoint_path: str):
+    # save_checkpoint also needs the optimizer and the scheduler
+    task = build_task(build_tiny_model(), checkpoint_path)
+    task.rank = 0
+    task.epoch = 2
+    task.model.train()
+    task.optim = Adam(task.model.parameters(), lr=1e-3)
+    task.scheduler = LambdaLR(task.optim, lambda step: 1.)
+    # one step so that the optimizer holds its moments
+    task.model.decoder.fc.weight.sum().backward()
+    task.optim.step()
+    task.scheduler.step()
+
+    return task
+
+def assert_same_state(loaded, expected):
+    assert loaded.keys() == expected.keys()
+    for key, value in expected.items():
+        if isinstance(value, torch.Tensor):
+            torch.testing.assert_close(loaded[key], value, msg=key)
+        elif isinstance(value, dict):
+            assert_same_state(loaded[key], value)
+        else:
+            assert loaded[key] == value, key
+
+def test_saved_checkpoint_round_trip(tmp_path):
+    task = build_training_task(str(tmp_path))
+    state_dict = {name: value.clone() for name, value in task.model.state_dict().items()}
+    optimizer_state = task.optim.state_dict()
+
+    task.save_checkpoint({"best_val_score": .5})
+    task.promote_checkpoint("last_model", "best_model")
+    # training goes on while the checkpoint is written from its snapshot
+    with torch.no_grad():
+        for param in task.model.parameters():
+            param.add_(1.)
+    task.checkpoint_writer.wait()
+
+    # the best model is a hardlink to the files of the last one, not a copy
+    for last_file, best_file in zip(checkpoint_files(os.path.join(tmp_path, "last_model")), 
+                                    checkpoint_files(os.path.join(tmp_path, "best_model"))):
+        assert os.path.samefile(last_file, best_file)
+    checkpoint = read_checkpoint(os.path.join(tmp_path, "best_model"))
+    assert checkpoint["epoch"] == 2 and checkpoint["best_val_score"] == .5
+    assert_same_state(checkpoint["state_dict"], state_dict)
+    assert_same_state(checkpoint["optimizer"], optimizer_state)
+    assert checkpoint["scheduler"]["last_epoch"] == 1
+    # the weights-only read leaves the optimizer state on disk
+    assert read_checkpoint(os.path.join(tmp_path, "best_model"), ("state_dict", "epoch")).keys() == {"state_dict", "epoch"}
+
+    loaded = build_task(build_tiny_model(seed=1), str(tmp_path))
+    loaded.load_checkpoint("best_model", weights_only=True)
+    assert_same_state(loaded.model.state_dict(), state_dict)
+
+def test_checkpoint_in_flight_is_not_read(tmp_path, monkeypatch):
+    task = build_training_task(str(tmp_path))
+    stem = os.path.join(tmp_path, "last_model")
+    task.save_checkpoint({})
+    task.checkpoint_writer.wait()
+
+    # the next write is held before its weights are written
+    release = threading.Event()
+    save_file = utils.checkpoint.save_file
+    def held_save_file(*args, **kwargs):
+        release.wait()
+        save_file(*args, **kwargs)
+    monkeypatch.setattr(utils.checkpoint, "save_file", held_save_file)
+    task.epoch = 3
+    task.save_checkpoint({})
+
+    # other readers keep seeing the previous checkpoint until the new one replaces it
+    assert checkpoint_exists(stem)
+    assert read_checkpoint(stem, ("epoch", ))["epoch"] == 2
+
+    # the process writing the checkpoint waits for it before loading
+    loaded = {}
+    reader = threading.Thread(target=lambda: loaded.update(task.load_checkpoint("last_model", weights_only=True)))
+    reader.start()
+    reader.join(timeout=.5)
+    assert reader.is_alive() and len(loaded) == 0
+    release.set()
+    reader.join()
+
+    assert loaded["epoch"] == 3
@@ -0,0 +1,32 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import random
+
+from evaluation import Cider, CiderReward
+
+WORDS = ["màu", "xanh", "đỏ", "con", "mèo", "chó", "hai", "ba", "trên", "bàn"]
+
+def random_sentence(rng, words=WORDS):
+    return " ".join(rng.choice(words) for _ in range(rng.randint(1, 6)))
+
+def test_rewards_match_cider():
+    rng = random.Random(0)
+    references = {str(key): [random_sentence(rng) for _ in range(rng.randint(1, 3))] for key in range(20)}
+    cider = Cider(references)
+    cider_reward = CiderReward(references)
+
+    # sampled answers, references themselves, and words which appear in no reference
+    keys = [rng.choice(list(references)) for _ in range(40)]
+    hypotheses = [random_sentence(rng) for _ in range(30)] + \
+                    [references[key][0] for key in keys[30:35]] + \
+                    [random_sentence(rng, ["ngoài", "tập", "từ"]) for _ in range(5)]
+
+    gens = {str(ith): [hypothesis, ] for ith, hypothesis in enumerate(hypotheses)}
+    gts = {str(ith): references[key] for ith, key in enumerate(keys)}
+    score, scores = cider.compute_score(gts, gens)
+    reward, rewards = cider_reward.compute_score(keys, hypotheses)
+
+    np.testing.assert_allclose(rewards, scores, rtol=1e-9, atol=1e-9)
+    assert reward == pytest.approx(score)
@@ -0,0 +1,93 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import json
+import os
+from torch import nn
+from torch.utils.data import DataLoader
+from types import SimpleNamespace
+
+import evaluation
+from data_utils.utils import collate_fn
+from tasks.classification_task import ClassificationTask
+from utils.instance import Instance
+
+ANSWERS = ["yes", "no", "red", "blue"]
+
+class AnswerVocab(object):
+    padding_idx = 0
+
+    def decode_answer(self, answer_vecs, join_word=False):
+        return [ANSWERS[idx] for idx in answer_vecs.tolist()]
+
+class FixedAnswers(nn.Module):
+    '''
+        Predicts answer_logits[question_id] for every row of a question.
+    '''
+    def __init__(self, answer_logits):
+        super().__init__()
+
+        self.answer_logits = answer_logits
+
+    def forward(self, items):
+        return torch.stack([self.answer_logits[question_id] for question_id in items.question_id])
+
+def build_samples():
+    # as FeatureClassificationDataset emits them: one row per answer, the rows of a question share its id
+    rows = [(7, 0), (7, 1), (7, 1), (9, 2), (9, 3), (11, 0)]
+    samples = [Instance(sample_idx=idx, question_id=question_id, filename=f"{question_id}.jpg",
+                        question_tokens=torch.tensor([5, 6, 0]), answer_tokens=torch.tensor([answer]))
+                    for idx, (question_id, answer) in enumerate(rows)]
+    # DistributedSampler repeats the first samples to even out the shards
+    samples.append(samples[0])
+
+    return rows, samples
+
+def build_task(tmp_path, samples):
+    task = ClassificationTask.__new__(ClassificationTask)
+    task.distributed = False
+    task.rank = 0
+    task.world_size = 1
+    task.epoch = 0
+    task.device = torch.device("cpu")
+    task.precision = "float32"
+    task.vocab = AnswerVocab()
+    task.checkpoint_path = str(tmp_path)
+    task.config = SimpleNamespace(TRAINING=SimpleNamespace(VERBOSE_SCORES=["Accuracy", "F1"]))
+    # question 7 is answered "no", question 9 "red" and question 11 "yes"
+    task.model = FixedAnswers({7: torch.tensor([0., 1., 0., 0.]), 9: torch.tensor([0., 0., 1., 0.]),
+                                11: torch.tensor([1., 0., 0., 0.])})
+    task.test_dataloader = DataLoader(samples, batch_size=1, collate_fn=collate_fn)
+    task.has_checkpoint = lambda name: True
+    task.load_checkpoint = lambda name, weights_only=False: None
+
+    return task
+
+def expected_scores(rows):
+    predicted = {7: "no", 9: "red", 11: "yes"}
+    gts = {str(idx): [ANSWERS[answer]] for idx, (_, answer) in enumerate(rows)}
+    gens = {str(idx): [predicted[question_id]] for idx, (question_id, _) in enumerate(rows)}
+
+    return evaluation.compute_scores(gts, gens)[0]
+
+def test_evaluate_metrics_scores_every_answer_row(tmp_path):
+    rows, samples = build_samples()
+    task = build_task(tmp_path, samples)
+
+    scores = task.evaluate_metrics(DataLoader(samples, batch_size=3, collate_fn=collate_fn))
+
+    assert scores == expected_scores(rows)
+
+def test_get_predictions_keeps_every_answer_row(tmp_path):
+    rows, samples = build_samples()
+    task = build_task(tmp_path, samples)
+
+    task.get_predictions()
+
+    test_results = json.load(open(os.path.join(tmp_path, "test_results.json")))
+    # one result per row, the repeated sample only once
+    assert [result["id"] for result in test_results["results"]] == [[question_id] for question_id, _ in rows]
+    expected = expected_scores(rows)
+    for name in ("Accuracy", "F1"):
+        assert test_results[name] == pytest.approx(expected[name])
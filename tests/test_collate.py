@@ -0,0 +1,59 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from data_utils.utils import collate_fn
+from utils.instance import Instance
+
+PADDING_IDX = 0
+MAX_LEN = 12
+
+def padded(tokens):
+    # the datasets pad the tokens to the max lengths of the vocab
+    return torch.tensor(tokens + [PADDING_IDX] * (MAX_LEN - len(tokens)))
+
+def build_samples(questions, answers):
+    return [Instance(question_tokens=padded(question), answer_tokens=padded(answer), 
+                     shifted_right_answer_tokens=padded(answer[1:]))
+                for question, answer in zip(questions, answers)]
+
+@pytest.mark.parametrize("pad_to_multiple_of, question_width, answer_width", [(1, 5, 3), (4, 8, 4), (8, 8, 8)])
+def test_trimmed_widths_round_up(pad_to_multiple_of, question_width, answer_width):
+    samples = build_samples(questions=[[4, 5, 6, 7, 8], [4, 5]], answers=[[1, 9, 2], [1, 2]])
+
+    batch = collate_fn(samples, padding_idx=PADDING_IDX, trim_padding=True, pad_to_multiple_of=pad_to_multiple_of)
+
+    assert batch.question_tokens.shape == (2, question_width)
+    assert batch.answer_tokens.shape == (2, answer_width)
+    # nothing but padding was cut
+    assert torch.equal(batch.question_tokens, torch.stack([sample.question_tokens for sample in samples])[:, :question_width])
+    assert batch.question_lengths.tolist() == [5, 2]
+    assert batch.answer_lengths.tolist() == [3, 2]
+
+def test_shifted_answers_are_trimmed_with_the_answers():
+    samples = build_samples(questions=[[4, 5], [4, 5, 6]], answers=[[1, 9, 10, 2], [1, 11, 2]])
+
+    batch = collate_fn(samples, padding_idx=PADDING_IDX, trim_padding=True, pad_to_multiple_of=1)
+
+    assert batch.shifted_right_answer_tokens.shape == batch.answer_tokens.shape == (2, 4)
+    assert batch.shifted_right_answer_tokens.tolist() == [[9, 10, 2, 0], [11, 2, 0, 0]]
+    assert batch.answer_tokens.tolist() == [[1, 9, 10, 2], [1, 11, 2, 0]]
+
+def test_untrimmed_batches_keep_the_vocab_max_lengths():
+    samples = build_samples(questions=[[4, 5], [4, 5, 6]], answers=[[1, 9, 10, 2], [1, 11, 2]])
+
+    batch = collate_fn(samples, padding_idx=PADDING_IDX)
+
+    assert batch.question_tokens.shape == batch.answer_tokens.shape == batch.shifted_right_answer_tokens.shape == (2, MAX_LEN)
+    assert batch.question_lengths.tolist() == [2, 3]
+
+def test_lengths_with_padding_ids_inside_the_sequences():
+    # a token equal to padding_idx inside a sequence does not end it
+    samples = build_samples(questions=[[4, PADDING_IDX, 6, 7], [PADDING_IDX, 5]], answers=[[1, PADDING_IDX, 9, 2], [1, 2]])
+
+    batch = collate_fn(samples, padding_idx=PADDING_IDX, trim_padding=True, pad_to_multiple_of=1)
+
+    assert batch.question_lengths.tolist() == [4, 2]
+    assert batch.answer_lengths.tolist() == [4, 2]
+    assert batch.question_tokens.tolist() == [[4, PADDING_IDX, 6, 7], [PADDING_IDX, 5, PADDING_IDX, PADDING_IDX]]
+    assert batch.answer_tokens.tolist() == [[1, PADDING_IDX, 9, 2], [1, 2, PADDING_IDX, PADDING_IDX]]
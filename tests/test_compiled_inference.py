@@ -0,0 +1,47 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from builders.model_builder import build_model
+from utils.instance import InstanceList
+from tests.helpers import TinyVocab, tiny_model_config
+
+@pytest.fixture
+def eager_compile(monkeypatch):
+    # dynamo traces the graphs as in inference, without the code generation of the default backend
+    compile = torch.compile
+    monkeypatch.setattr(torch, "compile", lambda fn, **kwargs: compile(fn, backend="eager", **kwargs))
+
+def build_inputs(vocab):
+    items = InstanceList()
+    items.region_features = torch.randn(3, 7, 8)
+    items.region_lengths = torch.tensor([7, 4, 5])
+    items.question_lengths = torch.tensor([5, 3, 4])
+    question_tokens = torch.randint(4, len(vocab), (3, 5))
+    items.question_tokens = question_tokens.masked_fill(torch.arange(5) >= items.question_lengths[:, None], vocab.padding_idx)
+
+    return items
+
+def decode(model, items, beam_size, compile_inference):
+    model.compile_inference = compile_inference
+    with torch.no_grad():
+        if beam_size == 1:
+            return model.greedy_decode(items, batch_size=items.batch_size)
+        return model.beam_search(items, batch_size=items.batch_size, beam_size=beam_size, out_size=beam_size)
+
+@pytest.mark.parametrize("beam_size", [1, 3])
+def test_compiled_step_matches_stateful_decoder(eager_compile, beam_size):
+    torch.manual_seed(0)
+    vocab = TinyVocab()
+    model = build_model(tiny_model_config(), vocab).eval()
+    items = build_inputs(vocab)
+
+    outs, log_probs = decode(model, items, beam_size, compile_inference=False)
+    compiled_outs, compiled_log_probs = decode(model, items, beam_size, compile_inference=True)
+    # the graphs are reused by the next decode
+    compiled_outs, compiled_log_probs = decode(model, items, beam_size, compile_inference=True)
+
+    assert torch.equal(compiled_outs, outs)
+    torch.testing.assert_close(compiled_log_probs, log_probs, atol=1e-5, rtol=1e-5)
+    # the explicit caches are not part of the checkpoints
+    assert not any(name.startswith("step_") for name in model.state_dict())
@@ -0,0 +1,54 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from types import SimpleNamespace
+
+from models.modules.decoders import DecoderLayer
+from models.utils import generate_padding_mask_from_lengths, generate_sequential_mask
+from tests.helpers import attention_config
+
+def build_layer():
+    torch.manual_seed(0)
+    config = SimpleNamespace(SELF_ATTENTION=attention_config(CAN_BE_STATEFUL=True), ENC_ATTENTION=attention_config())
+
+    return DecoderLayer(config, max_len=8).eval()
+
+def test_decoding_with_projected_encoder_states_matches_full_forward():
+    # 2 samples of 3 beams, the encoder states are kept once per sample
+    layer = build_layer()
+    beam_size = 3
+    x = torch.randn(6, 5, 16)
+    encoder_features = torch.randn(2, 7, 16)
+    encoder_mask = generate_padding_mask_from_lengths(torch.tensor([7, 4]), 7)
+    reorder = torch.tensor([1, 2, 0, 5, 3, 4])
+
+    with torch.no_grad():
+        outs = []
+        with layer.statefulness(x.shape[0]):
+            for t in range(x.shape[1]):
+                outs.append(layer(x[:, t:t+1], encoder_features, encoder_features, None, encoder_mask))
+                # beam search regathers the beams within each sample, the encoder states are left as they are
+                layer.apply_to_states(lambda s: s[reorder], include_beam_invariant=False)
+                x = x[reorder]
+                outs = [out[reorder] for out in outs]
+        cached = torch.cat(outs, dim=1)
+
+        full = layer(x, encoder_features.repeat_interleave(beam_size, dim=0), encoder_features.repeat_interleave(beam_size, dim=0),
+                        generate_sequential_mask(5), encoder_mask.repeat_interleave(beam_size, dim=0))
+
+    torch.testing.assert_close(cached, full, atol=1e-5, rtol=1e-5)
+
+def test_encoder_states_are_projected_once():
+    layer = build_layer()
+    calls = []
+    project_keys_values = layer.enc_attn.attention.project_keys_values
+    layer.enc_attn.attention.project_keys_values = lambda *args: calls.append(None) or project_keys_values(*args)
+    x = torch.randn(2, 4, 16)
+    encoder_features = torch.randn(2, 7, 16)
+
+    with torch.no_grad(), layer.statefulness(x.shape[0]):
+        for t in range(x.shape[1]):
+            layer(x[:, t:t+1], encoder_features, encoder_features, None, None)
+
+    assert len(calls) == 1
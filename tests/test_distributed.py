@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import os
+from torch import nn
+from torch import distributed as dist
+from torch import multiprocessing as mp
+
+from tasks.base_task import BaseTask
+
+WORLD_SIZE = 2
+
+def build_task(distributed: bool, rank: int=0, world_size: int=1):
+    task = BaseTask.__new__(BaseTask)
+    task.distributed = distributed
+    task.rank = rank
+    task.world_size = world_size
+
+    return task
+
+def reduce_on_rank(rank: int, init_file: str, result_file: str):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+    torch.manual_seed(0)
+    task = build_task(True, rank, WORLD_SIZE)
+    task.model = nn.Sequential(nn.Linear(3, 4), nn.Linear(4, 2))
+
+    # rank 1 leaves the second layer without gradient, as a parameter unused by its loss
+    layer = task.model if rank == 0 else task.model[0]
+    (layer(torch.full((2, 3), float(rank + 1))).sum() * (rank + 1)).backward()
+    task.all_reduce_gradients()
+
+    if rank == 0:
+        torch.save([p.grad for p in task.model.parameters()], result_file)
+    dist.destroy_process_group()
+
+def test_all_reduce_gradients_averages_over_ranks(tmp_path):
+    init_file = os.path.join(tmp_path, "init")
+    result_file = os.path.join(tmp_path, "grads.pth")
+    mp.spawn(reduce_on_rank, args=(init_file, result_file), nprocs=WORLD_SIZE)
+
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(3, 4), nn.Linear(4, 2))
+    model(torch.full((2, 3), 1.)).sum().backward()
+    expected = [p.grad.clone() for p in model.parameters()]
+    model.zero_grad(set_to_none=True)
+    (model[0](torch.full((2, 3), 2.)).sum() * 2).backward()
+    expected = [(g + (p.grad if p.grad is not None else 0)) / WORLD_SIZE for g, p in zip(expected, model.parameters())]
+
+    for grad, expected_grad in zip(torch.load(result_file), expected):
+        torch.testing.assert_close(grad, expected_grad)
+
+def test_lambda_lr_does_not_depend_on_the_number_of_ranks():
+    single = build_task(False)
+    distributed = build_task(True, world_size=4)
+    for task in (single, distributed):
+        task.warmup = 100
+        task.model = nn.Module()
+        task.model.d_model = 16
+
+    # a run resumed with another number of ranks continues at the same point of the schedule
+    for step in (0, 9, 99, 1000):
+        assert distributed.lambda_lr(step) == single.lambda_lr(step)
+    # the learning rate peaks at the end of the warmup, counted in optimizer steps
+    assert single.lambda_lr(98) > single.lambda_lr(97)
+    assert single.lambda_lr(99) > single.lambda_lr(100)
@@ -0,0 +1,50 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.modules.attentions import AugmentedGeometryScaledDotProductAttention, ScaledDotProductAttention
+from tests.helpers import attention_config
+
+def test_separate_qkv_checkpoint_is_fused():
+    torch.manual_seed(0)
+    attention = ScaledDotProductAttention(attention_config())
+    q_end = attention.h * attention.d_k
+    k_end = 2 * attention.h * attention.d_k
+    state_dict = {"fc_o.weight": torch.randn(16, 16), "fc_o.bias": torch.randn(16)}
+    for fc in ("fc_q", "fc_k", "fc_v"):
+        state_dict[f"{fc}.weight"] = torch.randn(16, 16)
+        state_dict[f"{fc}.bias"] = torch.randn(16)
+
+    incompatible_keys = attention.load_state_dict(dict(state_dict), strict=False)
+
+    assert incompatible_keys.missing_keys == [] and incompatible_keys.unexpected_keys == []
+    for fc, (start, end) in zip(("fc_q", "fc_k", "fc_v"), ((0, q_end), (q_end, k_end), (k_end, None))):
+        torch.testing.assert_close(attention.fc_qkv.weight[start:end], state_dict[f"{fc}.weight"])
+        torch.testing.assert_close(attention.fc_qkv.bias[start:end], state_dict[f"{fc}.bias"])
+
+    # the outputs are the ones of the separate layers
+    x = torch.randn(2, 5, 16)
+    memory = torch.randn(2, 7, 16)
+    q = torch.nn.functional.linear(x, state_dict["fc_q.weight"], state_dict["fc_q.bias"]).view(2, 5, 2, 8).permute(0, 2, 1, 3)
+    k = torch.nn.functional.linear(memory, state_dict["fc_k.weight"], state_dict["fc_k.bias"]).view(2, 7, 2, 8).permute(0, 2, 1, 3)
+    v = torch.nn.functional.linear(memory, state_dict["fc_v.weight"], state_dict["fc_v.bias"]).view(2, 7, 2, 8).permute(0, 2, 1, 3)
+    att = torch.softmax(q @ k.transpose(-2, -1) / 8 ** 0.5, dim=-1)
+    expected = torch.nn.functional.linear((att @ v).permute(0, 2, 1, 3).reshape(2, 5, 16), state_dict["fc_o.weight"], state_dict["fc_o.bias"])
+    with torch.no_grad():
+        torch.testing.assert_close(attention(x, memory, memory)[0], expected)
+
+def test_per_head_geometry_checkpoint_is_fused():
+    torch.manual_seed(0)
+    attention = AugmentedGeometryScaledDotProductAttention(attention_config(TRIGNOMETRIC_EMBEDDING=True))
+    state_dict = {key: value for key, value in attention.state_dict().items() if not key.startswith("fc_g.")}
+    d_g = attention.fc_g.in_features
+    for ith in range(attention.h):
+        state_dict[f"fc_gs.{ith}.weight"] = torch.randn(1, d_g)
+        state_dict[f"fc_gs.{ith}.bias"] = torch.randn(1)
+
+    incompatible_keys = attention.load_state_dict(dict(state_dict), strict=False)
+
+    assert incompatible_keys.missing_keys == [] and incompatible_keys.unexpected_keys == []
+    for ith in range(attention.h):
+        torch.testing.assert_close(attention.fc_g.weight[ith:ith+1], state_dict[f"fc_gs.{ith}.weight"])
+        torch.testing.assert_close(attention.fc_g.bias[ith:ith+1], state_dict[f"fc_gs.{ith}.bias"])
@@ -0,0 +1,60 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.modules.attentions import AugmentedGeometryScaledDotProductAttention
+from models.utils import box_relational_embedding, generate_padding_mask_from_lengths
+from tests.helpers import attention_config
+
+def build_attention(trignometric_embedding: bool, chunk_size: int=None):
+    torch.manual_seed(0)
+    config = attention_config(TRIGNOMETRIC_EMBEDDING=trignometric_embedding)
+    if chunk_size is not None:
+        config.GEOMETRY_CHUNK_SIZE = chunk_size
+
+    return AugmentedGeometryScaledDotProductAttention(config).eval()
+
+def random_boxes(bs: int, n: int):
+    corners = torch.rand(bs, n, 2, 2) * 100
+
+    return torch.cat([corners.min(dim=2).values, corners.max(dim=2).values], dim=-1)
+
+@pytest.mark.parametrize("trignometric_embedding", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 3, 16])
+def test_chunked_geometry_matches_full_embedding(trignometric_embedding, chunk_size):
+    attention = build_attention(trignometric_embedding)
+    chunked_attention = build_attention(trignometric_embedding, chunk_size)
+    boxes = random_boxes(2, 10)
+    x = torch.randn(2, 10, 16)
+    attention_mask = generate_padding_mask_from_lengths(torch.tensor([10, 6]), 10)
+
+    with torch.no_grad():
+        out, att = attention(x, x, x, attention_mask=attention_mask, boxes=boxes)
+        chunked_out, chunked_att = chunked_attention(x, x, x, attention_mask=attention_mask, boxes=boxes)
+
+    torch.testing.assert_close(chunked_out, out)
+    torch.testing.assert_close(chunked_att, att)
+
+@pytest.mark.parametrize("trignometric_embedding", [True, False])
+def test_shared_embedding_matches_per_layer_embedding(trignometric_embedding):
+    attention = build_attention(trignometric_embedding)
+    boxes = random_boxes(2, 10)
+    x = torch.randn(2, 10, 16)
+
+    with torch.no_grad():
+        out, _ = attention(x, x, x, boxes=boxes)
+        relative_geometry_embeddings = box_relational_embedding(boxes, dim_g=attention.d_g, trignometric_embedding=trignometric_embedding)
+        shared_out, _ = attention(x, x, x, relative_geometry_embeddings=relative_geometry_embeddings)
+
+    torch.testing.assert_close(shared_out, out)
+
+def test_fused_heads_match_per_head_layers():
+    # the former h separate nn.Linear(d_g, 1), one per head
+    attention = build_attention(True)
+    boxes = random_boxes(2, 10)
+    relative_geometry_embeddings = box_relational_embedding(boxes, dim_g=attention.d_g, trignometric_embedding=True)
+
+    with torch.no_grad():
+        expected = torch.stack([torch.relu(relative_geometry_embeddings @ attention.fc_g.weight[ith] + attention.fc_g.bias[ith])
+                                    for ith in range(attention.h)], dim=1)
+        torch.testing.assert_close(attention.geometry_weights(boxes), expected)
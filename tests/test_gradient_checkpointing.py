@@ -0,0 +1,85 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.nn import functional as F
+
+import models.utils
+from builders.model_builder import build_model
+from utils.instance import InstanceList
+from tests.helpers import TinyVocab, tiny_model_config
+
+@pytest.fixture
+def checkpointed_layers(monkeypatch):
+    # the layers run by torch.utils.checkpoint
+    layers = []
+    checkpoint = models.utils.checkpoint
+    def recording_checkpoint(layer, **kwargs):
+        layers.append(layer)
+        return checkpoint(layer, **kwargs)
+    monkeypatch.setattr(models.utils, "checkpoint", recording_checkpoint)
+
+    return layers
+
+def build_model_pair(vocab):
+    config = tiny_model_config()
+    torch.manual_seed(0)
+    model = build_model(config, vocab)
+    for node in (config.SELF_ENCODER, config.GUIDED_ENCODER, config.DECODER):
+        node.GRADIENT_CHECKPOINTING = True
+    checkpointed = build_model(config, vocab)
+    checkpointed.load_state_dict(model.state_dict())
+
+    return model, checkpointed
+
+def build_inputs(vocab):
+    torch.manual_seed(1)
+    items = InstanceList()
+    items.region_features = torch.randn(3, 7, 8)
+    items.region_lengths = torch.tensor([7, 4, 5])
+    items.question_lengths = torch.tensor([5, 3, 4])
+    question_tokens = torch.randint(4, len(vocab), (3, 5))
+    items.question_tokens = question_tokens.masked_fill(torch.arange(5) >= items.question_lengths[:, None], vocab.padding_idx)
+    answer_tokens = torch.randint(4, len(vocab), (3, 4))
+    items.answer_tokens = answer_tokens.masked_fill(torch.arange(4) >= torch.tensor([[4], [2], [3]]), vocab.padding_idx)
+    items.shifted_right_answer_tokens = torch.cat([items.answer_tokens[:, 1:], torch.zeros((3, 1), dtype=torch.long)], dim=-1)
+
+    return items
+
+def training_loss(model, items, vocab):
+    out = model(items)
+
+    return F.nll_loss(out.view(-1, out.shape[-1]), items.shifted_right_answer_tokens.view(-1), ignore_index=vocab.padding_idx)
+
+def test_checkpointed_layers_match_the_plain_forward(checkpointed_layers):
+    vocab = TinyVocab()
+    model, checkpointed = build_model_pair(vocab)
+    items = build_inputs(vocab)
+
+    loss = training_loss(model.train(), items, vocab)
+    loss.backward()
+    assert len(checkpointed_layers) == 0
+    checkpointed_loss = training_loss(checkpointed.train(), items, vocab)
+    checkpointed_loss.backward()
+
+    # the layers of the encoders and of the decoder were recomputed in backward
+    assert any(layer in list(checkpointed.decoder.modules()) for layer in checkpointed_layers)
+    assert any(layer in list(checkpointed.self_encoder.modules()) for layer in checkpointed_layers)
+    torch.testing.assert_close(checkpointed_loss, loss)
+    for (name, param), checkpointed_param in zip(model.named_parameters(), checkpointed.parameters()):
+        if param.grad is None:
+            assert checkpointed_param.grad is None, name
+        else:
+            torch.testing.assert_close(checkpointed_param.grad, param.grad, msg=name)
+
+def test_no_checkpointing_in_eval_or_without_gradients(checkpointed_layers):
+    vocab = TinyVocab()
+    _, checkpointed = build_model_pair(vocab)
+    items = build_inputs(vocab)
+
+    training_loss(checkpointed.eval(), items, vocab)
+    with torch.no_grad():
+        training_loss(checkpointed.train(), items, vocab)
+        checkpointed.eval().greedy_decode(items, batch_size=items.batch_size)
+
+    assert len(checkpointed_layers) == 0
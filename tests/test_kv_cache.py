@@ -0,0 +1,77 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.modules.attentions import MultiHeadAttention
+from models.utils import generate_sequential_mask
+from tests.helpers import attention_config
+
+def build_attention(seed: int=0):
+    torch.manual_seed(seed)
+
+    return MultiHeadAttention(attention_config(CAN_BE_STATEFUL=True), max_len=8).eval()
+
+def decode_step_by_step(attention, x, reorder=None):
+    outs = []
+    with attention.statefulness(x.shape[0]):
+        for t in range(x.shape[1]):
+            token = x[:, t:t+1]
+            outs.append(attention(token, token, token, attention_mask=None))
+            if reorder is not None:
+                attention.apply_to_states(lambda s: s[reorder])
+                x = x[reorder]
+                outs = [out[reorder] for out in outs]
+
+    return torch.cat(outs, dim=1)
+
+@pytest.mark.parametrize("grad_enabled", [False, True])
+def test_cached_decoding_matches_full_forward(grad_enabled):
+    attention = build_attention()
+    x = torch.randn(3, 5, 16)
+
+    with torch.set_grad_enabled(grad_enabled):
+        full = attention(x, x, x, attention_mask=generate_sequential_mask(5))
+        cached = decode_step_by_step(attention, x)
+
+    torch.testing.assert_close(cached, full, atol=1e-5, rtol=1e-5)
+
+@pytest.mark.parametrize("grad_enabled", [False, True])
+def test_cached_decoding_with_beam_reorder(grad_enabled):
+    attention = build_attention()
+    x = torch.randn(4, 5, 16)
+    reorder = torch.tensor([2, 0, 3, 1])
+
+    with torch.set_grad_enabled(grad_enabled):
+        cached = decode_step_by_step(attention, x, reorder)
+        # reordering every step permutes the whole sequence the same way, which the full forward sees directly
+        permuted = x
+        for _ in range(5):
+            permuted = permuted[reorder]
+        full = attention(permuted, permuted, permuted, attention_mask=generate_sequential_mask(5))
+
+    torch.testing.assert_close(cached, full, atol=1e-5, rtol=1e-5)
+
+def test_backward_through_cached_decoding():
+    # self-critical training decodes with gradients then back-propagates through all the steps
+    attention = build_attention()
+    attention.train()
+    x = torch.randn(4, 5, 16, requires_grad=True)
+
+    out = decode_step_by_step(attention, x, torch.tensor([1, 0, 3, 2]))
+    out.sum().backward()
+
+    assert x.grad is not None
+    assert all(p.grad is not None for p in attention.attention.parameters())
+
+def test_loads_state_dict_with_legacy_running_buffers():
+    # the stateful layers registered running_keys and running_values as (0, d_model) buffers before the cache
+    attention = build_attention()
+    state_dict = attention.state_dict()
+    state_dict["running_keys"] = torch.zeros((0, 16))
+    state_dict["running_values"] = torch.zeros((0, 16))
+
+    loaded = build_attention(seed=1)
+    incompatible_keys = loaded.load_state_dict(state_dict, strict=True)
+
+    assert len(incompatible_keys.missing_keys) == 0 and len(incompatible_keys.unexpected_keys) == 0
+    assert loaded.running_keys is None and loaded.running_values is None
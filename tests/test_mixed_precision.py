@@ -0,0 +1,79 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.nn import NLLLoss
+from torch.optim import Adam
+from torch.optim.lr_scheduler import LambdaLR
+from torch.utils.data import DataLoader
+
+from builders.model_builder import build_model
+from tasks.open_ended_task import OpenEndedTask
+from utils.instance import InstanceList
+from tests.helpers import TinyVocab, tiny_model_config
+
+def build_inputs(vocab):
+    torch.manual_seed(1)
+    items = InstanceList()
+    items.region_features = torch.randn(3, 7, 8)
+    items.region_lengths = torch.tensor([7, 4, 5])
+    items.question_lengths = torch.tensor([5, 3, 4])
+    question_tokens = torch.randint(4, len(vocab), (3, 5))
+    items.question_tokens = question_tokens.masked_fill(torch.arange(5) >= items.question_lengths[:, None], vocab.padding_idx)
+    answer_tokens = torch.randint(4, len(vocab), (3, 4))
+    items.answer_tokens = answer_tokens.masked_fill(torch.arange(4) >= torch.tensor([[4], [2], [3]]), vocab.padding_idx)
+    items.shifted_right_answer_tokens = torch.cat([items.answer_tokens[:, 1:], torch.zeros((3, 1), dtype=torch.long)], dim=-1)
+
+    return items
+
+def build_task(precision: str):
+    task = OpenEndedTask.__new__(OpenEndedTask)
+    vocab = TinyVocab()
+    torch.manual_seed(0)
+    task.model = build_model(tiny_model_config(), vocab)
+    task.training_model = task.model
+    task.device = torch.device("cpu")
+    task.precision = precision
+    task.epoch = 0
+    task.log_every = 50
+    task.optim = Adam(task.model.parameters(), lr=1e-3)
+    task.scheduler = LambdaLR(task.optim, lambda step: 1.)
+    task.loss_fn = NLLLoss(ignore_index=vocab.padding_idx)
+    # a single batch, already collated
+    task.train_dataloader = DataLoader([build_inputs(vocab)], batch_size=None, collate_fn=lambda items: items)
+
+    return task
+
+def record_dtypes(task):
+    # the dtypes of the output projection of the decoder and of the losses
+    dtypes = {"projection": [], "loss": []}
+    task.model.decoder.fc.register_forward_hook(lambda module, inputs, output: dtypes["projection"].append(output.dtype))
+    task.loss_fn.register_forward_hook(lambda module, inputs, output: dtypes["loss"].append(output.dtype))
+
+    return dtypes
+
+@pytest.mark.parametrize("precision, compute_dtype", [("bfloat16", torch.bfloat16), ("float32", torch.float32)])
+def test_autocast_in_training_and_evaluation(precision, compute_dtype):
+    task = build_task(precision)
+    dtypes = record_dtypes(task)
+
+    task.train()
+    task.evaluate_loss(task.train_dataloader)
+
+    assert dtypes["projection"] == [compute_dtype, compute_dtype]
+    # the log-probabilities are computed in float32, so are the losses
+    assert dtypes["loss"] == [torch.float32, torch.float32]
+    # the optimizer steps on float32 parameters
+    assert all(param.dtype == torch.float32 for param in task.model.parameters())
+
+def test_float32_precision_is_a_no_op():
+    task = build_task("float32")
+    items = build_inputs(TinyVocab())
+    task.model.eval()
+
+    with torch.no_grad():
+        out = task.model(items)
+        with task.autocast():
+            autocast_out = task.model(items)
+
+    assert torch.equal(autocast_out, out)
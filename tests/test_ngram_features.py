@@ -0,0 +1,31 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.utils import accumulate_ngram_features
+
+def loop_ngram_features(ngrams_features, ngrams):
+    '''
+        The former per-token loop, over the sequence length and with the n-gram sizes as window sizes.
+    '''
+    unigram_features = ngrams_features[0].clone()
+    for ith in range(unigram_features.shape[1]):
+        for ngram, features in zip(ngrams[1:], ngrams_features[1:]):
+            for prev_ith in range(max(0, ith - ngram + 1), min(ith + 1, features.shape[1])):
+                unigram_features[:, ith] += features[:, prev_ith]
+
+    return unigram_features
+
+@pytest.mark.parametrize("ngrams", [[1], [1, 2], [1, 2, 3], [1, 3, 5]])
+def test_accumulation_matches_loop(ngrams):
+    torch.manual_seed(0)
+    seq_len = 7
+    ngrams_features = [torch.randn(2, seq_len - ngram + 1, 16) for ngram in ngrams]
+    inputs = [features.clone() for features in ngrams_features]
+
+    out = accumulate_ngram_features(ngrams_features, ngrams)
+
+    torch.testing.assert_close(out, loop_ngram_features(ngrams_features, ngrams))
+    # the outputs of the convolutions are left untouched
+    for features, expected in zip(ngrams_features, inputs):
+        torch.testing.assert_close(features, expected)
@@ -0,0 +1,54 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from builders.model_builder import build_model
+from models.onnx_export import export_onnx
+from utils.instance import InstanceList
+from utils.onnx_predictor import OnnxPredictor
+from tests.helpers import TinyVocab, tiny_model_config
+
+@pytest.fixture(scope="module")
+def exported(tmp_path_factory):
+    torch.manual_seed(0)
+    vocab = TinyVocab()
+    model = build_model(tiny_model_config(), vocab).eval()
+
+    # padded regions and questions, so the masks of the graphs are exercised
+    items = InstanceList()
+    items.region_features = torch.randn(3, 7, 8)
+    items.region_lengths = torch.tensor([7, 4, 5])
+    items.question_lengths = torch.tensor([5, 3, 4])
+    question_tokens = torch.randint(4, len(vocab), (3, 5))
+    items.question_tokens = question_tokens.masked_fill(torch.arange(5) >= items.question_lengths[:, None], vocab.padding_idx)
+
+    output_dir = str(tmp_path_factory.mktemp("onnx"))
+    export_onnx(model, items, output_dir)
+
+    return model, items, OnnxPredictor(output_dir)
+
+def onnx_inputs(predictor, items):
+    return {name: items.get(name).numpy() for name in predictor.encoder_inputs}
+
+@pytest.mark.parametrize("beam_size", [1, 3])
+def test_beam_search_matches_torch(exported, beam_size):
+    model, items, predictor = exported
+
+    with torch.no_grad():
+        outs, log_probs = model.beam_search(items, batch_size=items.batch_size, beam_size=beam_size, out_size=1)
+    onnx_outs, onnx_log_probs = predictor.beam_search(onnx_inputs(predictor, items), beam_size=beam_size)
+
+    assert (outs.numpy() == onnx_outs).all()
+    torch.testing.assert_close(torch.from_numpy(onnx_log_probs), log_probs, atol=1e-4, rtol=1e-4)
+
+def test_greedy_decode_matches_torch(exported):
+    model, items, predictor = exported
+
+    with torch.no_grad():
+        outs, log_probs = model.greedy_decode(items, batch_size=items.batch_size)
+    onnx_outs, onnx_log_probs = predictor.greedy_decode(onnx_inputs(predictor, items))
+
+    assert (outs.numpy() == onnx_outs).all()
+    torch.testing.assert_close(torch.from_numpy(onnx_log_probs), log_probs, atol=1e-4, rtol=1e-4)
@@ -0,0 +1,99 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.nn import functional as F
+
+from builders.model_builder import build_model
+from utils.instance import InstanceList
+from tests.helpers import TinyVocab, tiny_model_config
+
+# the special tokens and the tokens of the training answers
+SHORTLIST = [0, 1, 2, 3, 5, 8, 9, 13, 17]
+
+class ShortlistVocab(TinyVocab):
+    def answer_token_ids(self):
+        return SHORTLIST
+
+def build_models(vocab):
+    config = tiny_model_config()
+    torch.manual_seed(0)
+    model = build_model(config, vocab).eval()
+    config.DECODER.OUTPUT_SHORTLIST = True
+    shortlist_model = build_model(config, vocab).eval()
+    # the shortlist model projects on the rows of the shortlisted tokens only
+    state_dict = model.state_dict()
+    state_dict["decoder.fc.weight"] = state_dict["decoder.fc.weight"][SHORTLIST]
+    shortlist_model.load_state_dict(state_dict)
+
+    return model, shortlist_model
+
+def build_inputs(vocab):
+    torch.manual_seed(1)
+    items = InstanceList()
+    items.region_features = torch.randn(3, 7, 8)
+    items.region_lengths = torch.tensor([7, 4, 5])
+    items.question_lengths = torch.tensor([5, 3, 4])
+    question_tokens = torch.randint(4, len(vocab), (3, 5))
+    items.question_tokens = question_tokens.masked_fill(torch.arange(5) >= items.question_lengths[:, None], vocab.padding_idx)
+    # answers made of shortlisted tokens
+    answer_tokens = torch.tensor(SHORTLIST[4:])[torch.randint(0, len(SHORTLIST) - 4, (3, 4))]
+    items.answer_tokens = answer_tokens.masked_fill(torch.arange(4) >= torch.tensor([[4], [2], [3]]), vocab.padding_idx)
+    items.shifted_right_answer_tokens = torch.cat([items.answer_tokens[:, 1:], torch.zeros((3, 1), dtype=torch.long)], dim=-1)
+
+    return items
+
+def restrict_to_shortlist(module, inputs, output):
+    # the full-vocab distribution renormalized over the shortlisted tokens
+    disallowed = torch.ones(output.shape[-1], dtype=torch.bool)
+    disallowed[SHORTLIST] = False
+
+    return F.log_softmax(output.masked_fill(disallowed, -10e4), dim=-1)
+
+def test_output_ids_round_trip():
+    vocab = ShortlistVocab()
+    _, shortlist_model = build_models(vocab)
+
+    output_ids = torch.arange(len(SHORTLIST))
+    assert shortlist_model.from_output_ids(output_ids).tolist() == SHORTLIST
+    assert torch.equal(shortlist_model.to_output_ids(shortlist_model.from_output_ids(output_ids)), output_ids)
+    # the special tokens keep their ids, the tokens outside of the shortlist become <unk>
+    tokens = torch.tensor([[0, 1, 2, 3], [4, 5, 6, 17]])
+    assert shortlist_model.to_output_ids(tokens).tolist() == [[0, 1, 2, 3], [3, 4, 3, 8]]
+
+def test_shortlist_matches_full_vocab_on_shortlisted_targets():
+    vocab = ShortlistVocab()
+    model, shortlist_model = build_models(vocab)
+    items = build_inputs(vocab)
+    model.decoder.register_forward_hook(restrict_to_shortlist)
+
+    with torch.no_grad():
+        out = model(items)
+        shortlist_out = shortlist_model(items)
+    targets = items.shifted_right_answer_tokens.view(-1)
+    loss = F.nll_loss(out.view(-1, out.shape[-1]), targets, ignore_index=vocab.padding_idx)
+    shortlist_loss = F.nll_loss(shortlist_out.view(-1, shortlist_out.shape[-1]), shortlist_model.to_output_ids(targets),
+                                ignore_index=vocab.padding_idx)
+
+    torch.testing.assert_close(shortlist_out, out[..., SHORTLIST])
+    torch.testing.assert_close(shortlist_loss, loss)
+
+@pytest.mark.parametrize("beam_size", [1, 3])
+def test_shortlist_decoding_matches_full_vocab(beam_size):
+    vocab = ShortlistVocab()
+    model, shortlist_model = build_models(vocab)
+    items = build_inputs(vocab)
+    model.decoder.register_forward_hook(restrict_to_shortlist)
+
+    with torch.no_grad():
+        if beam_size == 1:
+            outs, log_probs = model.greedy_decode(items, batch_size=items.batch_size)
+            shortlist_outs, shortlist_log_probs = shortlist_model.greedy_decode(items, batch_size=items.batch_size)
+        else:
+            outs, log_probs = model.beam_search(items, batch_size=items.batch_size, beam_size=beam_size, out_size=1)
+            shortlist_outs, shortlist_log_probs = shortlist_model.beam_search(items, batch_size=items.batch_size, 
+                                                                              beam_size=beam_size, out_size=1)
+
+    # the decoded answers are vocab ids in both cases
+    assert torch.equal(shortlist_outs, outs)
+    torch.testing.assert_close(shortlist_log_probs, log_probs)
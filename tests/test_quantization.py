@@ -0,0 +1,49 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch import nn
+
+from models.modules.attentions import ScaledDotProductAttention
+from tests.helpers import attention_config
+
+def build_attention():
+    torch.manual_seed(0)
+
+    return ScaledDotProductAttention(attention_config()).eval()
+
+def run_attention(attention, x, memory):
+    # self-attention, cross-attention and keys differing from values
+    return (attention(x, x, x)[0], 
+            attention(x, memory, memory)[0], 
+            attention(x, memory, memory.flip(1))[0])
+
+def test_split_projections_match_fused():
+    attention = build_attention()
+    x = torch.randn(2, 5, 16)
+    memory = torch.randn(2, 7, 16)
+
+    with torch.no_grad():
+        expected = run_attention(attention, x, memory)
+        attention.split_projections()
+        outs = run_attention(attention, x, memory)
+
+    assert not hasattr(attention, "fc_qkv")
+    for out, expected_out in zip(outs, expected):
+        torch.testing.assert_close(out, expected_out)
+
+def test_quantized_projections_run_int8_layers():
+    attention = build_attention()
+    x = torch.randn(2, 5, 16)
+    memory = torch.randn(2, 7, 16)
+
+    with torch.no_grad():
+        expected = run_attention(attention, x, memory)
+        attention.split_projections()
+        attention = torch.ao.quantization.quantize_dynamic(attention, {nn.Linear}, dtype=torch.qint8)
+        outs = run_attention(attention, x, memory)
+
+    for fc in (attention.fc_q, attention.fc_kv, attention.fc_o):
+        assert isinstance(fc, torch.ao.nn.quantized.dynamic.Linear)
+    for out, expected_out in zip(outs, expected):
+        torch.testing.assert_close(out, expected_out, atol=5e-2, rtol=5e-2)
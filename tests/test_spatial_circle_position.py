@@ -0,0 +1,60 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.modules.SCP import SpatialCirclePosition
+from utils.spatial_circle_position import loop_cells, loop_distances, random_boxes
+from tests.helpers import attention_config
+
+NUM_DISTANCE = 8
+# the pixel distances of the former geometry are not capped, the embedding covers the diagonal of the images
+NUM_PIXEL_DISTANCE = 1000
+
+def build_scp(cell_distances: bool=True):
+    torch.manual_seed(0)
+    num_distance = NUM_DISTANCE if cell_distances else NUM_PIXEL_DISTANCE
+
+    return SpatialCirclePosition(attention_config(NUM_DISTANCE=num_distance, CELL_DISTANCES=cell_distances)).eval()
+
+@pytest.mark.parametrize("cell_distances", [True, False])
+def test_cells_and_distances_match_loops(cell_distances):
+    scp = build_scp(cell_distances)
+    image_sizes = [(640, 480), (123, 77), (11, 5)]
+    boxes = random_boxes(3, 20, image_sizes)
+    # centroids on cell boundaries and past the last boundary
+    boxes[0, 0] = torch.tensor([58, 43, 58, 43])
+    boxes[0, 1] = torch.tensor([639, 479, 639, 479])
+
+    cells = scp.patch(boxes, torch.tensor(image_sizes))
+    torch.testing.assert_close(cells, loop_cells(boxes, image_sizes, cell_distances))
+    num_distance = NUM_DISTANCE if cell_distances else None
+    torch.testing.assert_close(scp.distance_buckets(cells), loop_distances(cells, num_distance))
+
+def test_former_geometry_by_default():
+    scp = SpatialCirclePosition(attention_config(NUM_DISTANCE=NUM_PIXEL_DISTANCE))
+    # the centroid of a box is half its width and height: (58, 43) on the boundary of the cell (1, 1) of a 640x480
+    # image for the first box, (29, 21) in the cell (0, 0) for the second one although it lies in the bottom right corner
+    boxes = torch.tensor([[[0, 0, 116, 86], [580, 430, 638, 473]]])
+
+    cells = scp.patch(boxes, torch.tensor([[640, 480]]))
+
+    # the pixel centres of the 58x43 cells, 72px apart
+    assert cells.tolist() == [[[87, 64], [29, 21]]]
+    assert scp.distance_buckets(cells).tolist() == [[[0, 72], [72, 0]]]
+
+@pytest.mark.parametrize("cell_distances", [True, False])
+def test_forward(cell_distances):
+    # constructing the module used to fail, init_weights read the distance embedding before it was created
+    scp = build_scp(cell_distances)
+    image_sizes = [(640, 480), (320, 240)]
+    boxes = random_boxes(2, 10, image_sizes)
+    features = torch.randn(2, 10, 16)
+    padding_masks = torch.zeros((2, 1, 1, 10), dtype=torch.bool)
+    padding_masks[1, ..., 7:] = True
+
+    with torch.no_grad():
+        out, att = scp(features, boxes, padding_masks, image_sizes)
+
+    assert out.shape == (2, 10, 16)
+    assert att.shape == (2, 2, 10, 10)
+    assert torch.all(att[1, ..., 7:] < 1e-6)
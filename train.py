@@ -1,4 +1,6 @@
 import argparse
+import torch
+from torch import distributed as dist
 
 from configs.utils import get_config
 from builders.task_builder import build_task
@@ -10,15 +12,29 @@ logger = setup_logger()
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--config-file", type=str, required=True)
+parser.add_argument("--quantize", type=str, default=None, choices=["dynamic-int8"])
 
 args = parser.parse_args()
 
 config = get_config(args.config_file)
 
+# launched with torchrun, e.g. torchrun --nproc_per_node=4 train.py --config-file ...
+distributed = int(os.environ.get("WORLD_SIZE", 1)) > 1
+if distributed:
+    dist.init_process_group(backend="gloo")
+    # the cores of the machine are shared between the ranks running on it
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", dist.get_world_size()))
+    torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+
 task = build_task(config)
 
 task.start()
-task.get_predictions()
+if distributed:
+    # best_model is written by rank 0 only
+    dist.barrier()
+task.get_predictions(quantize=args.quantize)
+if distributed:
+    dist.destroy_process_group()
 logger.info("Task done.")
 
 # #shutdown pc
@@ -0,0 +1,164 @@
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from utils.logging_utils import setup_logger
+
+import os
+import time
+import uuid
+from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
+
+logger = setup_logger()
+
+# a checkpoint "<stem>" is written as <stem>.safetensors holding every tensor of the checkpoint
+# and <stem>.state.pth, a small sidecar holding the remaining python objects
+WEIGHTS_SUFFIX = ".safetensors"
+SIDECAR_SUFFIX = ".state.pth"
+TENSOR_KEY = "__tensor__"
+
+def checkpoint_files(stem: str):
+    return stem + WEIGHTS_SUFFIX, stem + SIDECAR_SUFFIX
+
+def checkpoint_exists(stem: str) -> bool:
+    return all(os.path.isfile(fname) for fname in checkpoint_files(stem))
+
+def split_tensors(obj, tensors: dict, prefix: str):
+    '''
+        Moves a CPU copy of every tensor of obj into tensors, replacing it by a reference to its key.
+    '''
+    if isinstance(obj, torch.Tensor):
+        tensors[prefix] = obj.detach().to("cpu", copy=True).contiguous()
+        return {TENSOR_KEY: prefix}
+    if isinstance(obj, dict):
+        return {key: split_tensors(value, tensors, f"{prefix}.{key}") for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(split_tensors(value, tensors, f"{prefix}.{ith}") for ith, value in enumerate(obj))
+
+    return obj
+
+def tensor_keys(obj):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and TENSOR_KEY in obj:
+            yield obj[TENSOR_KEY]
+            return
+        for value in obj.values():
+            yield from tensor_keys(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            yield from tensor_keys(value)
+
+def merge_tensors(obj, tensors):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and TENSOR_KEY in obj:
+            return tensors[obj[TENSOR_KEY]]
+        return {key: merge_tensors(value, tensors) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(merge_tensors(value, tensors) for value in obj)
+
+    return obj
+
+def snapshot_checkpoint(checkpoint: dict):
+    '''
+        Returns the tensors and the sidecar of checkpoint. The tensors are copied to CPU,
+        so training can go on updating the parameters while they are written.
+    '''
+    tensors = {}
+    sidecar = split_tensors(checkpoint, tensors, "checkpoint")
+
+    return tensors, sidecar
+
+def write_checkpoint(tensors: dict, sidecar: dict, stem: str):
+    '''
+        Each file is written next to its destination then renamed over it, so a reader never sees
+        a partially written file. Both files carry the same id to detect a pair from different saves.
+    '''
+    weights_file, sidecar_file = checkpoint_files(stem)
+    checkpoint_id = uuid.uuid4().hex
+    save_file(tensors, weights_file + ".tmp", metadata={"checkpoint_id": checkpoint_id})
+    torch.save({"checkpoint_id": checkpoint_id, "checkpoint": sidecar}, sidecar_file + ".tmp")
+    os.replace(weights_file + ".tmp", weights_file)
+    os.replace(sidecar_file + ".tmp", sidecar_file)
+
+def read_checkpoint(stem: str, fields=None) -> dict:
+    '''
+        fields: the entries of the checkpoint to load, all of them when None.
+        The weights file is memory-mapped and only the tensors of fields are materialized,
+        e.g. the optimizer state is never read when fields is ("state_dict", "epoch").
+    '''
+    weights_file, sidecar_file = checkpoint_files(stem)
+    sidecar = torch.load(sidecar_file, weights_only=False)
+    checkpoint = sidecar["checkpoint"]
+    if fields is not None:
+        checkpoint = {key: value for key, value in checkpoint.items() if key in fields}
+
+    tensors = {}
+    with safe_open(weights_file, framework="pt", device="cpu") as f:
+        if f.metadata()["checkpoint_id"] != sidecar["checkpoint_id"]:
+            logger.warning("%s and %s come from different saves", weights_file, sidecar_file)
+        for key in tensor_keys(checkpoint):
+            tensors[key] = f.get_tensor(key)
+
+    return merge_tensors(checkpoint, tensors)
+
+def promote_checkpoint(source: str, target: str):
+    '''
+        Makes the checkpoint files of target point to the ones of source. Hardlinks avoid copying the
+        weights, and the links are renamed over the target files so the swap of each file is atomic.
+    '''
+    for source_file, target_file in zip(checkpoint_files(source), checkpoint_files(target)):
+        if os.path.exists(target_file + ".tmp"):
+            os.remove(target_file + ".tmp")
+        try:
+            os.link(source_file, target_file + ".tmp")
+        except OSError:
+            # file systems without hardlinks
+            copyfile(source_file, target_file + ".tmp")
+        os.replace(target_file + ".tmp", target_file)
+
+class CheckpointWriter(object):
+    '''
+        Writes checkpoints on a background thread. Only the CPU snapshot of the checkpoint is taken
+        on the training thread. The jobs run one at a time in submission order, so a promotion
+        submitted after a save sees the files of that save.
+    '''
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = []
+
+    def _check_errors(self):
+        pending = []
+        for future in self.futures:
+            if future.done():
+                # raises the error of a failed write on the training thread
+                future.result()
+            else:
+                pending.append(future)
+        self.futures = pending
+
+    def _write(self, tensors: dict, sidecar: dict, stem: str):
+        start_time = time.perf_counter()
+        write_checkpoint(tensors, sidecar, stem)
+        logger.info("Checkpoint written to %s in %.2fs", stem, time.perf_counter() - start_time)
+
+    def save(self, checkpoint: dict, stem: str) -> float:
+        '''
+            Returns the time the training thread was stalled for the snapshot.
+        '''
+        self._check_errors()
+        start_time = time.perf_counter()
+        tensors, sidecar = snapshot_checkpoint(checkpoint)
+        stall_time = time.perf_counter() - start_time
+        self.futures.append(self.executor.submit(self._write, tensors, sidecar, stem))
+
+        return stall_time
+
+    def promote(self, source: str, target: str):
+        self._check_errors()
+        self.futures.append(self.executor.submit(promote_checkpoint, source, target))
+
+    def wait(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
@@ -151,6 +151,23 @@ class InstanceList(OrderedDict):
         
         return ret
 
+    # Tensor-like methods
+    def index_select(self, indices: torch.Tensor) -> "InstanceList":
+        """
+        Returns:
+            InstanceList: the rows `indices` of all fields, tensors are indexed along their first dimension
+                and lists item by item.
+        """
+        ret = InstanceList()
+        for k, v in self.items():
+            if isinstance(v, torch.Tensor):
+                v = v[indices.to(v.device)]
+            elif isinstance(v, list):
+                v = [v[idx] for idx in indices.tolist()]
+            ret.set(k, v)
+
+        return ret
+
     # special method for concatenating tensor objects
     def pad_values(self, values: List[torch.tensor], padding_value=0) -> List[torch.tensor]:
         padded_values = []
@@ -0,0 +1,152 @@
+import numpy as np
+import onnxruntime as ort
+
+import os
+import json
+
+class OnnxPredictor(object):
+    '''
+        Runs greedy decoding and beam search around the graphs written by models.onnx_export.export_onnx.
+        Only numpy and onnxruntime are needed, so predictions can be served by a process without torch.
+        The decoding follows GreedySearch and BeamSearch step by step, with the caches held as arrays.
+    '''
+    def __init__(self, model_dir: str, providers=("CPUExecutionProvider", )):
+        metadata = json.load(open(os.path.join(model_dir, "predictor.json")))
+        self.encoder_inputs = metadata["encoder_inputs"]
+        self.n_layers = metadata["n_layers"]
+        self.head = metadata["head"]
+        self.d_key = metadata["d_key"]
+        self.d_value = metadata["d_value"]
+        self.max_len = metadata["max_len"]
+        self.bos_idx = metadata["bos_idx"]
+        self.eos_idx = metadata["eos_idx"]
+        self.padding_idx = metadata["padding_idx"]
+        # vocab ids of the output distribution when the decoder uses an output shortlist
+        output_ids = metadata.get("output_ids")
+        self.output_ids = np.asarray(output_ids, dtype=np.int64) if output_ids is not None else None
+
+        self.encoder = ort.InferenceSession(os.path.join(model_dir, "encoder.onnx"), providers=list(providers))
+        self.decoder_step = ort.InferenceSession(os.path.join(model_dir, "decoder_step.onnx"), providers=list(providers))
+
+    def encode(self, input_features: dict):
+        return self.encoder.run(None, {name: np.asarray(input_features[name]) for name in self.encoder_inputs})
+
+    def init_caches(self, b_s: int):
+        past_keys = np.zeros((self.n_layers, b_s, self.head, 0, self.d_key), dtype=np.float32)
+        past_values = np.zeros((self.n_layers, b_s, self.head, 0, self.d_value), dtype=np.float32)
+        past_mask = np.zeros((b_s, 1, 1, 0), dtype=bool)
+
+        return past_keys, past_values, past_mask
+
+    def step(self, t: int, tokens, encoder_states, caches):
+        enc_keys, enc_values, encoder_padding_mask = encoder_states
+        past_keys, past_values, past_mask = caches
+        log_probs, present_keys, present_values, present_mask = self.decoder_step.run(None, {
+            "tokens": tokens.astype(np.int64),
+            "step": np.array([t], dtype=np.int64),
+            "enc_keys": enc_keys,
+            "enc_values": enc_values,
+            "encoder_padding_mask": encoder_padding_mask,
+            "past_keys": past_keys,
+            "past_values": past_values,
+            "past_mask": past_mask
+        })
+
+        return log_probs, (present_keys, present_values, present_mask)
+
+    def from_output_ids(self, ids):
+        if self.output_ids is None:
+            return ids
+
+        return self.output_ids[ids]
+
+    def greedy_decode(self, input_features: dict):
+        encoder_states = self.encode(input_features)
+        b_s = encoder_states[0].shape[1]
+        caches = self.init_caches(b_s)
+
+        outputs = np.full((b_s, self.max_len), self.padding_idx, dtype=np.int64)
+        log_probs = np.zeros((b_s, self.max_len), dtype=np.float32)
+        unfinished = np.ones((b_s, ), dtype=bool)
+
+        selected_words = np.full((b_s, 1), self.bos_idx, dtype=np.int64)
+        for t in range(self.max_len):
+            word_logprob, caches = self.step(t, selected_words, encoder_states, caches)
+            words = word_logprob.argmax(axis=-1)
+            this_word_logprob = word_logprob[np.arange(b_s), words]
+
+            words = np.where(unfinished, words, self.padding_idx)
+            outputs[:, t] = words
+            log_probs[:, t] = np.where(unfinished, this_word_logprob, 0)
+
+            unfinished = unfinished & (words != self.eos_idx)
+            if not unfinished.any():
+                break
+
+            selected_words = words[:, None]
+
+        return self.from_output_ids(outputs), log_probs
+
+    def beam_search(self, input_features: dict, beam_size: int, out_size: int=1):
+        encoder_states = self.encode(input_features)
+        b_s = encoder_states[0].shape[1]
+        past_keys, past_values, past_mask = self.init_caches(b_s)
+
+        seq_mask = np.ones((b_s, beam_size, 1), dtype=np.float32)
+        seq_logprob = np.zeros((b_s, 1, 1), dtype=np.float32)
+        outputs = []
+        log_probs = []
+        selected_words = np.full((b_s, 1), self.bos_idx, dtype=np.int64)
+        for t in range(self.max_len):
+            cur_beam_size = 1 if t == 0 else beam_size
+
+            word_logprob, (past_keys, past_values, past_mask) = self.step(t, selected_words, encoder_states,
+                                                                            (past_keys, past_values, past_mask))
+            word_logprob = word_logprob.reshape(b_s, cur_beam_size, -1)
+            candidate_logprob = seq_logprob + word_logprob
+
+            # Mask sequence if it reaches <eos>
+            if t > 0:
+                mask = (selected_words.reshape(b_s, cur_beam_size) != self.eos_idx).astype(np.float32)[..., None]
+                seq_mask = seq_mask * mask
+                word_logprob = word_logprob * seq_mask
+                old_seq_logprob = np.broadcast_to(seq_logprob, candidate_logprob.shape).copy()
+                old_seq_logprob[:, :, 1:] = -999
+                candidate_logprob = seq_mask * candidate_logprob + old_seq_logprob * (1 - seq_mask)
+
+            candidate_logprob = candidate_logprob.reshape(b_s, -1)
+            selected_idx = np.argsort(-candidate_logprob, axis=-1, kind="stable")[:, :beam_size]
+            selected_logprob = np.take_along_axis(candidate_logprob, selected_idx, axis=-1)
+            selected_beam = selected_idx // word_logprob.shape[-1]
+            selected_words = selected_idx - selected_beam * word_logprob.shape[-1]
+
+            # reorder the caches along the selected beams, the encoder states are only expanded once
+            flat_beam = (np.arange(b_s)[:, None] * cur_beam_size + selected_beam).reshape(-1)
+            past_keys = past_keys[:, flat_beam]
+            past_values = past_values[:, flat_beam]
+            past_mask = past_mask[flat_beam]
+            if t == 0:
+                enc_keys, enc_values, encoder_padding_mask = encoder_states
+                encoder_states = (np.repeat(enc_keys, beam_size, axis=1), np.repeat(enc_values, beam_size, axis=1),
+                                    np.repeat(encoder_padding_mask, beam_size, axis=0))
+
+            seq_logprob = selected_logprob[..., None]
+            seq_mask = np.take_along_axis(seq_mask, selected_beam[..., None], axis=1)
+            outputs = [np.take_along_axis(o, selected_beam[..., None], axis=1) for o in outputs]
+            outputs.append(selected_words[..., None])
+
+            this_word_logprob = word_logprob[np.arange(b_s)[:, None], selected_beam, selected_words][..., None]
+            log_probs = [np.take_along_axis(o, selected_beam[..., None], axis=1) for o in log_probs]
+            log_probs.append(this_word_logprob)
+            selected_words = selected_words.reshape(-1, 1)
+
+        # Sort result
+        sort_idxs = np.argsort(-seq_logprob, axis=1, kind="stable")
+        sort_idxs = np.broadcast_to(sort_idxs, (b_s, beam_size, self.max_len))
+        outputs = np.take_along_axis(np.concatenate(outputs, axis=-1), sort_idxs, axis=1)[:, :out_size]
+        log_probs = np.take_along_axis(np.concatenate(log_probs, axis=-1), sort_idxs, axis=1)[:, :out_size]
+        if out_size == 1:
+            outputs = outputs.squeeze(1)
+            log_probs = log_probs.squeeze(1)
+
+        return self.from_output_ids(outputs), log_probs
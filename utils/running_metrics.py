@@ -0,0 +1,38 @@
+import torch
+
+import time
+
+class RunningMetrics(object):
+    '''
+        Running means of the metrics of a training or validation loop, kept as tensors on the device
+        of the metrics. Updating them does not synchronize with the device, the means are only read
+        back every log_every steps and when the loop ends.
+    '''
+    def __init__(self, log_every: int=50):
+        self.log_every = max(log_every, 1)
+        self.sums = {}
+        self.steps = 0
+        self.start_time = time.perf_counter()
+
+    def update(self, **metrics: torch.Tensor):
+        for name, value in metrics.items():
+            value = value.detach().float()
+            if name in self.sums:
+                self.sums[name].add_(value)
+            else:
+                self.sums[name] = value.clone()
+        self.steps += 1
+
+    def should_log(self) -> bool:
+        return self.steps % self.log_every == 0
+
+    def means(self) -> dict:
+        if self.steps == 0:
+            return {}
+        # a single transfer for all the metrics
+        means = (torch.stack(list(self.sums.values())) / self.steps).tolist()
+
+        return dict(zip(self.sums.keys(), means))
+
+    def steps_per_second(self) -> float:
+        return self.steps / (time.perf_counter() - self.start_time)
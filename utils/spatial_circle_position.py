@@ -0,0 +1,70 @@
+import torch
+
+import math
+from typing import List, Optional
+
+def loop_cells(ocr_boxes: torch.Tensor, image_sizes: List[tuple], cell_distances: bool=True) -> torch.Tensor:
+    '''
+        Per-token grid assignment of SpatialCirclePosition.patch, scanning the 11 cell boundaries as the former
+        implementation did. A centroid on a boundary goes to the higher cell and one past the last boundary
+        to the last cell.
+        cell_distances: returns the (column, row) indices of the cells, otherwise the former geometry: the centroid
+            of a box is half its width and height, and the pixel centres of the cells are returned.
+    '''
+    bs, n_ocr, _ = ocr_boxes.shape
+    cells = torch.zeros((bs, n_ocr, 2), dtype=torch.long)
+    for batch in range(bs):
+        img_w, img_h = image_sizes[batch]
+        w_per_area = max(img_w // 11, 1)
+        h_per_area = max(img_h // 11, 1)
+        for ith in range(n_ocr):
+            x1, y1, x2, y2 = ocr_boxes[batch, ith].tolist()
+            if cell_distances:
+                centroid_x = (x1 + x2) // 2
+                centroid_y = (y1 + y2) // 2
+            else:
+                centroid_x = (x2 - x1) // 2
+                centroid_y = (y2 - y1) // 2
+            # scanning the cells in order, the last one containing the centroid is kept
+            selected_x = 10
+            selected_y = 10
+            for cell in range(11):
+                if cell * w_per_area <= centroid_x <= (cell + 1) * w_per_area:
+                    selected_x = cell
+                if cell * h_per_area <= centroid_y <= (cell + 1) * h_per_area:
+                    selected_y = cell
+            if cell_distances:
+                cells[batch, ith] = torch.tensor([selected_x, selected_y])
+            else:
+                cells[batch, ith] = torch.tensor([selected_x * w_per_area + w_per_area // 2,
+                                                  selected_y * h_per_area + h_per_area // 2])
+
+    return cells
+
+def loop_distances(cells: torch.Tensor, num_distance: Optional[int]=None) -> torch.Tensor:
+    '''
+        Truncated Euclidean distances between every pair of tokens, capped at num_distance - 1 when given.
+    '''
+    bs, n_ocr, _ = cells.shape
+    dist = torch.zeros((bs, n_ocr, n_ocr), dtype=torch.long)
+    for batch in range(bs):
+        for i in range(n_ocr):
+            for j in range(i, n_ocr):
+                dx, dy = (cells[batch, i] - cells[batch, j]).tolist()
+                d = int(math.sqrt(dx * dx + dy * dy))
+                if num_distance is not None:
+                    d = min(d, num_distance - 1)
+                dist[batch, i, j] = d
+                dist[batch, j, i] = d
+
+    return dist
+
+def random_boxes(bs: int, n_ocr: int, image_sizes: List[tuple]) -> torch.Tensor:
+    '''
+        Integer (x1, y1, x2, y2) boxes lying in their images.
+    '''
+    sizes = torch.tensor(image_sizes, dtype=torch.float).view(bs, 1, 2)
+    corners = torch.rand(bs, n_ocr, 2, 2) * sizes.unsqueeze(2)
+    boxes = torch.cat([corners.min(dim=2).values, corners.max(dim=2).values], dim=-1)
+
+    return boxes.floor().long()